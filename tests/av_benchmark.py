@@ -0,0 +1,107 @@
+"""
+Benchmark of audio/video processing. Measures time of conversion and sending of outgoing video frames and of
+mixing of incoming audio. Results are printed as JSON (time in milliseconds per frame of video or per 20 ms of
+audio), so they can be compared between versions.
+
+Usage: python tests/av_benchmark.py [--frames N] [--calls N] [--output path]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'toxygen'))
+from calls import AV, Call
+from audio_mixer import AudioMixer, OUTPUT_RATE
+
+
+RESOLUTIONS = {
+    '480p': (640, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080)
+}
+
+
+class ToxAVMock:
+    """
+    Frames are not sent anywhere
+    """
+
+    def video_send_frame(self, friend_number, width, height, y, u, v):
+        return True
+
+
+def convert_video(args):
+    results = {}
+    for name, (width, height) in RESOLUTIONS.items():
+        frame = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        AV.convert_bgr_to_yuv(frame)  # warm up
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            AV.convert_bgr_to_yuv(frame)
+        results[name] = (time.perf_counter() - start) * 1000 / args.frames
+    return results
+
+
+def send_video(args):
+    """
+    Sending of 720p frames to args.calls friends. Half of friends receive video with reduced size
+    """
+    results = {}
+    av = AV(ToxAVMock())
+    frame = np.random.randint(0, 256, (720, 1280, 3), dtype=np.uint8)
+    for count in range(1, args.calls + 1):
+        call = Call(False, True)
+        call.video_max_height = 480 if count % 2 else None
+        av._calls[count] = call
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            av.send_video_frame(frame)
+        results[count] = (time.perf_counter() - start) * 1000 / args.frames
+    return results
+
+
+def mix_audio(args):
+    """
+    Mixing of audio of args.calls friends. Friends send 60 ms frames of mono audio with different rates
+    """
+    results = {}
+    rates = (48000, 24000, 16000, 8000)
+    for count in range(1, args.calls + 1):
+        mixer = AudioMixer()
+        frames = [np.random.randint(-1000, 1000, rates[i % len(rates)] * 60 // 1000, dtype=np.int16).tobytes()
+                  for i in range(count)]
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            for i in range(count):
+                mixer.add_frame(i, frames[i], 1, rates[i % len(rates)])
+            for _ in range(3):
+                mixer.read(OUTPUT_RATE // 50)
+        results[count] = (time.perf_counter() - start) * 1000 / (args.frames * 3)
+    return results
+
+
+def run(args):
+    return {'convert_bgr_to_yuv': convert_video(args), 'send_video_frame': send_video(args),
+            'mix_audio': mix_audio(args)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of audio/video processing')
+    parser.add_argument('--frames', type=int, default=300, help='count of processed frames')
+    parser.add_argument('--calls', type=int, default=8, help='max count of simultaneous calls')
+    parser.add_argument('--output', help='path to file with results (stdout by default)')
+    args = parser.parse_args()
+
+    report = json.dumps({'params': vars(args), 'results': run(args)}, indent=4)
+    if args.output:
+        with open(args.output, 'wt') as fl:
+            fl.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
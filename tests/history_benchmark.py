@@ -0,0 +1,154 @@
+"""
+Benchmark of chat history. Generates synthetic history db and measures time of typical operations.
+Results are printed as JSON (time in seconds), so they can be compared between versions.
+
+Usage: python tests/history_benchmark.py [--contacts N] [--messages N] [--size N] [--encrypted] [--output path]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'toxygen'))
+from settings import ProfileHelper
+from toxes import ToxES
+from history import History, MESSAGE_OWNER, PAGE_SIZE
+from friend import Friend
+from messages import TextMessage
+import history_export
+
+
+WORDS = ('hello', 'tox', 'message', 'file', 'call', 'video', 'audio', 'friend', 'profile', 'history', 'test', 'ok')
+
+NEEDLE = 'xylophone'  # word which is added to one old message of every contact for search benchmark
+
+PASSWORD = 'benchmark'
+
+PROFILE_NAME = 'benchmark'
+
+GENERATION_BATCH = 10000
+
+
+def random_text(size):
+    words = []
+    while sum(map(len, words)) + len(words) < size:
+        words.append(random.choice(WORDS))
+    return ' '.join(words)[:size]
+
+
+def tox_id(i):
+    return '{:076X}'.format(i)
+
+
+class Timer:
+
+    def __init__(self, results, name):
+        self._results, self._name = results, name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self._results[self._name] = time.perf_counter() - self._start
+
+
+def generate(args):
+    """
+    Creates history db with args.contacts contacts and args.messages messages of every contact
+    """
+    history = History(PROFILE_NAME)
+    t = time.time() - args.messages * 60
+    for contact in range(args.contacts):
+        history.add_friend_to_db(tox_id(contact))
+        needle = args.messages // 10
+        for start in range(0, args.messages, GENERATION_BATCH):
+            messages = []
+            for i in range(start, min(start + GENERATION_BATCH, args.messages)):
+                text = random_text(args.size)
+                if i == needle:
+                    text = NEEDLE + ' ' + text
+                messages.append((text, MESSAGE_OWNER['ME'] if i % 2 else MESSAGE_OWNER['FRIEND'], t + i * 60, 0))
+            history.save_messages_to_db(tox_id(contact), messages)
+    history.save()
+
+
+def run(args):
+    results = {}
+    encr = ToxES()
+    encr.set_password(PASSWORD if args.encrypted else None)
+    with Timer(results, 'generate'):
+        generate(args)
+
+    with Timer(results, 'open'):
+        history = History(PROFILE_NAME)
+
+    friends = [Friend(history.messages_getter(tox_id(i)), i, str(i), '', None, tox_id(i))
+               for i in range(args.contacts)]
+    with Timer(results, 'first_page'):
+        for friend in friends:
+            friend.load_corr()
+    results['first_page'] /= args.contacts
+
+    friend = friends[0]
+    with Timer(results, 'scroll_back'):
+        for _ in range(args.pages):
+            friend.load_corr(False)
+    results['scroll_back'] /= args.pages
+
+    with Timer(results, 'search_indexed'):
+        history.search_messages(tox_id(0), NEEDLE)
+    with Timer(results, 'search_regex'):
+        history.search_messages(tox_id(0), NEEDLE[:4] + '.*' + NEEDLE[-4:])
+    with Timer(results, 'search_scroll_back'):
+        friend.search_string(NEEDLE)
+
+    for friend in friends:
+        for i in range(args.session):
+            friend.append_message(TextMessage(random_text(args.size), MESSAGE_OWNER['ME'], time.time(), 0))
+    with Timer(results, 'save_messages'):  # writing of new messages of all contacts in one transaction
+        with history.transaction():
+            for friend in friends:
+                history.save_messages_to_db(friend.tox_id, friend.get_corr_for_saving())
+                friend.mark_corr_as_saved()
+
+    contacts = [(friend.name, friend.tox_id, []) for friend in friends]
+    with Timer(results, 'export'):
+        with open(os.devnull, 'wt') as fl:
+            history_export.export_history(history, fl, 'jsonl', 'me', contacts)
+
+    with Timer(results, 'close'):
+        history.save()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of chat history')
+    parser.add_argument('--contacts', type=int, default=10, help='count of contacts')
+    parser.add_argument('--messages', type=int, default=100000, help='count of messages of every contact')
+    parser.add_argument('--size', type=int, default=100, help='length of every message')
+    parser.add_argument('--encrypted', action='store_true', help='encrypt history with password')
+    parser.add_argument('--pages', type=int, default=100, help='count of pages loaded on scroll-back')
+    parser.add_argument('--session', type=int, default=PAGE_SIZE, help='count of new messages of every contact')
+    parser.add_argument('--output', help='path to file with results (stdout by default)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        ProfileHelper(directory, PROFILE_NAME)
+        results = run(args)
+    finally:
+        shutil.rmtree(directory)
+    report = json.dumps({'params': vars(args), 'results': results}, indent=4)
+    if args.output:
+        with open(args.output, 'wt') as fl:
+            fl.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
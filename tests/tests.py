@@ -3,6 +3,10 @@ from toxygen.tox_dns import tox_dns
 from toxygen.history import History
 from toxygen.smileys import SmileyLoader
 from toxygen.messages import *
+from toxygen.file_transfers import Holes, ResumableTransfers, BlockHashes, HASH_BLOCK_SIZE, BandwidthShaper, BURST_TIME
+from toxygen.file_transfers import ReadAheadSource, READ_AHEAD_BLOCK, ToxCalls, CHUNK_SENDING_ATTEMPTS
+from toxygen.transfers_scheduler import TransfersScheduler
+from toxygen.audio_mixer import AudioMixer, JITTER_BUFFER_DELAY
 import toxygen.toxes as encr
 import toxygen.util as util
 import time
@@ -96,6 +100,149 @@ def create_random_friend():
     return friend
 
 
+class TestFileTransfers:
+
+    def test_holes(self):
+        holes = Holes()
+        holes.add(0, 100)
+        holes.add(200, 300)
+        holes.remove(50, 250)
+        assert holes.first() == 0
+        holes.remove(0, 50)
+        assert holes.first() == 250
+        holes.remove(260, 270)
+        assert len(holes) == 2
+        holes.remove(250, 300)
+        assert holes.first() is None
+
+    def test_block_hashes(self):
+        create_singletons()
+        path = ProfileHelper.get_path() + 'hashed_file'
+        data = os.urandom(2 * HASH_BLOCK_SIZE + 100)
+        with open(path, 'wb') as fl:
+            fl.write(data)
+        hashes = BlockHashes(len(data))
+        for i in range(0, len(data), 1000):
+            if not HASH_BLOCK_SIZE < i <= HASH_BLOCK_SIZE + 1000:  # gap - rest of file is hashed from disk
+                hashes.update(i, data[i:i + 1000])
+        assert hashes.get_hashes()[0] is not None and hashes.get_hashes()[1] is None
+        hashes.finish(path)
+        other = BlockHashes(len(data))
+        other.finish(path)
+        assert hashes.mismatched_range(other.get_hashes()) is None
+        other.get_hashes()[1] = b''
+        assert hashes.mismatched_range(other.get_hashes()) == (HASH_BLOCK_SIZE, 2 * HASH_BLOCK_SIZE)
+
+    def test_read_ahead(self):
+        create_singletons()
+        path = ProfileHelper.get_path() + 'read_file'
+        data = os.urandom(8 * READ_AHEAD_BLOCK + 100)
+        with open(path, 'wb') as fl:
+            fl.write(data)
+
+        def read(position, size=1000):
+            for _ in range(100):  # wait for reading thread
+                hits = source.get_stats()['hits']
+                chunk = bytes(source.get_chunk(position, size))
+                if source.get_stats()['hits'] > hits:
+                    break
+                time.sleep(0.01)
+            assert chunk == data[position:position + size]
+
+        with open(path, 'rb') as fl:
+            source = ReadAheadSource(fl, len(data), 2 * READ_AHEAD_BLOCK)
+            read(0)
+            read(READ_AHEAD_BLOCK - 500)  # chunk from two blocks
+            read(6 * READ_AHEAD_BLOCK)  # seek forward
+            read(8 * READ_AHEAD_BLOCK + 50)  # end of file
+            read(100)  # seek back, blocks are read again
+            assert source.get_stats()['hits'] == 5
+            source.close()
+        os.remove(path)
+
+    def test_tox_calls_sendq(self):
+        sent, failures = [], [1]
+
+        def send_chunk(position):
+            if position == 1 and failures[0]:
+                failures[0] -= 1
+                raise RuntimeError('Packet queue is full.')
+            sent.append(position)
+        calls = ToxCalls()
+        for position in range(3):
+            calls.add(send_chunk, position, attempts=CHUNK_SENDING_ATTEMPTS, key=(0, 0))
+        calls.add(sent.append, 'other')
+        calls.run()
+        assert sent == [0, 'other']  # next chunks of transfer wait for failed chunk
+        calls.add(send_chunk, 3, attempts=CHUNK_SENDING_ATTEMPTS, key=(0, 0))
+        calls.run()
+        assert sent == [0, 'other', 1, 2, 3]
+
+    def test_transfers_scheduler(self):
+        started = []
+        scheduler = TransfersScheduler(lambda *args: started.append(args) or True, lambda n: True, 2, 3)
+        scheduler.add(0, [('big', 100, 'A', None), ('small', 1, 'B', None), ('medium', 10, 'C', 'dir/medium')])
+        scheduler.add(1, [('other', 1000, 'D', None), ('other2', 1000, 'E', None)])
+        assert list(map(lambda x: x[2], started)) == ['B', 'C', 'D']
+        assert started[1][3] == 'dir/medium'
+        scheduler.transfer_finished('B')
+        assert started[-1][2] == 'A'
+        assert scheduler.get_queue_size() == 1
+        assert 'E' in scheduler and 'B' not in scheduler
+
+    def test_transfers_scheduler_postpone(self):
+        results = [None, True]
+        scheduler = TransfersScheduler(lambda *args: results.pop(0), lambda n: True, 2, 3)
+        scheduler.add(0, [('a', 1, 'A', 'dir/a')])
+        assert scheduler.get_queue_size() == 1
+        scheduler.schedule()
+        assert scheduler.get_queue_size() == 0 and 'A' in scheduler
+
+    def test_bandwidth_shaper(self):
+        call = [False]
+        shaper = BandwidthShaper(lambda: call[0])
+        shaper.set_limits(0, 1000, {1: 100}, 10)
+        assert shaper.consume(0, False, 10 ** 6) == 0
+        assert shaper.consume(0, True, 1000 * BURST_TIME) < 0.01
+        assert 0.9 < shaper.consume(0, True, 1000) < 1.1
+        assert shaper.consume(1, False, 100 * BURST_TIME + 100) > 0.9
+        call[0] = True
+        assert shaper.consume(2, False, 100) > 5
+
+    def test_resumable_transfers(self):
+        create_singletons()
+        ToxES().set_password(None)
+        path = ProfileHelper.get_path() + 'test.transfers'
+        if os.path.exists(path):
+            os.remove(path)
+        transfers = ResumableTransfers(path)
+        transfers.add('AA', '/tmp/file', 0, True, 1000)
+        transfers.add('BB', '/tmp/other_file', 1, False, 2000)
+        assert transfers.update('AA', 500, {'0': 'ff'})
+        transfers.save()
+        transfers.remove('BB')
+        assert 'BB' in ResumableTransfers(path)  # not saved yet
+        transfers.save()
+        transfers = ResumableTransfers(path)
+        assert 'BB' not in transfers
+        assert transfers.get('AA')['position'] == 500
+        assert transfers.get('AA')['hashes'] == {'0': 'ff'}
+
+
+class TestAudioMixer:
+
+    def test_mixer(self):
+        mixer = AudioMixer()
+        samples = bytes(4) * 48 * JITTER_BUFFER_DELAY  # silence in 48000 Hz stereo
+        assert mixer.read(960) == bytes(3840)
+        mixer.add_frame(1, b'\x10\x00' * 8 * JITTER_BUFFER_DELAY, 1, 8000)
+        mixer.add_frame(2, samples, 2, 48000)
+        data = mixer.read(960)
+        assert data[:4] == b'\x10\x00\x10\x00' and data[-4:] == b'\x10\x00\x10\x00'
+        mixer.remove_friend(1)
+        assert mixer.read(960) == bytes(3840)
+
+
 class TestFriend:
 
     def test_friend_creation(self):
@@ -127,6 +274,8 @@ class TestFriend:
                              TOX_FILE_TRANSFER_STATE['RUNNING'],
                              100, 'file_name', friend.number, 0)
         friend.append_message(tm)
+        assert friend.update_transfer_data(0, TOX_FILE_TRANSFER_STATE['RUNNING']) == -1
+        assert friend.update_transfer_data(1, TOX_FILE_TRANSFER_STATE['RUNNING']) is None
         friend.clear_corr()
         assert len(friend.get_corr()) == 1
         assert len(friend.get_corr_for_saving()) == 0
@@ -134,6 +283,19 @@ class TestFriend:
         assert len(friend.get_corr()) == 2
         assert len(friend.get_corr_for_saving()) == 1
 
+    def test_friend_unsent(self):
+        create_singletons()
+        friend = create_random_friend()
+        t = time.time()
+        friend.append_message(TextMessage('First', MESSAGE_OWNER['NOT_SENT'], t, 0))
+        friend.append_message(TextMessage('Hello!', MESSAGE_OWNER['FRIEND'], t + 0.001, 0))
+        friend.append_message(TextMessage('Second', MESSAGE_OWNER['NOT_SENT'], t + 0.002, 0))
+        assert [m.get_data()[0] for m in friend.get_unsent_messages()] == ['First', 'Second']
+        friend.mark_as_sent()
+        assert friend.get_corr()[0].get_owner() == MESSAGE_OWNER['ME']
+        assert len(friend.get_unsent_messages()) == 1
+        assert friend.get_last_message_text() == 'Second'
+
     def test_history_search(self):
         create_singletons()
         friend = create_random_friend()
@@ -146,6 +308,23 @@ class TestFriend:
         result = friend.search_string('tox')
         assert result is None
 
+    def test_friend_unload_messages(self):
+        create_singletons()
+        history = History('my_name')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.add_friend_to_db(tox_id)
+        t = time.time()
+        history.save_messages_to_db(tox_id, [(str(i), MESSAGE_OWNER['ME'], t + i, 0) for i in range(100)])
+        friend = Friend(history.messages_getter(tox_id), 0, 'Friend', '', None, tox_id)
+        friend.load_all_corr()
+        friend.append_message(TextMessage('Unsaved', MESSAGE_OWNER['ME'], t + 100, 0))
+        assert friend.unload_old_messages(100) == 101 - PAGE_SIZE
+        assert friend.get_corr()[-1].get_data()[0] == 'Unsaved'
+        friend.load_all_corr()
+        assert len(friend.get_corr()) == 101
+        history.delete_friend_from_db(tox_id)
+        history.close()
+
 
 class TestHistory:
 
@@ -175,3 +354,140 @@ class TestHistory:
         assert len(messages) == 0
         history.delete_friend_from_db(friend.tox_id)
         assert not history.friend_exists_in_db(friend.tox_id)
+
+    def test_history_transaction(self):
+        create_singletons()
+        history = History('my_name')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        t = time.time()
+        with history.transaction():
+            history.add_friend_to_db(tox_id)
+            assert history.friend_exists_in_db(tox_id)
+            history.save_messages_to_db(tox_id, [('Test!', MESSAGE_OWNER['NOT_SENT'], t, 0)])
+            history.update_messages(tox_id, t + 1)
+        messages = history.messages_getter(tox_id).get_all()
+        assert len(messages) == 1
+        assert messages[0][1] == MESSAGE_OWNER['ME']
+        history.delete_friend_from_db(tox_id)
+        history.close()
+
+    def test_history_pages(self):
+        create_singletons()
+        history = History('my_name')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.add_friend_to_db(tox_id)
+        t = time.time()
+        history.save_messages_to_db(tox_id, [(str(i), MESSAGE_OWNER['ME'], t + i // 2, 0) for i in range(100)])
+        getter = history.messages_getter(tox_id)
+        messages = []
+        page = getter.get(PAGE_SIZE)
+        while page:
+            messages.extend(page)
+            page = getter.get(PAGE_SIZE)
+        assert len(messages) == 100
+        assert len(set(m[0] for m in messages)) == 100
+        assert messages[0][2] >= messages[-1][2]
+        history.delete_friend_from_db(tox_id)
+        history.close()
+
+    def test_history_migration(self):
+        import sqlite3
+        create_singletons()
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        path = ProfileHelper.get_path() + 'legacy.hstr'
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE friends(tox_id TEXT PRIMARY KEY)')
+        db.execute('INSERT INTO friends VALUES (?)', (tox_id, ))
+        db.execute('CREATE TABLE id' + tox_id + '(id INTEGER PRIMARY KEY, message TEXT, owner INTEGER, '
+                   'unix_time REAL, message_type INTEGER)')
+        t = time.time()
+        db.executemany('INSERT INTO id' + tox_id + '(message, owner, unix_time, message_type) VALUES (?, ?, ?, ?)',
+                       [(str(i), MESSAGE_OWNER['FRIEND'], t + i, 0) for i in range(30)])
+        db.commit()
+        db.close()
+        history = History('legacy')
+        assert history.friend_exists_in_db(tox_id)
+        messages = history.messages_getter(tox_id).get_all()
+        assert len(messages) == 30
+        assert messages[0][0] == '29'
+        history.close()
+
+    def test_history_search(self):
+        create_singletons()
+        history = History('my_name')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.add_friend_to_db(tox_id)
+        t = time.time()
+        history.save_messages_to_db(tox_id, [('Hello! It is test!', MESSAGE_OWNER['ME'], t, 0),
+                                             ('Other message', MESSAGE_OWNER['FRIEND'], t + 1, 0)])
+        assert len(history.search_messages(tox_id, 'test')) == 1
+        assert len(history.search_messages(tox_id, 'e[m|s]')) == 2
+        assert not history.search_messages(tox_id, 'tox')
+        getter = history.messages_getter(tox_id)
+        found = getter.search('hello')
+        assert found is not None
+        assert len(getter.get_until(found)) == 2
+        assert getter.search('hello') is None
+        history.delete_friend_from_db(tox_id)
+        history.close()
+
+    def test_history_encryption(self):
+        create_singletons()
+        lib = ToxES()  # same module as used by history
+        lib.set_password('toxygen')
+        path = ProfileHelper.get_path() + 'encrypted.hstr'
+        if os.path.exists(path):
+            os.remove(path)
+        history = History('encrypted')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.add_friend_to_db(tox_id)
+        history.save_messages_to_db(tox_id, [('Secret message', MESSAGE_OWNER['ME'], time.time(), 0)])
+        assert len(history.search_messages(tox_id, 'secret')) == 1
+        lib.set_password('new password')
+        history.save()
+        with open(path, 'rb') as fl:
+            assert b'Secret message' not in fl.read()
+        history = History('encrypted')
+        assert history.messages_getter(tox_id).get_one()[0] == 'Secret message'
+        lib.set_password(None)
+        history.save()
+        history = History('encrypted')
+        assert history.messages_getter(tox_id).get_one()[0] == 'Secret message'
+        history.close()
+
+    def test_history_journal(self):
+        create_singletons()
+        history = History('my_name')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.add_friend_to_db(tox_id)
+        getter = history.messages_getter(tox_id)
+        history.start_journal()
+        t = time.time()
+        history.write_later([(history.save_messages_to_db, (tox_id, [('Test!', MESSAGE_OWNER['ME'], t, 0)]))])
+        history.flush()
+        assert getter.get_one() is None  # messages saved after creation of getter are in memory
+        assert len(history.messages_getter(tox_id).get_all()) == 1
+        history.delete_friend_from_db(tox_id)
+        history.close()
+
+    def test_history_export(self):
+        import io
+        import json
+        from toxygen.history_export import export_history
+        create_singletons()
+        history = History('my_name')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.add_friend_to_db(tox_id)
+        t = time.time()
+        history.save_messages_to_db(tox_id, [(str(i), MESSAGE_OWNER['FRIEND'], t + i, 0) for i in range(10)])
+        fl = io.StringIO()
+        export_history(history, fl, 'jsonl', 'Me', [('Friend', tox_id, [('Unsaved', MESSAGE_OWNER['ME'], t + 10, 0)])],
+                       t + 5)
+        lines = fl.getvalue().splitlines()
+        assert len(lines) == 6
+        assert json.loads(lines[0])['message'] == '5'
+        assert json.loads(lines[-1])['author'] == 'Me'
+        history.delete_friend_from_db(tox_id)
+        history.close()
@@ -0,0 +1,138 @@
+import collections
+import threading
+import numpy as np
+
+
+OUTPUT_RATE = 48000  # all sampling rates supported by toxav are divisors of OUTPUT_RATE
+
+OUTPUT_CHANNELS = 2
+
+JITTER_BUFFER_DELAY = 60  # ms of audio buffered before playing is started
+
+JITTER_BUFFER_MAX_DELAY = 300  # ms, older audio is dropped
+
+
+class JitterBuffer:
+    """
+    Incoming audio of one friend in output format. Playing is started when JITTER_BUFFER_DELAY ms of audio are
+    buffered. If buffer underflows, it is filled again before playing. Thread safe
+    """
+
+    def __init__(self, rate=OUTPUT_RATE):
+        self._lock = threading.Lock()
+        self._chunks = collections.deque()  # arrays of samples with shape (count, channels)
+        self._offset = 0  # count of played samples of first chunk
+        self._size = 0  # count of buffered samples
+        self._delay = rate * JITTER_BUFFER_DELAY // 1000
+        self._max_delay = rate * JITTER_BUFFER_MAX_DELAY // 1000
+        self._playing = False
+        self._dropped = 0
+
+    def put(self, samples):
+        """
+        :param samples: int16 array with shape (count, channels)
+        """
+        with self._lock:
+            self._chunks.append(samples)
+            self._size += len(samples)
+            while self._size > self._max_delay and len(self._chunks) > 1:  # playing is late
+                chunk = self._chunks.popleft()
+                self._size -= len(chunk) - self._offset
+                self._dropped += len(chunk) - self._offset
+                self._offset = 0
+
+    def mix_into(self, out):
+        """
+        Adds buffered samples to out
+        :param out: int32 array with shape (count, channels)
+        """
+        count = len(out)
+        with self._lock:
+            if not self._playing:
+                if self._size < self._delay:
+                    return
+                self._playing = True
+            position = 0
+            while position < count and self._chunks:
+                chunk = self._chunks[0]
+                size = min(count - position, len(chunk) - self._offset)
+                out[position:position + size] += chunk[self._offset:self._offset + size]
+                position += size
+                self._offset += size
+                self._size -= size
+                if self._offset == len(chunk):
+                    self._chunks.popleft()
+                    self._offset = 0
+            if position < count:  # underflow
+                self._playing = False
+
+    def get_dropped(self):
+        return self._dropped
+
+
+class AudioMixer:
+    """
+    Mixes incoming audio of all calls into one stream with OUTPUT_RATE and OUTPUT_CHANNELS
+    """
+
+    def __init__(self):
+        self._buffers = {}  # key - friend number, value - JitterBuffer
+        self._mix = np.zeros((0, OUTPUT_CHANNELS), dtype=np.int32)
+
+    def add_frame(self, friend_number, samples, channels, rate):
+        """
+        Called from toxav thread
+        :param samples: bytes with 16-bit pcm
+        :param channels: count of channels
+        :param rate: sampling rate
+        """
+        samples = np.frombuffer(samples, dtype=np.int16).reshape(-1, channels)
+        samples = self.resample(self.convert_channels(samples), rate)
+        if friend_number not in self._buffers:
+            self._buffers[friend_number] = JitterBuffer()
+        self._buffers[friend_number].put(samples)
+
+    def remove_friend(self, friend_number):
+        if friend_number in self._buffers:
+            del self._buffers[friend_number]
+
+    def clear(self):
+        self._buffers = {}
+
+    def read(self, count):
+        """
+        Called from audio output thread
+        :param count: count of samples per channel
+        :return: bytes with mixed 16-bit pcm
+        """
+        if len(self._mix) != count:
+            self._mix = np.zeros((count, OUTPUT_CHANNELS), dtype=np.int32)
+        else:
+            self._mix.fill(0)
+        for buffer in list(self._buffers.values()):
+            buffer.mix_into(self._mix)
+        return np.clip(self._mix, -32768, 32767).astype(np.int16).tobytes()
+
+    @staticmethod
+    def convert_channels(samples):
+        channels = samples.shape[1]
+        if channels == OUTPUT_CHANNELS:
+            return samples
+        if channels > 1:
+            samples = samples.mean(axis=1, keepdims=True).astype(np.int16)
+        return np.repeat(samples, OUTPUT_CHANNELS, axis=1)
+
+    @staticmethod
+    def resample(samples, rate):
+        """
+        Linear interpolation of every channel
+        """
+        if rate == OUTPUT_RATE:
+            return samples
+        count = len(samples) * OUTPUT_RATE // rate
+        positions = np.arange(count) * (rate / OUTPUT_RATE)
+        indexes = np.arange(len(samples))
+        result = np.empty((count, samples.shape[1]), dtype=np.int16)
+        for channel in range(samples.shape[1]):
+            result[:, channel] = np.interp(positions, indexes, samples[:, channel])
+        return result
@@ -5,6 +5,10 @@ import util
 import pyaudio
 import wave
 import settings
+import threading
+import ctypes
+import cv2
+import numpy as np
 from util import curr_directory
 
 
@@ -132,3 +136,96 @@ class IncomingCallWidget(widgets.CenteredWidget):
 
     def set_pixmap(self, pixmap):
         self.avatar_label.setPixmap(pixmap)
+
+
+class VideoWidget(widgets.CenteredWidget):
+    """
+    Shows incoming video of friend. Toxav thread only copies planes of frame to I420 buffer of widget, frame is
+    converted to RGB in main thread when widget is painted. If frame wasn't shown before next frame came, it's dropped
+    without conversion
+    """
+
+    frame_ready = QtCore.pyqtSignal()
+
+    def __init__(self, name):
+        super(VideoWidget, self).__init__()
+        self.setWindowTitle(name)
+        self.resize(QtCore.QSize(640, 480))
+        self._lock = threading.Lock()
+        self._i420 = None  # latest frame
+        self._next_i420 = None  # buffer for next frame
+        self._frame = None  # rgb frame which is shown
+        self._converted = True  # is latest frame converted to rgb
+        self._update_pending = False
+        self._closed = False
+        self.frame_ready.connect(self.show_frame)
+
+    def set_frame(self, width, height, y, u, v, ystride, ustride, vstride):
+        """
+        Called from toxav thread. Planes are copied to buffers of widget, nothing is allocated if size of frames
+        isn't changed
+        :param y, u, v: pointers to planes of I420 frame
+        :param ystride, ustride, vstride: offsets between rows of planes in bytes, negative if rows go upwards in memory
+        """
+        if self._closed:
+            return
+        width, height = width & ~1, height & ~1
+        buffer = self._next_i420
+        if buffer is None or buffer.shape != (height * 3 // 2, width):
+            buffer = np.empty((height * 3 // 2, width), dtype=np.uint8)
+        planes = buffer.reshape(-1)
+        y_size = width * height
+        uv_size = y_size // 4
+        np.copyto(planes[:y_size].reshape(height, width), self.wrap_plane(y, ystride, height, width))
+        np.copyto(planes[y_size:y_size + uv_size].reshape(height // 2, width // 2),
+                  self.wrap_plane(u, ustride, height // 2, width // 2))
+        np.copyto(planes[y_size + uv_size:].reshape(height // 2, width // 2),
+                  self.wrap_plane(v, vstride, height // 2, width // 2))
+        with self._lock:
+            self._i420, self._next_i420 = buffer, self._i420
+            self._converted = False
+            if self._update_pending:  # widget will show latest frame
+                return
+            self._update_pending = True
+        self.frame_ready.emit()
+
+    @staticmethod
+    def wrap_plane(data, stride, height, width):
+        """
+        :param data: pointer to first row of plane
+        :param stride: offset between rows in bytes
+        :return: array (height, width) which shares memory with plane
+        """
+        start = (height - 1) * -stride if stride < 0 else 0  # offset of first row from lowest address of plane
+        size = (height - 1) * abs(stride) + width
+        memory = (ctypes.c_uint8 * size).from_address(ctypes.cast(data, ctypes.c_void_p).value - start)
+        return np.ndarray((height, width), np.uint8, memory, start, (stride, 1))
+
+    def show_frame(self):
+        if self._closed:  # call was finished or user closed widget
+            return
+        if not self.isVisible():
+            self.show()
+        self.update()
+
+    def closeEvent(self, event):
+        self._closed = True
+        event.accept()
+
+    def paintEvent(self, event):
+        with self._lock:
+            self._update_pending = False
+            if self._i420 is None:
+                return
+            if not self._converted:
+                self._frame = cv2.cvtColor(self._i420, cv2.COLOR_YUV2RGB_I420, self._frame)  # reused if size is same
+                self._converted = True
+        height, width = self._frame.shape[:2]
+        image = QtGui.QImage(self._frame.data, width, height, width * 3, QtGui.QImage.Format_RGB888)
+        size = image.size().scaled(self.size(), QtCore.Qt.KeepAspectRatio)
+        rect = QtCore.QRect(QtCore.QPoint(0, 0), size)
+        rect.moveCenter(self.rect().center())
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtCore.Qt.black)
+        painter.drawImage(rect, image)
+        painter.end()
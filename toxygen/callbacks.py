@@ -6,11 +6,11 @@ from toxcore_enums_and_consts import *
 from toxav_enums import *
 from tox import bin_to_string
 from plugin_support import PluginLoader
+from file_transfers import is_transfer_packet, ToxCalls
+from ctypes import string_at
 import queue
 import threading
 import util
-import cv2
-import numpy as np
 
 # -----------------------------------------------------------------------------------------------------------------
 # Threads
@@ -41,43 +41,91 @@ def invoke_in_main_thread(fn, *args, **kwargs):
     QtCore.QCoreApplication.postEvent(_invoker, InvokeEvent(fn, *args, **kwargs))
 
 
-class FileTransfersThread(threading.Thread):
-
-    def __init__(self):
-        self._queue = queue.Queue()
-        self._timeout = 0.01
-        self._continue = True
-        super().__init__()
-
-    def execute(self, function, *args, **kwargs):
-        self._queue.put((function, args, kwargs))
+class FileTransfersExecutor:
+    """
+    Pool of threads which process chunks of file transfers. All work of one transfer is done by one worker in order.
+    Workers don't call toxcore, their calls are made in tox thread (see ToxCalls). Tox thread never waits for workers:
+    if too many chunks of transfer are queued, transfer is paused until worker processes half of them
+    """
+
+    def __init__(self, workers_count, congestion_handler, max_queued=256):
+        """
+        :param congestion_handler: callable with args (key, congested)
+        :param max_queued: max count of queued tasks of one transfer
+        """
+        self._queues = [queue.Queue() for _ in range(max(workers_count, 1))]
+        self._workers = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self._queues]
+        self._congestion_handler = congestion_handler
+        self._max_queued = max_queued
+        self._queued = {}  # key - key of transfer, value - count of queued tasks
+        self._congested = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def execute(self, key, function, *args, **kwargs):
+        """
+        Add task to queue of worker
+        :param key: (friend number, file number) of transfer. Tasks with same key are executed in order
+        """
+        with self._lock:
+            count = self._queued.get(key, 0) + 1
+            self._queued[key] = count
+            congested = count >= self._max_queued and key not in self._congested
+            if congested:
+                self._congested.add(key)
+        self._queues[hash(key) % len(self._queues)].put((key, function, args, kwargs))
+        if congested:
+            self._congestion_handler(key, True)
 
     def stop(self):
-        self._continue = False
-
-    def run(self):
-        while self._continue:
+        """
+        Finish queued tasks and stop workers
+        """
+        for q in self._queues:
+            q.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self, q):
+        while True:
+            task = q.get()
+            if task is None:
+                break
+            key, function, args, kwargs = task
             try:
-                function, args, kwargs = self._queue.get(timeout=self._timeout)
                 function(*args, **kwargs)
-            except queue.Empty:
-                pass
-            except queue.Full:
-                util.log('Queue is Full in _thread')
             except Exception as ex:
-                util.log('Exception in _thread: ' + str(ex))
+                util.log('Exception in file transfers thread: ' + str(ex))
+            with self._lock:
+                count = self._queued[key] - 1
+                if count:
+                    self._queued[key] = count
+                else:
+                    del self._queued[key]
+                relieved = key in self._congested and count <= self._max_queued // 2
+                if relieved:
+                    self._congested.remove(key)
+            if relieved:
+                self._congestion_handler(key, False)
 
 
-_thread = FileTransfersThread()
+_executor = None
 
 
 def start():
-    _thread.start()
+    global _executor
+    ToxCalls()
+    _executor = FileTransfersExecutor(Settings.get_instance()['file_transfers_workers'],
+                                      lambda key, congested: Profile.get_instance().transfer_congested(*key, congested))
+    _executor.start()
 
 
 def stop():
-    _thread.stop()
-    _thread.join()
+    if _executor is not None:
+        _executor.stop()
 
 # -----------------------------------------------------------------------------------------------------------------
 # Callbacks - current user
@@ -243,15 +291,16 @@ def file_recv_chunk(tox, friend_number, file_number, position, chunk, length, us
     """
     Incoming chunk
     """
-    _thread.execute(Profile.get_instance().incoming_chunk, friend_number, file_number, position,
-                    chunk[:length] if length else None)
+    _executor.execute((friend_number, file_number), Profile.get_instance().incoming_chunk, friend_number,
+                      file_number, position, string_at(chunk, length) if length else None)
 
 
 def file_chunk_request(tox, friend_number, file_number, position, size, user_data):
     """
     Outgoing chunk
     """
-    Profile.get_instance().outgoing_chunk(friend_number, file_number, position, size)
+    _executor.execute((friend_number, file_number), Profile.get_instance().outgoing_chunk, friend_number,
+                      file_number, position, size)
 
 
 def file_recv_control(tox, friend_number, file_number, file_control, user_data):
@@ -274,7 +323,10 @@ def lossless_packet(tox, friend_number, data, length, user_data):
     """
     Incoming lossless packet
     """
-    data = data[:length]
+    data = string_at(data, length)
+    if is_transfer_packet(data):
+        invoke_in_main_thread(Profile.get_instance().incoming_transfer_packet, friend_number, data)
+        return
     plugin = PluginLoader.get_instance()
     invoke_in_main_thread(plugin.callback_lossless, friend_number, data)
 
@@ -311,12 +363,20 @@ def call(toxav, friend_number, audio, video, user_data):
     invoke_in_main_thread(Profile.get_instance().incoming_call, audio, video, friend_number)
 
 
+def bit_rate_status(toxav, friend_number, audio_bit_rate, video_bit_rate, user_data):
+    """
+    Core suggests new bit rates because network is saturated
+    """
+    Profile.get_instance().call.bit_rate_status(friend_number, audio_bit_rate, video_bit_rate)
+
+
 def callback_audio(toxav, friend_number, samples, audio_samples_per_channel, audio_channels_count, rate, user_data):
     """
     New audio chunk
     """
     Profile.get_instance().call.audio_chunk(
-        bytes(samples[:audio_samples_per_channel * 2 * audio_channels_count]),
+        friend_number,
+        string_at(samples, audio_samples_per_channel * 2 * audio_channels_count),
         audio_channels_count,
         rate)
 
@@ -327,52 +387,12 @@ def callback_audio(toxav, friend_number, samples, audio_samples_per_channel, aud
 
 def video_receive_frame(toxav, friend_number, width, height, y, u, v, ystride, ustride, vstride, user_data):
     """
-    Creates yuv frame from y, u, v and shows it using OpenCV
-    For yuv => bgr we need this YUV420 frame:
-
-              width
-    -------------------------
-    |                       |
-    |          Y            |      height
-    |                       |
-    -------------------------
-    |           |           |
-    |  U even   |   U odd   |      height // 4
-    |           |           |
-    -------------------------
-    |           |           |
-    |  V even   |   V odd   |      height // 4
-    |           |           |
-    -------------------------
-
-     width // 2   width // 2
-
-    It can be created from initial y, u, v using slices
+    New video frame. Planes are copied to buffers of widget which shows video of friend
     """
     try:
-        y_size = abs(max(width, abs(ystride)))
-        u_size = abs(max(width // 2, abs(ustride)))
-        v_size = abs(max(width // 2, abs(vstride)))
-
-        y = np.asarray(y[:y_size * height], dtype=np.uint8).reshape(height, y_size)
-        u = np.asarray(u[:u_size * height // 2], dtype=np.uint8).reshape(height // 2, u_size)
-        v = np.asarray(v[:v_size * height // 2], dtype=np.uint8).reshape(height // 2, v_size)
-
-        width -= width % 4
-        height -= height % 4
-
-        frame = np.zeros((int(height * 1.5), width), dtype=np.uint8)
-
-        frame[:height, :] = y[:height, :width]
-        frame[height:height * 5 // 4, :width // 2] = u[:height // 2:2, :width // 2]
-        frame[height:height * 5 // 4, width // 2:] = u[1:height // 2:2, :width // 2]
-
-        frame[height * 5 // 4:, :width // 2] = v[:height // 2:2, :width // 2]
-        frame[height * 5 // 4:, width // 2:] = v[1:height // 2:2, :width // 2]
-
-        frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
-
-        invoke_in_main_thread(cv2.imshow, str(friend_number), frame)
+        widget = Profile.get_instance().get_video_widget(friend_number)
+        if widget is not None:
+            widget.set_frame(width, height, y, u, v, ystride, ustride, vstride)
     except Exception as ex:
         print(ex)
 
@@ -456,6 +476,7 @@ def init_callbacks(tox, window, tray):
     toxav = tox.AV
     toxav.callback_call_state(call_state, 0)
     toxav.callback_call(call, 0)
+    toxav.callback_bit_rate_status(bit_rate_status, 0)
     toxav.callback_audio_receive_frame(callback_audio, 0)
     toxav.callback_video_receive_frame(video_receive_frame, 0)
 
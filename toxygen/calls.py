@@ -4,12 +4,50 @@ import threading
 import settings
 from toxav_enums import *
 import cv2
-import itertools
-import numpy as np
+from ctypes import c_char
 import screen_sharing
+import util
+from audio_mixer import AudioMixer, OUTPUT_RATE, OUTPUT_CHANNELS
 # TODO: play sound until outgoing call will be started or cancelled
 
 
+VIDEO_BIT_RATE = 5000
+
+VIDEO_FPS = 25
+
+STATS_SMOOTHING = 0.1  # weight of last value in smoothed conversion time
+
+ERRORS_LOG_INTERVAL = 10  # sec, repeated errors are logged once per interval
+
+# max height of video frames sent to friend for suggested video bit rate (in Kb/sec), None - size isn't changed
+VIDEO_SIZES = ((2000, None), (1000, 720), (500, 480), (250, 360), (0, 240))
+
+
+class CallStats:
+    """
+    Counters of sent audio and video frames of call
+    """
+
+    def __init__(self):
+        self.video_captured = 0
+        self.video_sent = 0
+        self.video_dropped = 0  # frames which weren't captured in time
+        self.video_errors = 0
+        self.conversion_time = 0.  # smoothed time of conversion of video frame in ms
+        self.audio_sent = 0
+        self.audio_dropped = 0  # stale frames
+        self.audio_errors = 0
+
+    def add_conversion_time(self, value):
+        if self.conversion_time:
+            self.conversion_time += (value - self.conversion_time) * STATS_SMOOTHING
+        else:
+            self.conversion_time = value
+
+    def get(self):
+        return dict(vars(self))
+
+
 class Call:
 
     def __init__(self, out_audio, out_video, in_audio=False, in_video=False):
@@ -18,6 +56,8 @@ class Call:
         self._out_audio = out_audio
         self._out_video = out_video
         self._is_active = False
+        self._video_max_height = None
+        self._stats = CallStats()
 
     def get_is_active(self):
         return self._is_active
@@ -27,6 +67,11 @@ class Call:
 
     is_active = property(get_is_active, set_is_active)
 
+    def get_stats(self):
+        return self._stats
+
+    stats = property(get_stats)
+
     # -----------------------------------------------------------------------------------------------------------------
     # Audio
     # -----------------------------------------------------------------------------------------------------------------
@@ -67,6 +112,14 @@ class Call:
 
     out_video = property(get_out_video, set_out_video)
 
+    def get_video_max_height(self):
+        return self._video_max_height
+
+    def set_video_max_height(self, value):
+        self._video_max_height = value
+
+    video_max_height = property(get_video_max_height, set_video_max_height)
+
 
 class AV:
 
@@ -81,6 +134,7 @@ class AV:
         self._audio_thread = None
         self._audio_running = False
         self._out_stream = None
+        self._mixer = AudioMixer()  # incoming audio of all calls
 
         self._audio_rate = 8000
         self._audio_channels = 1
@@ -94,6 +148,8 @@ class AV:
         self._video_width = 640
         self._video_height = 480
 
+        self._errors = {}  # key - error source, value - list [time of last logging, count of not logged errors]
+
     def stop(self):
         self._running = False
         self.stop_audio_thread()
@@ -102,20 +158,23 @@ class AV:
     def __contains__(self, friend_number):
         return friend_number in self._calls
 
+    def has_active_calls(self):
+        return any(map(lambda c: c.is_active, self._calls.values()))
+
     # -----------------------------------------------------------------------------------------------------------------
     # Calls
     # -----------------------------------------------------------------------------------------------------------------
 
     def __call__(self, friend_number, audio, video):
         """Call friend with specified number"""
-        self._toxav.call(friend_number, 32 if audio else 0, 5000 if video else 0)
+        self._toxav.call(friend_number, 32 if audio else 0, VIDEO_BIT_RATE if video else 0)
         self._calls[friend_number] = Call(audio, video)
         threading.Timer(30.0, lambda: self.finish_not_started_call(friend_number)).start()
 
     def accept_call(self, friend_number, audio_enabled, video_enabled):
         if self._running:
             self._calls[friend_number] = Call(audio_enabled, video_enabled)
-            self._toxav.answer(friend_number, 32 if audio_enabled else 0, 5000 if video_enabled else 0)
+            self._toxav.answer(friend_number, 32 if audio_enabled else 0, VIDEO_BIT_RATE if video_enabled else 0)
             if audio_enabled:
                 self.start_audio_thread()
             if video_enabled:
@@ -126,9 +185,10 @@ class AV:
             self._toxav.call_control(friend_number, TOXAV_CALL_CONTROL['CANCEL'])
         if friend_number in self._calls:
             del self._calls[friend_number]
-        if not len(list(filter(lambda c: c.out_audio, self._calls))):
+        self._mixer.remove_friend(friend_number)
+        if not len(self.get_calls(True)):
             self.stop_audio_thread()
-        if not len(list(filter(lambda c: c.out_video, self._calls))):
+        if not len(self.get_calls(False)):
             self.stop_video_thread()
 
     def finish_not_started_call(self, friend_number):
@@ -156,6 +216,26 @@ class AV:
     def is_video_call(self, number):
         return number in self and self._calls[number].in_video
 
+    def get_stats(self, friend_number):
+        """
+        :return: dict with counters of sent frames of call with friend or None if there is no call
+        """
+        call = self._calls.get(friend_number)
+        return call.stats.get() if call is not None else None
+
+    def bit_rate_status(self, friend_number, audio_bit_rate, video_bit_rate):
+        """
+        Network is saturated. Suggested bit rates are applied, size of video frames sent to friend is reduced
+        if bit rate is too low for it
+        """
+        if friend_number not in self:
+            return
+        self._calls[friend_number].video_max_height = next(h for rate, h in VIDEO_SIZES if video_bit_rate >= rate)
+        try:
+            self._toxav.bit_rate_set(friend_number, audio_bit_rate, video_bit_rate)
+        except Exception as ex:
+            self.log_error('Setting of bit rate failed', ex)
+
     # -----------------------------------------------------------------------------------------------------------------
     # Threads
     # -----------------------------------------------------------------------------------------------------------------
@@ -197,6 +277,7 @@ class AV:
             self._out_stream.stop_stream()
             self._out_stream.close()
             self._out_stream = None
+        self._mixer.clear()
 
     def start_video_thread(self):
         if self._video_thread is not None:
@@ -212,7 +293,7 @@ class AV:
                                                         s.video['width'], s.video['height'])
         else:
             self._video = cv2.VideoCapture(s.video['device'])
-            self._video.set(cv2.CAP_PROP_FPS, 25)
+            self._video.set(cv2.CAP_PROP_FPS, VIDEO_FPS)
             self._video.set(cv2.CAP_PROP_FRAME_WIDTH, self._video_width)
             self._video.set(cv2.CAP_PROP_FRAME_HEIGHT, self._video_height)
 
@@ -232,18 +313,28 @@ class AV:
     # Incoming chunks
     # -----------------------------------------------------------------------------------------------------------------
 
-    def audio_chunk(self, samples, channels_count, rate):
+    def audio_chunk(self, friend_number, samples, channels_count, rate):
         """
-        Incoming chunk
+        Incoming chunk. It's added to jitter buffer of friend, output stream plays mix of all calls and doesn't block
+        toxav thread
         """
-
+        if self._audio is None:
+            return
+        self._mixer.add_frame(friend_number, samples, channels_count, rate)
         if self._out_stream is None:
             self._out_stream = self._audio.open(format=pyaudio.paInt16,
-                                                channels=channels_count,
-                                                rate=rate,
+                                                channels=OUTPUT_CHANNELS,
+                                                rate=OUTPUT_RATE,
                                                 output_device_index=settings.Settings.get_instance().audio['output'],
-                                                output=True)
-        self._out_stream.write(samples)
+                                                output=True,
+                                                frames_per_buffer=OUTPUT_RATE // 50,
+                                                stream_callback=self.play_audio)
+
+    def play_audio(self, in_data, frame_count, time_info, status):
+        """
+        Callback of output stream
+        """
+        return self._mixer.read(frame_count), pyaudio.paContinue
 
     # -----------------------------------------------------------------------------------------------------------------
     # AV sending
@@ -251,54 +342,120 @@ class AV:
 
     def send_audio(self):
         """
-        This method sends audio to friends
+        This method sends audio to friends. Reading from stream blocks until next frame is captured, so frames are
+        sent with rate of input device. If sending is late, stale frames are dropped
         """
 
         while self._audio_running:
             try:
+                stale = self._audio_stream.get_read_available() // self._audio_sample_count - 1
+                if stale > 0:
+                    self._audio_stream.read(stale * self._audio_sample_count)
+                    for call in self.get_calls(True):
+                        call.stats.audio_dropped += stale
                 pcm = self._audio_stream.read(self._audio_sample_count)
                 if pcm:
-                    for friend_num in self._calls:
-                        if self._calls[friend_num].out_audio:
+                    for friend_num, call in list(self._calls.items()):
+                        if call.out_audio:
                             try:
                                 self._toxav.audio_send_frame(friend_num, pcm, self._audio_sample_count,
                                                              self._audio_channels, self._audio_rate)
+                                call.stats.audio_sent += 1
                             except:
-                                pass
-            except:
-                pass
-
-            time.sleep(0.01)
+                                call.stats.audio_errors += 1
+            except Exception as ex:
+                self.log_error('Audio capturing failed', ex)
+                time.sleep(self._audio_duration / 1000)
 
     def send_video(self):
         """
-        This method sends video to friends
+        This method sends video to friends. Frames are captured at VIDEO_FPS rate. If capturing and sending of frame
+        takes more time than frame interval, frames of missed intervals are dropped instead of sending them later
         """
+        interval = 1 / VIDEO_FPS
+        deadline = time.monotonic()
         while self._video_running:
             try:
                 result, frame = self._video.read()
                 if result:
-                    height, width, channels = frame.shape
-                    for friend_num in self._calls:
-                        if self._calls[friend_num].out_video:
-                            try:
-                                y, u, v = self.convert_bgr_to_yuv(frame)
-                                self._toxav.video_send_frame(friend_num, width, height, y, u, v)
-                            except:
-                                pass
+                    self.send_video_frame(frame)
+            except Exception as ex:
+                self.log_error('Video capturing failed', ex)
+
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                dropped = int(-delay / interval)
+                deadline += dropped * interval
+                for call in self.get_calls(False):
+                    call.stats.video_dropped += dropped
+
+    def log_error(self, message, ex):
+        """
+        Log error of audio, video or toxav thread. Same errors are logged at most once per ERRORS_LOG_INTERVAL sec
+        """
+        now = time.monotonic()
+        data = self._errors.setdefault(message, [now - ERRORS_LOG_INTERVAL, 0])
+        if now - data[0] < ERRORS_LOG_INTERVAL:
+            data[1] += 1
+            return
+        skipped = ' ({} similar errors were skipped)'.format(data[1]) if data[1] else ''
+        util.log(message + ': ' + str(ex) + skipped)
+        data[0], data[1] = now, 0
+
+    def get_calls(self, audio):
+        """
+        :return: list of calls with outgoing audio or video
+        """
+        return list(filter(lambda c: c.out_audio if audio else c.out_video, list(self._calls.values())))
+
+    def send_video_frame(self, frame):
+        """
+        Sends captured frame to all friends in video calls. Frame is converted once for every size of video sent to
+        friends, so cost of sending doesn't depend on count of calls
+        :param frame: bgr frame
+        """
+        height, width = frame.shape[:2]
+        planes = {}  # key - (width, height), value - y, u, v planes
+        conversion_time = {}  # key - (width, height), value - time of conversion in ms
+        for friend_num, call in list(self._calls.items()):
+            if not call.out_video:
+                continue
+            call.stats.video_captured += 1
+            size = self.get_video_size(width, height, call.video_max_height)
+            if size not in planes:
+                start = time.perf_counter()
+                scaled = frame if size == (width & ~1, height & ~1) else cv2.resize(frame, size,
+                                                                                    interpolation=cv2.INTER_AREA)
+                planes[size] = self.convert_bgr_to_yuv(scaled)
+                conversion_time[size] = (time.perf_counter() - start) * 1000
+            call.stats.add_conversion_time(conversion_time[size])
+            try:
+                self._toxav.video_send_frame(friend_num, size[0], size[1], *planes[size])
+                call.stats.video_sent += 1
             except:
-                pass
+                call.stats.video_errors += 1
 
-            time.sleep(0.01)
+    @staticmethod
+    def get_video_size(width, height, max_height):
+        """
+        :return: size (width, height) of sent frame with aspect ratio of captured frame
+        """
+        if max_height is not None and max_height < height:
+            width, height = width * max_height // height, max_height
+        return width & ~1, height & ~1
 
-    def convert_bgr_to_yuv(self, frame):
+    @staticmethod
+    def convert_bgr_to_yuv(frame):
         """
         :param frame: input bgr frame
-        :return y, u, v: y, u, v values of frame
+        :return y, u, v: y, u, v planes of frame (ctypes arrays of c_char)
 
         How this function works:
-        OpenCV creates YUV420 frame from BGR
-        This frame has following structure and size:
+        OpenCV creates YUV420 (I420) frame from BGR
+        This frame is contiguous array with following structure and size:
         width, height - dim of input frame
         width, height * 1.5 - dim of output frame
 
@@ -319,21 +476,15 @@ class AV:
 
          width // 2   width // 2
 
-        Y, U, V can be extracted using slices and joined in one list using itertools.chain.from_iterable()
-        Function returns bytes(y), bytes(u), bytes(v), because it is required for ctypes
+        Rows of U and V planes with width // 2 pixels go one after another in memory, so Y, U, V planes are
+        contiguous slices of flat frame. They are passed to toxav as ctypes arrays which share memory with frame,
+        nothing is copied
         """
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
-
-        y = frame[:self._video_height, :]
-        y = list(itertools.chain.from_iterable(y))
-
-        u = np.zeros((self._video_height // 2, self._video_width // 2), dtype=np.int)
-        u[::2, :] = frame[self._video_height:self._video_height * 5 // 4, :self._video_width // 2]
-        u[1::2, :] = frame[self._video_height:self._video_height * 5 // 4, self._video_width // 2:]
-        u = list(itertools.chain.from_iterable(u))
-        v = np.zeros((self._video_height // 2, self._video_width // 2), dtype=np.int)
-        v[::2, :] = frame[self._video_height * 5 // 4:, :self._video_width // 2]
-        v[1::2, :] = frame[self._video_height * 5 // 4:, self._video_width // 2:]
-        v = list(itertools.chain.from_iterable(v))
-
-        return bytes(y), bytes(u), bytes(v)
+        height, width = frame.shape[0] & ~1, frame.shape[1] & ~1  # I420 requires even size
+        frame = cv2.cvtColor(frame[:height, :width], cv2.COLOR_BGR2YUV_I420).reshape(-1)
+        y_size = width * height
+        uv_size = y_size // 4
+        y = (c_char * y_size).from_buffer(frame[:y_size])
+        u = (c_char * uv_size).from_buffer(frame[y_size:y_size + uv_size])
+        v = (c_char * uv_size).from_buffer(frame[y_size + uv_size:])
+        return y, u, v
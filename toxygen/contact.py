@@ -5,6 +5,7 @@ import util
 from messages import *
 import file_transfers as ft
 import re
+import time
 
 
 class Contact(basecontact.BaseContact):
@@ -24,11 +25,12 @@ class Contact(basecontact.BaseContact):
         self._visible = True
         self._alias = False
         self._message_getter = message_getter
-        self._corr = []
+        self._corr = Corr()
         self._unsaved_messages = 0
         self._history_loaded = self._new_actions = False
         self._curr_text = self._search_string = ''
         self._search_index = 0
+        self._last_used = 0  # time when contact was active
 
     def __del__(self):
         self.set_visibility(False)
@@ -44,6 +46,7 @@ class Contact(basecontact.BaseContact):
         """
         :param first_time: friend became active, load first part of messages
         """
+        self._last_used = time.time()
         if (first_time and self._history_loaded) or (not hasattr(self, '_message_getter')):
             return
         if self._message_getter is None:
@@ -53,8 +56,7 @@ class Contact(basecontact.BaseContact):
             data.reverse()
         else:
             return
-        data = list(map(lambda tupl: TextMessage(*tupl), data))
-        self._corr = data + self._corr
+        self._corr.prepend(map(lambda tupl: TextMessage(*tupl), data))
         self._history_loaded = True
 
     def load_all_corr(self):
@@ -66,8 +68,7 @@ class Contact(basecontact.BaseContact):
         data = list(self._message_getter.get_all())
         if data is not None and len(data):
             data.reverse()
-            data = list(map(lambda tupl: TextMessage(*tupl), data))
-            self._corr = data + self._corr
+            self._corr.prepend(map(lambda tupl: TextMessage(*tupl), data))
             self._history_loaded = True
 
     def get_corr_for_saving(self):
@@ -75,11 +76,55 @@ class Contact(basecontact.BaseContact):
         Get data to save in db
         :return: list of unsaved messages or []
         """
-        messages = list(filter(lambda x: x.get_type() <= 1, self._corr))
-        return list(map(lambda x: x.get_data(), messages[-self._unsaved_messages:])) if self._unsaved_messages else []
+        if not self._unsaved_messages:
+            return []
+        return self._corr.get_last_text_messages(self._unsaved_messages)
 
-    def get_corr(self):
-        return self._corr[:]
+    def mark_corr_as_saved(self):
+        """
+        All unsaved messages were passed to history
+        """
+        self._unsaved_messages = 0
+
+    def get_corr(self, start=None, end=None):
+        """
+        :return: list of messages, slice of all messages if start or end is not None
+        """
+        return self._corr[start:end]
+
+    def get_corr_size(self):
+        return len(self._corr)
+
+    def get_last_used(self):
+        return self._last_used
+
+    def unload_old_messages(self, count):
+        """
+        Unload oldest messages which are saved in db (info messages are unloaded too). At least PAGE_SIZE messages
+        are kept. Unloaded messages will be loaded from db on scroll-back
+        :param count: max count of messages to unload
+        :return: count of unloaded messages
+        """
+        if not hasattr(self, '_message_getter') or self._message_getter is None:
+            return 0
+        saved = self._corr.get_text_count() - self._unsaved_messages
+        count = min(count, len(self._corr) - PAGE_SIZE)
+        i = 0
+        while i < count:
+            if self._corr.get_type(i) <= 1:
+                if not saved or self._corr.get_owner(i) == MESSAGE_OWNER['NOT_SENT']:
+                    break
+                saved -= 1
+            elif self._corr.get_type(i) != MESSAGE_TYPE['INFO_MESSAGE']:
+                break
+            i += 1
+        while i and self._corr.get_time(i) == self._corr.get_time(i - 1):  # messages with same time stay together
+            i -= 1
+        if i:
+            self._message_getter.rewind(self._corr.get_time(i - 1))
+            del self._corr[:i]
+            self._search_index = 0
+        return i
 
     def append_message(self, message):
         """
@@ -90,11 +135,7 @@ class Contact(basecontact.BaseContact):
             self._unsaved_messages += 1
 
     def get_last_message_text(self):
-        messages = list(filter(lambda x: x.get_type() <= 1 and x.get_owner() != MESSAGE_OWNER['FRIEND'], self._corr))
-        if messages:
-            return messages[-1].get_data()[0]
-        else:
-            return ''
+        return self._corr.get_last_text(MESSAGE_OWNER['FRIEND'])
 
     # -----------------------------------------------------------------------------------------------------------------
     # Unsent messages
@@ -104,34 +145,32 @@ class Contact(basecontact.BaseContact):
         """
         :return list of unsent messages
         """
-        messages = filter(lambda x: x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr)
-        return list(messages)
+        return list(map(lambda i: self._corr[i], self._corr.get_unsent_indexes()))
 
     def get_unsent_messages_for_saving(self):
         """
         :return list of unsent messages for saving
         """
-        messages = filter(lambda x: x.get_type() <= 1 and x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr)
-        return list(map(lambda x: x.get_data(), messages))
+        indexes = filter(lambda i: self._corr.get_type(i) <= 1, self._corr.get_unsent_indexes())
+        return list(map(lambda i: self._corr[i].get_data(), indexes))
 
     def mark_as_sent(self):
-        try:
-            message = list(filter(lambda x: x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr))[0]
-            message.mark_as_sent()
-        except Exception as ex:
-            util.log('Mark as sent ex: ' + str(ex))
+        if not self._corr.mark_as_sent():
+            util.log('Mark as sent ex: unsent message not found')
 
     # -----------------------------------------------------------------------------------------------------------------
     # Message deletion
     # -----------------------------------------------------------------------------------------------------------------
 
     def delete_message(self, time):
-        elem = list(filter(lambda x: type(x) in (TextMessage, GroupChatMessage) and x.get_data()[2] == time, self._corr))[0]
-        tmp = list(filter(lambda x: x.get_type() <= 1, self._corr))
-        if elem in tmp[-self._unsaved_messages:] and self._unsaved_messages:
-            self._unsaved_messages -= 1
-        self._corr.remove(elem)
-        self._message_getter.delete_one()
+        text_types = (MESSAGE_TYPE['TEXT'], MESSAGE_TYPE['ACTION'], MESSAGE_TYPE['GC_TEXT'], MESSAGE_TYPE['GC_ACTION'])
+        index = next(i for i in range(len(self._corr) - 1, -1, -1)
+                     if self._corr.get_type(i) in text_types and self._corr.get_time(i) == time)
+        if self._corr.get_type(index) <= 1 and self._unsaved_messages:
+            newer = len(list(filter(lambda i: self._corr.get_type(i) <= 1, range(index + 1, len(self._corr)))))
+            if newer < self._unsaved_messages:  # message is not saved
+                self._unsaved_messages -= 1
+        del self._corr[index]
         self._search_index = 0
 
     def delete_old_messages(self):
@@ -144,9 +183,10 @@ class Contact(basecontact.BaseContact):
             return x.get_owner() == MESSAGE_OWNER['NOT_SENT']
 
         old = filter(save_message, self._corr[:-SAVE_MESSAGES])
-        self._corr = list(old) + self._corr[-SAVE_MESSAGES:]
-        text_messages = filter(lambda x: x.get_type() <= 1, self._corr)
-        self._unsaved_messages = min(self._unsaved_messages, len(list(text_messages)))
+        corr = Corr(old)
+        corr.extend(self._corr[-SAVE_MESSAGES:])
+        self._corr = corr
+        self._unsaved_messages = min(self._unsaved_messages, self._corr.get_text_count())
         self._search_index = 0
 
     def clear_corr(self, save_unsent=False):
@@ -158,14 +198,14 @@ class Contact(basecontact.BaseContact):
         self._search_index = 0
         # don't delete data about active file transfer
         if not save_unsent:
-            self._corr = list(filter(lambda x: x.get_type() == 2 and
-                                               x.get_status() in ft.ACTIVE_FILE_TRANSFERS, self._corr))
+            self._corr = self._corr.filter(lambda x: x.get_type() == 2 and
+                                                     x.get_status() in ft.ACTIVE_FILE_TRANSFERS)
             self._unsaved_messages = 0
         else:
-            self._corr = list(filter(lambda x: (x.get_type() == 2 and x.get_status() in ft.ACTIVE_FILE_TRANSFERS)
-                                               or (x.get_type() <= 1 and x.get_owner() == MESSAGE_OWNER['NOT_SENT']),
-                                     self._corr))
-            self._unsaved_messages = len(self.get_unsent_messages())
+            self._corr = self._corr.filter(lambda x: (x.get_type() == 2 and x.get_status() in ft.ACTIVE_FILE_TRANSFERS)
+                                                     or (x.get_type() <= 1 and
+                                                         x.get_owner() == MESSAGE_OWNER['NOT_SENT']))
+            self._unsaved_messages = self._corr.get_unsent_count()
 
     # -----------------------------------------------------------------------------------------------------------------
     # Chat history search
@@ -176,27 +216,34 @@ class Contact(basecontact.BaseContact):
         return self.search_prev()
 
     def search_prev(self):
-        while True:
-            l = len(self._corr)
-            for i in range(self._search_index - 1, -l - 1, -1):
-                if self._corr[i].get_type() > 1:
-                    continue
-                message = self._corr[i].get_data()[0]
-                if re.search(self._search_string, message, re.IGNORECASE) is not None:
-                    self._search_index = i
-                    return i
-            self._search_index = -l
-            self.load_corr(False)
-            if len(self._corr) == l:
-                return None  # not found
+        l = len(self._corr)
+        for i in range(self._search_index - 1, -l - 1, -1):
+            if self._corr.get_type(i) > 1:
+                continue
+            message = self._corr.get_text(i)
+            if re.search(self._search_string, message, re.IGNORECASE) is not None:
+                self._search_index = i
+                return i
+        self._search_index = -l
+        if not hasattr(self, '_message_getter') or self._message_getter is None:
+            return None
+        found = self._message_getter.search(self._search_string)  # search in not loaded messages
+        if found is None:
+            return None  # not found
+        data = list(self._message_getter.get_until(found))
+        data.reverse()
+        self._corr.prepend(map(lambda tupl: TextMessage(*tupl), data))
+        self._history_loaded = True
+        self._search_index = -len(self._corr)
+        return self._search_index
 
     def search_next(self):
         if not self._search_index:
             return None
         for i in range(self._search_index + 1, 0):
-            if self._corr[i].get_type() > 1:
+            if self._corr.get_type(i) > 1:
                 continue
-            message = self._corr[i].get_data()[0]
+            message = self._corr.get_text(i)
             if re.search(self._search_string, message, re.IGNORECASE) is not None:
                 self._search_index = i
                 return i
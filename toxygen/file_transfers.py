@@ -1,9 +1,20 @@
-from toxcore_enums_and_consts import TOX_FILE_KIND, TOX_FILE_CONTROL
+from toxcore_enums_and_consts import TOX_FILE_KIND, TOX_FILE_CONTROL, TOX_FILE_ID_LENGTH, TOX_MAX_CUSTOM_PACKET_SIZE
 from os.path import basename, getsize, exists, dirname
-from os import remove, rename, chdir
+from os import remove, rename, chdir, replace
 from time import time, sleep
+from bisect import bisect_left, bisect_right
+from ctypes import c_char, ArgumentError
+import hashlib
 from tox import Tox
 import settings
+from toxes import ToxES
+import util
+import json
+import mmap
+import os
+import struct
+import threading
+import collections
 from PyQt5 import QtCore
 
 
@@ -27,6 +38,100 @@ SHOW_PROGRESS_BAR = (0, 1, 4)
 
 ALLOWED_FILES = ('toxygen_inline.png', 'utox-inline.png', 'sticker.png')
 
+READ_AHEAD_SIZE = 4 * 1024 * 1024  # size of outgoing file data which is read in background before it's requested
+
+READ_AHEAD_BLOCK = 64 * 1024
+
+READ_BEHIND_BLOCKS = 2  # count of blocks before requested position which are kept for retransmits
+
+HASH_BLOCK_SIZE = 1024 * 1024  # size of block of file which has own hash
+
+HASH_SIZE = 16  # size of hash of block
+
+HASH_ALGORITHM = {
+    'BLAKE2B': 0,
+    'SHA256': 1  # truncated to HASH_SIZE, Python 3.5 has no BLAKE2
+}
+
+BLOCK_HASH_ALGORITHM = HASH_ALGORITHM['BLAKE2B'] if hasattr(hashlib, 'blake2b') else HASH_ALGORITHM['SHA256']
+
+# file transfers packets use format of plugins packets (first byte, short name) with name reserved for toxygen
+TRANSFER_PACKET_PREFIX = bytes([160 + 4]) + b'__ft'
+
+TRANSFER_PACKET_TYPE = {
+    'HASHES': 0,  # file id, hash algorithm, index of first hash, hashes of blocks
+    'REFETCH': 1,  # file id, start and end of range which should be sent again
+    'MANIFEST': 2  # file id, path of file relative to directory which is sent
+}
+
+PACKET_SENDING_ATTEMPTS = 10
+
+CHUNK_SENDING_ATTEMPTS = 1000  # chunk isn't requested by toxcore again, so it's repeated while packet queue is full
+
+MAX_REFETCH_ATTEMPTS = 3  # how many times corrupted part of file is requested again
+
+VERIFICATION_TIMEOUT = 600  # sec, data of finished transfers is removed if friend sent no hashes or requests
+
+THROTTLE_MIN_PAUSE = 0.2  # transfer is paused if it exceeded speed limit by more than THROTTLE_MIN_PAUSE sec
+
+BURST_TIME = 0.5  # token bucket allows bursts of data which can be transferred in BURST_TIME sec with max speed
+
+TRANSFERS_SAVE_INTERVAL = 5  # positions of incoming transfers are saved every TRANSFERS_SAVE_INTERVAL sec
+
+SCHEDULER_RETRY_INTERVAL = 500  # ms, postponed transfers are started again after SCHEDULER_RETRY_INTERVAL
+
+WRITE_BUFFER_SIZE = 1024 * 1024  # incoming contiguous chunks are collected and written to file together
+
+
+class ToxCalls(util.Singleton):
+    """
+    toxcore isn't thread safe. Threads of file transfers don't call it, their calls are queued and made in thread of
+    tox iterate before iteration
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._calls = collections.deque()
+
+    def add(self, function, *args, attempts=1, key=None):
+        """
+        :param function: method of Tox
+        :param attempts: max count of calls if function raises exception or returns False (e.g. packet queue is full).
+        Failed call is repeated on next iteration. Calls with invalid arguments (ArgumentError) aren't repeated
+        :param key: calls with same key (e.g. chunks of one transfer) are made in order. If call fails, next calls with
+        its key wait until it's repeated. If call is dropped, next calls with its key are dropped too
+        """
+        self._calls.append((function, args, attempts, key))
+
+    def run(self):
+        failed, blocked, dropped = [], set(), set()
+        for _ in range(len(self._calls)):
+            call = self._calls.popleft()
+            function, args, attempts, key = call
+            if key is not None and key in dropped:
+                continue
+            if key is not None and key in blocked:
+                failed.append(call)
+                continue
+            try:
+                if function(*args) is not False:
+                    continue
+                error = 'call returned false'
+            except ArgumentError as ex:  # e.g. friend isn't connected or transfer was cancelled
+                attempts, error = 1, str(ex)
+            except Exception as ex:
+                error = str(ex)
+            if attempts > 1:
+                failed.append((function, args, attempts - 1, key))
+                blocked.add(key)
+            else:
+                dropped.add(key)
+                util.log('Call of toxcore from file transfers thread failed: ' + error)
+        self._calls.extendleft(reversed(failed))  # failed calls are made before calls which were added later
+
+    def clear(self):
+        self._calls.clear()
+
 
 def is_inline(file_name):
     return file_name in ALLOWED_FILES or file_name.startswith('qTox_Screenshot_') or file_name.startswith('qTox_Image_')
@@ -46,6 +151,9 @@ class FileTransfer(QtCore.QObject):
     """
     Superclass for file transfers
     """
+    PROGRESS_INTERVAL = 0.5  # min time in sec between progress signals
+    PROGRESS_DELTA = 0.001  # min change of progress between progress signals
+    SPEED_SMOOTHING = 0.3  # weight of last measured speed in smoothed speed
 
     def __init__(self, path, tox, friend_number, size, file_number=None):
         QtCore.QObject.__init__(self)
@@ -60,22 +168,52 @@ class FileTransfer(QtCore.QObject):
         self._state_changed = StateSignal()
         self._finished = TransferFinishedSignal()
         self._file_id = None
+        self._signalled_state = None  # state, progress, done and time of last emitted signal
+        self._signalled_progress = 0
+        self._signalled_done = 0
+        self._signal_time = 0
+        self._speed = None  # smoothed speed in bytes per sec
+        self._shaper = None
+        self._throttled = False  # transfer is paused because it exceeded speed limit
+        self._congested = False  # transfer is paused because worker thread can't process its chunks fast enough
+        self._hold_lock = threading.Lock()
 
     def set_tox(self, tox):
         self._tox = tox
 
     def set_state_changed_handler(self, handler):
         self._state_changed.signal.connect(handler)
+        self._signalled_state = None  # new handler gets current state on next signal
 
     def set_transfer_finished_handler(self, handler):
         self._finished.signal.connect(handler)
 
     def signal(self):
+        """
+        Emits state, progress and estimated time. Progress is emitted not more often than every PROGRESS_INTERVAL sec
+        and only if it changed by PROGRESS_DELTA. State changes and end of transfer are always emitted
+        """
         percentage = self._done / self._size if self._size else 0
-        if self._creation_time is None or not percentage:
-            t = -1
+        now = time()
+        state_changed = self.state != self._signalled_state
+        if not state_changed and percentage < 1:
+            if now - self._signal_time < self.PROGRESS_INTERVAL or \
+                    percentage - self._signalled_progress < self.PROGRESS_DELTA:
+                return
+        if not state_changed and now > self._signal_time:
+            speed = (self._done - self._signalled_done) / (now - self._signal_time)
+            if self._speed is None:
+                self._speed = speed
+            else:
+                self._speed = self.SPEED_SMOOTHING * speed + (1 - self.SPEED_SMOOTHING) * self._speed
+        if percentage >= 1:
+            t = 0
+        elif self._speed and percentage:
+            t = (self._size - self._done) / self._speed
         else:
-            t = ((time() - self._creation_time) / percentage) * (1 - percentage)
+            t = -1
+        self._signalled_state, self._signalled_progress = self.state, percentage
+        self._signalled_done, self._signal_time = self._done, now
         self._state_changed.signal.emit(self.state, percentage, int(t))
 
     def finished(self):
@@ -93,16 +231,19 @@ class FileTransfer(QtCore.QObject):
     def get_path(self):
         return self._path
 
+    def get_size(self):
+        return int(self._size)
+
     def cancel(self):
         self.send_control(TOX_FILE_CONTROL['CANCEL'])
         if hasattr(self, '_file'):
-            self._file.close()
+            self.close_file()
         self.signal()
 
     def cancelled(self):
         if hasattr(self, '_file'):
             sleep(0.1)
-            self._file.close()
+            self.close_file()
         self.state = TOX_FILE_TRANSFER_STATE['CANCELLED']
         self.signal()
 
@@ -121,17 +262,390 @@ class FileTransfer(QtCore.QObject):
     def get_file_id(self):
         return self._tox.file_get_file_id(self._friend_number, self._file_number)
 
+    def close_file(self):
+        self._file.close()
+
+    def set_shaper(self, shaper):
+        """
+        :param shaper: BandwidthShaper which limits speed of transfer
+        """
+        self._shaper = shaper
+
+    def throttle(self, size, incoming):
+        """
+        Transfer is paused for some time if it exceeds speed limits
+        :param size: size of transferred data
+        :param incoming: is transfer incoming
+        """
+        if self._shaper is None:
+            return
+        delay = self._shaper.consume(self._friend_number, incoming, size)
+        if delay > THROTTLE_MIN_PAUSE and not self._throttled:
+            self._hold(throttled=True)
+            timer = threading.Timer(delay, self._hold, kwargs={'throttled': False})
+            timer.daemon = True
+            timer.start()
+
+    def set_congested(self, value):
+        """
+        Transfer is paused while too many of its chunks wait in queue of worker thread
+        """
+        self._hold(congested=value)
+
+    def _hold(self, throttled=None, congested=None):
+        """
+        Pause transfer if it's throttled or congested, resume it when both reasons are gone
+        """
+        with self._hold_lock:
+            was_held = self._throttled or self._congested
+            if throttled is not None:
+                self._throttled = throttled
+            if congested is not None:
+                self._congested = congested
+            held = self._throttled or self._congested
+        if held and not was_held:
+            self.call_tox(self._tox.file_control, self._friend_number, self._file_number, TOX_FILE_CONTROL['PAUSE'])
+        elif was_held and not held and self.state == TOX_FILE_TRANSFER_STATE['RUNNING']:
+            self.call_tox(self._tox.file_control, self._friend_number, self._file_number, TOX_FILE_CONTROL['RESUME'])
+
+    @staticmethod
+    def call_tox(function, *args, attempts=1, key=None):
+        """
+        Call of toxcore from worker thread. It's made in tox thread
+        """
+        ToxCalls.get_instance().add(function, *args, attempts=attempts, key=key)
+
+# -----------------------------------------------------------------------------------------------------------------
+# Verification
+# -----------------------------------------------------------------------------------------------------------------
+
+
+class TruncatedHash:
+    """
+    Hash object with digest of HASH_SIZE bytes
+    """
+
+    def __init__(self, hasher):
+        self._hasher = hasher
+
+    def update(self, data):
+        self._hasher.update(data)
+
+    def digest(self):
+        return self._hasher.digest()[:HASH_SIZE]
+
+
+def block_hash(data=b''):
+    """
+    :return: hash object of block of file for BLOCK_HASH_ALGORITHM
+    """
+    if BLOCK_HASH_ALGORITHM == HASH_ALGORITHM['BLAKE2B']:
+        return hashlib.blake2b(data, digest_size=HASH_SIZE)
+    return TruncatedHash(hashlib.sha256(data))
+
+
+class BlockHashes:
+    """
+    Hashes of blocks of file (see block_hash()). Hashes are computed from data which is passed in order while file is
+    transferred. Blocks which were not hashed this way are read from file by finish()
+    """
+
+    def __init__(self, size, position=0, start=0, end=None):
+        """
+        :param size: size of file
+        :param position: position of first data which will be passed to update()
+        :param start: start of range of file which should be hashed
+        :param end: end of range of file which should be hashed or None (end of file)
+        """
+        self._size = int(size)
+        self._hashes = [None] * BlockHashes.blocks_count(size)
+        self._position = position
+        self._valid = not position % HASH_BLOCK_SIZE  # current block is hashed from its start
+        self._hasher = block_hash()
+        self._start = start
+        self._end = self._size if end is None else end
+
+    @staticmethod
+    def blocks_count(size):
+        return (int(size) + HASH_BLOCK_SIZE - 1) // HASH_BLOCK_SIZE
+
+    def update(self, position, data):
+        """
+        New data of file. Data after gap is ignored and hashed later from file
+        """
+        if position > self._position or position + len(data) <= self._position:
+            return
+        data = memoryview(data)[self._position - position:]
+        while len(data):
+            l = min(len(data), HASH_BLOCK_SIZE - self._position % HASH_BLOCK_SIZE)
+            self._hasher.update(data[:l])
+            data = data[l:]
+            self._position += l
+            if not self._position % HASH_BLOCK_SIZE or self._position >= self._size:
+                index = (self._position - 1) // HASH_BLOCK_SIZE
+                if self._valid and index < len(self._hashes):
+                    self._hashes[index] = self._hasher.digest()
+                self._hasher = block_hash()
+                self._valid = True
+
+    def finish(self, path):
+        """
+        Read from file and hash blocks of range which were not hashed
+        """
+        with open(path, 'rb') as fl:
+            for i in range(self._start // HASH_BLOCK_SIZE, BlockHashes.blocks_count(self._end)):
+                if self._hashes[i] is None:
+                    fl.seek(i * HASH_BLOCK_SIZE)
+                    self._hashes[i] = block_hash(fl.read(HASH_BLOCK_SIZE)).digest()
+
+    def set_hashes(self, hashes):
+        """
+        :param hashes: dict index of block -> hash of block which was computed before (e.g. before transfer was paused)
+        """
+        for i, h in hashes.items():
+            if i < len(self._hashes):
+                self._hashes[i] = h
+
+    def merge(self, other):
+        """
+        Replace hashes with hashes of blocks which were transferred again
+        """
+        for i, h in enumerate(other.get_hashes()):
+            if h is not None:
+                self._hashes[i] = h
+
+    def get_hashes(self):
+        return self._hashes
+
+    def mismatched_range(self, hashes):
+        """
+        :param hashes: hashes of blocks computed by friend
+        :return: tuple (start, end) - range of file which contains all blocks with other hashes or None
+        """
+        mismatched = [i for i, h in enumerate(self._hashes) if h != hashes[i]]
+        if not mismatched:
+            return None
+        return mismatched[0] * HASH_BLOCK_SIZE, min((mismatched[-1] + 1) * HASH_BLOCK_SIZE, self._size)
+
+
+def hashes_packets(file_id, hashes):
+    """
+    Lossless packets with hashes of blocks of file
+    """
+    header = TRANSFER_PACKET_PREFIX + bytes([TRANSFER_PACKET_TYPE['HASHES']]) + bytes.fromhex(file_id) + \
+        bytes([BLOCK_HASH_ALGORITHM])
+    count = (TOX_MAX_CUSTOM_PACKET_SIZE - len(header) - 4) // HASH_SIZE
+    for i in range(0, len(hashes), count):
+        yield header + struct.pack('>I', i) + b''.join(hashes[i:i + count])
+
+
+def refetch_packet(file_id, start, end):
+    """
+    Lossless packet with request to send range of file again
+    """
+    return TRANSFER_PACKET_PREFIX + bytes([TRANSFER_PACKET_TYPE['REFETCH']]) + bytes.fromhex(file_id) + \
+        struct.pack('>QQ', start, end)
+
+
+def manifest_packet(file_id, relative_path):
+    """
+    Lossless packet with path of file which will be sent as part of directory
+    """
+    return TRANSFER_PACKET_PREFIX + bytes([TRANSFER_PACKET_TYPE['MANIFEST']]) + bytes.fromhex(file_id) + \
+        bytes(relative_path, 'utf-8')
+
+
+def is_transfer_packet(data):
+    return data.startswith(TRANSFER_PACKET_PREFIX)
+
+
+def parse_transfer_packet(data):
+    """
+    :return: tuple (packet type, file id, data). Data is dict index -> hash for hashes packet (None if friend uses
+    other hash algorithm), tuple (start, end) for refetch packet and relative path for manifest packet
+    """
+    l = len(TRANSFER_PACKET_PREFIX)
+    packet_type = data[l]
+    file_id = data[l + 1:l + 1 + TOX_FILE_ID_LENGTH].hex().upper()
+    data = data[l + 1 + TOX_FILE_ID_LENGTH:]
+    if packet_type == TRANSFER_PACKET_TYPE['HASHES']:
+        if data[0] != BLOCK_HASH_ALGORITHM:
+            return packet_type, file_id, None
+        first, data = struct.unpack('>I', data[1:5])[0], data[5:]
+        hashes = {first + i // HASH_SIZE: data[i:i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE)}
+        return packet_type, file_id, hashes
+    elif packet_type == TRANSFER_PACKET_TYPE['MANIFEST']:
+        return packet_type, file_id, safe_relative_path(str(data, 'utf-8'))
+    return packet_type, file_id, struct.unpack('>QQ', data[:16])
+
+
+def safe_relative_path(path):
+    """
+    :return: path without parts which can point outside of directory
+    """
+    parts = filter(lambda p: p not in ('', '.', '..'), path.replace('\\', '/').split('/'))
+    return '/'.join(map(lambda p: p.replace(':', '_'), parts))  # drive letters on Windows
+
 # -----------------------------------------------------------------------------------------------------------------
 # Send file
 # -----------------------------------------------------------------------------------------------------------------
 
 
+class FileChunkSource:
+    """
+    Reads chunks of file without creating bytes objects. File is memory-mapped if possible and chunks are ctypes
+    arrays pointing into the mapping. Otherwise chunks are read into new buffers. Returned chunks are never changed,
+    so they can be sent later without copying
+    """
+
+    def __init__(self, fl, size):
+        """
+        :param fl: file opened in binary mode
+        :param size: size of file
+        """
+        self._file = fl
+        try:
+            # copy-on-write mapping is writable for ctypes but file is never changed
+            self._mmap = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_COPY) if size else None
+        except (OSError, ValueError):  # special files, some file systems, etc.
+            self._mmap = None
+
+    def get_chunk(self, position, size):
+        """
+        :param position: start position in file
+        :param size: chunk max size
+        :return: ctypes array with data
+        """
+        if self._mmap is not None:
+            size = max(min(size, len(self._mmap) - position), 0)
+            return (c_char * size).from_buffer(self._mmap, position)
+        buffer = bytearray(size)
+        self._file.seek(position)
+        size = self._file.readinto(buffer)
+        return (c_char * size).from_buffer(buffer)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:  # chunk is being sent in other thread, mapping will be closed by gc
+                pass
+
+
+class ReadAheadSource:
+    """
+    Reads next READ_AHEAD_SIZE bytes of file in background thread, so chunks requested by toxcore are usually taken
+    from memory. Other chunks are read from file directly. File is not memory-mapped. Returned chunks are never
+    changed: blocks aren't reused, chunks from two blocks or from file are copied to new buffers
+    """
+
+    def __init__(self, fl, size, read_ahead=READ_AHEAD_SIZE):
+        """
+        :param fl: file opened in binary mode
+        :param size: size of file
+        :param read_ahead: count of bytes after requested position which are read in background
+        """
+        self._file = fl
+        self._size = size
+        self._blocks = {}  # block index -> bytearray
+        self._count = max(read_ahead // READ_AHEAD_BLOCK, 1)
+        self._current = 0  # index of block of last requested chunk
+        self._next = 0  # index of next block which will be read
+        self._condition = threading.Condition()
+        self._closed = False
+        self._hits = self._misses = 0
+        self._thread = None
+        if size:
+            self._thread = threading.Thread(target=self._run, args=(fl.name,), daemon=True)
+            self._thread.start()
+
+    def get_chunk(self, position, size):
+        """
+        :param position: start position in file
+        :param size: chunk max size
+        :return: ctypes array with data
+        """
+        size = max(min(size, self._size - position), 0)
+        index, offset = divmod(position, READ_AHEAD_BLOCK)
+        with self._condition:
+            if index != self._current:
+                self._move(index)
+            first = self._blocks.get(index)
+            second = self._blocks.get(index + 1) if offset + size > READ_AHEAD_BLOCK else first
+        if first is None or second is None:
+            self._misses += 1
+            buffer = bytearray(size)
+            self._file.seek(position)
+            size = self._file.readinto(buffer)
+            return (c_char * size).from_buffer(buffer)
+        self._hits += 1
+        if offset + size <= len(first):
+            return (c_char * size).from_buffer(first, offset)
+        l = len(first) - offset
+        buffer = bytearray(size)
+        buffer[:l] = memoryview(first)[offset:]
+        buffer[l:] = memoryview(second)[:size - l]
+        return (c_char * size).from_buffer(buffer)
+
+    def get_stats(self):
+        """
+        :return: dict with count of chunks which were taken from memory (hits) and read from file (misses)
+        """
+        return {'hits': self._hits, 'misses': self._misses}
+
+    def close(self):
+        """
+        Stop reading thread. File opened by it is closed when this method returns
+        """
+        with self._condition:
+            self._closed = True
+            self._blocks.clear()
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _move(self, index):
+        """
+        Requested position was changed. Old blocks are removed, reading continues from new position
+        """
+        self._current = index
+        for i in list(self._blocks.keys()):
+            if i < index - READ_BEHIND_BLOCKS or i >= index + self._count:
+                del self._blocks[i]
+        if not index - READ_BEHIND_BLOCKS <= self._next <= index + self._count:
+            self._next = index  # seek
+        self._condition.notify()
+
+    def _run(self, path):
+        with open(path, 'rb', buffering=0) as fl:
+            while True:
+                with self._condition:
+                    while not self._closed and (self._next >= self._current + self._count or
+                                                self._next * READ_AHEAD_BLOCK >= self._size):
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                    index = self._next
+                    self._next += 1
+                    if index in self._blocks:
+                        continue
+                block = bytearray(READ_AHEAD_BLOCK)
+                fl.seek(index * READ_AHEAD_BLOCK)
+                del block[fl.readinto(block):]
+                with self._condition:
+                    if self._current - READ_BEHIND_BLOCKS <= index < self._current + self._count:
+                        self._blocks[index] = block
+
+
 class SendTransfer(FileTransfer):
 
     def __init__(self, path, tox, friend_number, kind=TOX_FILE_KIND['DATA'], file_id=None):
         if path is not None:
             self._file = open(path, 'rb')
             size = getsize(path)
+            # small files are memory-mapped, big files are read in background
+            source = ReadAheadSource if size > READ_AHEAD_SIZE else FileChunkSource
+            self._source = source(self._file, size)
         else:
             size = 0
         super(SendTransfer, self).__init__(path, tox, friend_number, size)
@@ -139,6 +653,14 @@ class SendTransfer(FileTransfer):
         self._file_number = tox.file_send(friend_number, kind, size, file_id,
                                           bytes(basename(path), 'utf-8') if path else b'')
         self._file_id = self.get_file_id()
+        self._hashes = None
+        self._verification = False
+
+    def enable_verification(self):
+        """
+        Hashes of file will be sent to friend after transfer is finished
+        """
+        self._verification = True
 
     def send_chunk(self, position, size):
         """
@@ -149,17 +671,43 @@ class SendTransfer(FileTransfer):
         if self._creation_time is None:
             self._creation_time = time()
         if size:
-            self._file.seek(position)
-            data = self._file.read(size)
-            self._tox.file_send_chunk(self._friend_number, self._file_number, position, data)
+            data = self._source.get_chunk(position, size)  # chunks aren't changed by source, so they aren't copied
+            self.call_tox(self._tox.file_send_chunk, self._friend_number, self._file_number, position, data,
+                          attempts=CHUNK_SENDING_ATTEMPTS, key=(self._friend_number, self._file_number))
+            if self._verification:
+                if self._hashes is None:  # resumed transfer starts from position requested by friend
+                    self._hashes = BlockHashes(self._size, position)
+                self._hashes.update(position, data)
+            del data
             self._done += size
+            self.throttle(size, False)
         else:
             if hasattr(self, '_file'):
-                self._file.close()
+                self.close_file()
+            if self._verification:
+                self.send_hashes()
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
             self.finished()
         self.signal()
 
+    def send_hashes(self):
+        if self._hashes is None:
+            self._hashes = BlockHashes(self._size)
+        self._hashes.finish(self._path)
+        for packet in hashes_packets(self._file_id, self._hashes.get_hashes()):
+            self.call_tox(self._tox.friend_send_lossless_packet, self._friend_number, packet,
+                          attempts=PACKET_SENDING_ATTEMPTS)
+
+    def close_file(self):
+        self._source.close()
+        super(SendTransfer, self).close_file()
+
+    def get_read_ahead_stats(self):
+        """
+        :return: dict with count of chunks taken from memory (hits) and read from file (misses) or None
+        """
+        return self._source.get_stats() if type(self._source) is ReadAheadSource else None
+
 
 class SendAvatar(SendTransfer):
     """
@@ -195,7 +743,8 @@ class SendFromBuffer(FileTransfer):
             self._creation_time = time()
         if size:
             data = self._data[position:position + size]
-            self._tox.file_send_chunk(self._friend_number, self._file_number, position, data)
+            self.call_tox(self._tox.file_send_chunk, self._friend_number, self._file_number, position, data,
+                          attempts=CHUNK_SENDING_ATTEMPTS, key=(self._friend_number, self._file_number))
             self._done += size
         else:
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
@@ -210,7 +759,7 @@ class SendFromFileBuffer(SendTransfer):
 
     def send_chunk(self, position, size):
         super(SendFromFileBuffer, self).send_chunk(position, size)
-        if not size:
+        if not size:  # file and its source are closed, so file can be removed on Windows too
             chdir(dirname(self._path))
             remove(self._path)
 
@@ -219,14 +768,73 @@ class SendFromFileBuffer(SendTransfer):
 # -----------------------------------------------------------------------------------------------------------------
 
 
+class Holes:
+    """
+    Sorted not intersecting ranges [start, end) of file which were not received yet
+    """
+
+    def __init__(self):
+        self._starts, self._ends = [], []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def first(self):
+        """
+        :return: start of first hole or None
+        """
+        return self._starts[0] if self._starts else None
+
+    def add(self, start, end):
+        """
+        Add new hole. It must be after all existing holes
+        """
+        self._starts.append(start)
+        self._ends.append(end)
+
+    def remove(self, start, end):
+        """
+        Range [start, end) was received
+        """
+        i = max(bisect_right(self._starts, start) - 1, 0)
+        j = bisect_left(self._starts, end)
+        starts, ends = [], []
+        for k in range(i, j):
+            s, e = self._starts[k], self._ends[k]
+            if e <= start:
+                starts.append(s)
+                ends.append(e)
+                continue
+            if s < start:
+                starts.append(s)
+                ends.append(start)
+            if e > end:
+                starts.append(end)
+                ends.append(e)
+        self._starts[i:j] = starts
+        self._ends[i:j] = ends
+
+
 class ReceiveTransfer(FileTransfer):
 
-    def __init__(self, path, tox, friend_number, size, file_number, position=0):
+    def __init__(self, path, tox, friend_number, size, file_number, position=0, end=None):
+        """
+        :param position: position from which transfer is continued
+        :param end: transfer is finished when this position is reached (re-fetch of corrupted part of file) or None
+        """
         super(ReceiveTransfer, self).__init__(path, tox, friend_number, size, file_number)
-        self._file = open(self._path, 'wb')
+        self._file = open(self._path, 'r+b' if (position or end) and exists(self._path) else 'wb', buffering=0)
         self._file_size = position
-        self._file.truncate(position)
-        self._missed = set()
+        if end is None:
+            self._file.truncate(position)
+        self._end = end
+        self._position = position
+        self._hashes = None  # created if verification is enabled
+        self._holes = Holes()
+        self._buffer = bytearray(min(int(size), WRITE_BUFFER_SIZE) if size else WRITE_BUFFER_SIZE)
+        self._buffer_view = memoryview(self._buffer)
+        self._buffer_position = position  # position in file of first byte of buffer
+        self._buffer_size = 0
         self._file_id = self.get_file_id()
         self._done = position
 
@@ -235,37 +843,127 @@ class ReceiveTransfer(FileTransfer):
         remove(self._path)
 
     def total_size(self):
-        self._missed.add(self._file_size)
-        return min(self._missed)
+        """
+        :return: size of received part of file without holes
+        """
+        hole = self._holes.first()
+        return self._file_size if hole is None else hole
+
+    def enable_verification(self):
+        """
+        Received blocks are hashed, hashes of not hashed blocks will be computed after transfer is finished
+        """
+        if self._hashes is None:
+            self._hashes = BlockHashes(self._size, self._position, 0 if self._end is None else self._position,
+                                       self._end)
+
+    def get_hashes(self):
+        """
+        :return: BlockHashes of received part of file or None if verification is disabled
+        """
+        return self._hashes
+
+    def get_saved_size(self):
+        """
+        :return: size of received part of file which was written to disk
+        """
+        size = self.total_size()
+        return min(size, self._buffer_position) if self._buffer_size else size
+
+    def get_saved_hashes(self):
+        """
+        :return: dict index of block -> hex of hash for blocks which were hashed and written to disk
+        """
+        if self._hashes is None:
+            return {}
+        saved = self.get_saved_size() // HASH_BLOCK_SIZE
+        return {i: h.hex() for i, h in enumerate(self._hashes.get_hashes()[:saved]) if h is not None}
+
+    def set_saved_hashes(self, hashes):
+        """
+        Hashes of blocks which were received before transfer was paused, they aren't computed again
+        :param hashes: dict index of block -> hex of hash
+        """
+        if self._hashes is not None:
+            self._hashes.set_hashes({int(i): bytes.fromhex(h) for i, h in hashes.items()})
 
     def write_chunk(self, position, data):
         """
         Incoming chunk
         :param position: position in file to save data
-        :param data: raw data (string)
+        :param data: raw data (bytes)
         """
         if self._creation_time is None:
             self._creation_time = time()
+        if self.state == TOX_FILE_TRANSFER_STATE['FINISHED']:  # chunks after end of re-fetched range
+            return
         if data is None:
-            self._file.close()
-            self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
-            self.finished()
+            self.finish()
         else:
-            data = bytearray(data)
-            if self._file_size < position:
-                self._file.seek(0, 2)
-                self._file.write(b'\0' * (position - self._file_size))
-                self._missed.add(self._file_size)
-            else:
-                self._missed.discard(position)
-            self._file.seek(position)
-            self._file.write(data)
             l = len(data)
+            if self._file_size < position:
+                self._holes.add(self._file_size, position)
+            elif len(self._holes) and position < self._file_size:
+                self._holes.remove(position, position + l)
             if position + l > self._file_size:
                 self._file_size = position + l
             self._done += l
+            self._buffer_chunk(position, data)
+            if self._hashes is not None:
+                self._hashes.update(position, data)
+            self.throttle(l, True)
+            if self._end is not None and self.total_size() >= self._end:
+                self.call_tox(self._tox.file_control, self._friend_number, self._file_number,
+                              TOX_FILE_CONTROL['CANCEL'])
+                self.finish()
         self.signal()
 
+    def finish(self):
+        self.close_file()
+        if self._hashes is not None:
+            self._hashes.finish(self._path)
+        self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
+        self.finished()
+
+    def close_file(self):
+        self.flush()
+        super(ReceiveTransfer, self).close_file()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Write buffer
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _buffer_chunk(self, position, data):
+        l = len(data)
+        if position != self._buffer_position + self._buffer_size or self._buffer_size + l > len(self._buffer):
+            self.flush()
+            self._buffer_position = position
+        if l > len(self._buffer):
+            self._write(position, data)
+        else:
+            self._buffer_view[self._buffer_size:self._buffer_size + l] = data
+            self._buffer_size += l
+
+    def flush(self):
+        """
+        Write buffered data to file
+        """
+        if self._buffer_size:
+            self._write(self._buffer_position, self._buffer_view[:self._buffer_size])
+            self._buffer_size = 0
+
+    def _write(self, position, data):
+        data = memoryview(data)
+        if not hasattr(os, 'pwrite'):
+            self._file.seek(position)
+        while len(data):
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self._file.fileno(), data, position)
+            else:
+                written = self._file.write(data)
+            data = data[written:]
+            position += written
+
 
 class ReceiveToBuffer(FileTransfer):
     """
@@ -274,11 +972,11 @@ class ReceiveToBuffer(FileTransfer):
 
     def __init__(self, tox, friend_number, size, file_number):
         super(ReceiveToBuffer, self).__init__(None, tox, friend_number, size, file_number)
-        self._data = bytes()
+        self._data = bytearray(int(size))  # grows if friend sends more data than announced
         self._data_size = 0
 
     def get_data(self):
-        return self._data
+        return bytes(memoryview(self._data)[:self._data_size])
 
     def write_chunk(self, position, data):
         if self._creation_time is None:
@@ -287,11 +985,10 @@ class ReceiveToBuffer(FileTransfer):
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
             self.finished()
         else:
-            data = bytes(data)
             l = len(data)
-            if self._data_size < position:
-                self._data += (b'\0' * (position - self._data_size))
-            self._data = self._data[:position] + data + self._data[position + l:]
+            if position + l > len(self._data):
+                self._data.extend(bytes(max(position + l, 2 * len(self._data)) - len(self._data)))
+            memoryview(self._data)[position:position + l] = data
             if position + l > self._data_size:
                 self._data_size = position + l
             self._done += l
@@ -345,3 +1042,207 @@ class ReceiveAvatar(ReceiveTransfer):
     def finished(self, emit=False):
         if emit:
             super().finished()
+
+# -----------------------------------------------------------------------------------------------------------------
+# Bandwidth shaping
+# -----------------------------------------------------------------------------------------------------------------
+
+
+class TokenBucket:
+    """
+    Limits speed of data transfer. Thread safe
+    """
+
+    def __init__(self, rate=0):
+        """
+        :param rate: max speed in bytes per sec, 0 - unlimited
+        """
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = rate * BURST_TIME
+        self._time = time()
+
+    def set_rate(self, rate):
+        with self._lock:
+            if not self._rate:  # bucket was unlimited
+                self._tokens, self._time = rate * BURST_TIME, time()
+            self._rate = rate
+            self._tokens = min(self._tokens, rate * BURST_TIME)
+
+    def consume(self, size):
+        """
+        :param size: size of transferred data
+        :return: time in sec which should pass before next data is transferred
+        """
+        with self._lock:
+            if not self._rate:
+                return 0
+            now = time()
+            self._tokens = min(self._tokens + (now - self._time) * self._rate, self._rate * BURST_TIME) - size
+            self._time = now
+            return max(-self._tokens / self._rate, 0)
+
+
+class BandwidthShaper:
+    """
+    Limits speed of file transfers globally and for every friend. Limits can be lower while audio/video call is active
+    """
+
+    def __init__(self, is_call_active):
+        """
+        :param is_call_active: callable which returns True if there is active call
+        """
+        self._is_call_active = is_call_active
+        self._global = {True: TokenBucket(), False: TokenBucket()}  # key - is incoming
+        self._friends = {}  # key - (friend number, is incoming)
+        self._limits = {True: 0, False: 0}
+        self._call_limit = 0
+        self._throttled = False  # are limits for call applied
+
+    def set_limits(self, upload, download, friends_limits, call_limit):
+        """
+        All speeds are in bytes per sec, 0 - unlimited
+        :param upload: max speed of all outgoing transfers
+        :param download: max speed of all incoming transfers
+        :param friends_limits: dict friend number -> max speed of outgoing and of incoming transfers of friend
+        :param call_limit: max speed of outgoing and of incoming transfers during call
+        """
+        self._limits = {True: download, False: upload}
+        self._call_limit = call_limit
+        self._friends = {}
+        for friend_number, limit in friends_limits.items():
+            self._friends[(friend_number, True)] = TokenBucket(limit)
+            self._friends[(friend_number, False)] = TokenBucket(limit)
+        self._update_global_limits()
+
+    def consume(self, friend_number, incoming, size):
+        """
+        :return: time in sec which should pass before next data of this friend is transferred
+        """
+        if self._throttled != bool(self._call_limit and self._is_call_active()):
+            self._update_global_limits()
+        delay = self._global[incoming].consume(size)
+        bucket = self._friends.get((friend_number, incoming))
+        if bucket is not None:
+            delay = max(delay, bucket.consume(size))
+        return delay
+
+    def _update_global_limits(self):
+        self._throttled = bool(self._call_limit and self._is_call_active())
+        for incoming, limit in self._limits.items():
+            if self._throttled:
+                limit = min(limit, self._call_limit) if limit else self._call_limit
+            self._global[incoming].set_rate(limit)
+
+# -----------------------------------------------------------------------------------------------------------------
+# Resumable transfers
+# -----------------------------------------------------------------------------------------------------------------
+
+
+class ResumableTransfers:
+    """
+    Started file transfers which can be resumed after friend reconnects or after restart. Saved in profile directory
+    (encrypted if profile has password). Key - file id, value - dict with path, friend number, direction, size,
+    position from which incoming transfer can be continued and hashes of received blocks. Changes are written to file
+    by save() which is called periodically
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._transfers = {}
+        self._key = None
+        self._dirty = False
+        if exists(path):
+            try:
+                with open(path, 'rb') as fl:
+                    data = fl.read()
+                inst = ToxES.get_instance()
+                if inst.is_data_encrypted(data):
+                    data = inst.pass_decrypt(data)
+                self._transfers = json.loads(str(data, 'utf-8'))
+            except Exception as ex:
+                util.log('Parsing transfers error: ' + str(ex))
+
+    def __contains__(self, file_id):
+        return file_id in self._transfers
+
+    def get(self, file_id):
+        return self._transfers.get(file_id)
+
+    def items(self):
+        return list(self._transfers.items())
+
+    def add(self, file_id, path, friend_number, incoming, size, position=0, end=None, hashes=None):
+        """
+        :param end: end of range of file which should be received or None (end of file)
+        :param hashes: dict index of block -> hex of hash of blocks which were received and hashed
+        """
+        self._transfers[file_id] = {
+            'path': path,
+            'friend_number': friend_number,
+            'incoming': incoming,
+            'size': size,
+            'position': position,
+            'end': end,
+            'hashes': hashes or {}
+        }
+        self._dirty = True
+
+    def update(self, file_id, position, hashes=None):
+        """
+        Set position of incoming transfer and hashes of its received blocks
+        :return: True if position was changed
+        """
+        data = self._transfers.get(file_id)
+        if data is None or data['position'] == position:
+            return False
+        data['position'] = position
+        if hashes is not None:
+            data['hashes'] = hashes
+        self._dirty = True
+        return True
+
+    def remove(self, file_id):
+        if file_id in self._transfers:
+            del self._transfers[file_id]
+            self._dirty = True
+
+    def clear(self):
+        self._transfers.clear()
+        self._dirty = True
+
+    def import_paused(self, paused):
+        """
+        Import transfers from old 'paused_file_transfers' setting
+        :param paused: dict file id -> [path, friend number, is incoming, start position]
+        """
+        for file_id, (path, friend_number, incoming, position) in paused.items():
+            self._transfers[file_id] = {
+                'path': path,
+                'friend_number': friend_number,
+                'incoming': incoming,
+                'size': 0,
+                'position': max(position, 0),
+                'end': None,
+                'hashes': {}
+            }
+        if paused:
+            self._dirty = True
+
+    def save(self, new_key=False):
+        """
+        Write transfers to file if they were changed
+        :param new_key: derive encryption key from current password (e.g. after password change), file is written
+        """
+        if not self._dirty and not new_key:
+            return
+        self._dirty = False
+        text = bytes(json.dumps(self._transfers), 'utf-8')
+        inst = ToxES.get_instance()
+        if inst.has_password():
+            if self._key is None or new_key:
+                self._key = inst.derive_key()
+            text = bytes(inst.key_encrypt(text, self._key))
+        with open(self._path + '.tmp', 'wb') as fl:
+            fl.write(text)
+        replace(self._path + '.tmp', self._path)
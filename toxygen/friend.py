@@ -20,23 +20,19 @@ class Friend(contact.Contact):
         """
         Update status of active transfer and load inline if needed
         """
-        try:
-            tr = list(filter(lambda x: x.get_type() == MESSAGE_TYPE['FILE_TRANSFER'] and x.is_active(file_number),
-                             self._corr))[0]
-            tr.set_status(status)
-            i = self._corr.index(tr)
-            if inline:  # inline was loaded
-                self._corr.insert(i, inline)
-            return i - len(self._corr)
-        except:
-            pass
+        i = self._corr.set_transfer_status(file_number, status)
+        if i is None:
+            return None
+        if inline:  # inline was loaded
+            self._corr.insert(i, inline)
+        return i - len(self._corr)
 
     def get_unsent_files(self):
-        messages = filter(lambda x: type(x) is UnsentFile, self._corr)
+        messages = filter(lambda x: type(x) is UnsentFile, self._corr.get_objects())
         return messages
 
     def clear_unsent_files(self):
-        self._corr = list(filter(lambda x: type(x) is not UnsentFile, self._corr))
+        self._corr.remove_objects(lambda x: type(x) is UnsentFile)
 
     def remove_invalid_unsent_files(self):
         def is_valid(message):
@@ -45,10 +41,10 @@ class Friend(contact.Contact):
             if message.get_data()[1] is not None:
                 return True
             return os.path.exists(message.get_data()[0])
-        self._corr = list(filter(is_valid, self._corr))
+        self._corr.remove_objects(lambda x: not is_valid(x))
 
     def delete_one_unsent_file(self, time):
-        self._corr = list(filter(lambda x: not (type(x) is UnsentFile and x.get_data()[2] == time), self._corr))
+        self._corr.remove_objects(lambda x: type(x) is UnsentFile and x.get_data()[2] == time)
 
     # -----------------------------------------------------------------------------------------------------------------
     # History support
@@ -1,8 +1,13 @@
-from sqlite3 import connect
+from sqlite3 import connect, OperationalError
 import settings
-from os import chdir
 import os.path
+import re
+import queue
+import threading
+from contextlib import contextmanager
 from toxes import ToxES
+from ctypes import ArgumentError
+from toxencryptsave_enums_and_consts import TOX_PASS_ENCRYPTION_EXTRA_LENGTH
 
 
 PAGE_SIZE = 42
@@ -11,6 +16,25 @@ TIMEOUT = 11
 
 SAVE_MESSAGES = 250
 
+MESSAGES_CACHE_SIZE = 5000  # max count of messages of all contacts in memory
+
+READERS_COUNT = 2  # size of pool of read-only connections
+
+CACHED_STATEMENTS = 256  # count of prepared statements cached by every connection
+
+SCHEMA_VERSION = 4  # 1 - table per friend, 2 - all messages in one table, 3 - full-text search index,
+# 4 - per-message encryption
+
+SALT_LENGTH = 32
+
+EXPORT_BATCH = 1000  # count of messages read from db at once during export
+
+JOURNAL_INTERVAL = 2  # seconds between flushes of new messages to write-behind journal
+
+MIGRATION_BATCH = 5000  # count of messages moved to new schema in one transaction
+
+MIN_INDEXED_SEARCH_LENGTH = 3  # shorter strings can't be found using trigram index
+
 MESSAGE_OWNER = {
     'ME': 0,
     'FRIEND': 1,
@@ -18,198 +42,743 @@ MESSAGE_OWNER = {
 }
 
 
+def regexp(pattern, value):
+    """
+    Implementation of REGEXP operator of SQLite. Case insensitive, like search in chat history
+    """
+    return value is not None and re.search(pattern, value, re.IGNORECASE) is not None
+
+
+def is_plain_text(search_string):
+    return not any(c in search_string for c in '\\.^$*+?{}[]|()')
+
+
+class Database:
+    """
+    Long-lived connections to history db: one connection for writing and pool of connections for reading.
+    WAL journal mode is used so readers don't block writer
+    """
+
+    def __init__(self, path, readers_count=READERS_COUNT):
+        self._path = path
+        self._lock = threading.RLock()
+        self._depth = 0  # depth of nested transactions
+        self._owner = None  # id of thread which holds current transaction
+        self._writer = self._connect()
+        self._writer.execute('PRAGMA journal_mode=WAL;')
+        self._writer.execute('PRAGMA synchronous=NORMAL;')
+        self._writer.execute('PRAGMA secure_delete=ON;')  # deleted and overwritten messages are zeroed in db file
+        self._readers = queue.Queue()
+        self._all_readers = []
+        for _ in range(readers_count):
+            db = self._connect()
+            self._readers.put(db)
+            self._all_readers.append(db)
+
+    def _connect(self):
+        db = connect(self._path, timeout=TIMEOUT, check_same_thread=False,
+                     cached_statements=CACHED_STATEMENTS, isolation_level=None)
+        db.create_function('REGEXP', 2, regexp)
+        return db
+
+    def create_function(self, name, args_count, func):
+        """
+        Registers SQL function in all connections
+        """
+        with self._lock:
+            for db in [self._writer] + self._all_readers:
+                db.create_function(name, args_count, func)
+
+    def has_search_index(self):
+        """
+        :return: True if full-text search index exists in db (requires FTS5 with trigram tokenizer).
+        Index is dropped if messages are encrypted
+        """
+        with self.cursor() as cursor:
+            cursor.execute("SELECT 0 FROM sqlite_master WHERE type='table' AND name='messages_fts';")
+            return cursor.fetchone() is not None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction. Nested transactions are savepoints of outer one, so batch of writes costs one commit
+        """
+        with self._lock:
+            name = 's' + str(self._depth)
+            self._writer.execute('SAVEPOINT ' + name + ';')
+            self._depth += 1
+            self._owner = threading.get_ident()
+            cursor = self._writer.cursor()
+            try:
+                yield cursor
+            except:
+                self._writer.execute('ROLLBACK TO ' + name + ';')
+                self._writer.execute('RELEASE ' + name + ';')
+                raise
+            else:
+                self._writer.execute('RELEASE ' + name + ';')
+            finally:
+                cursor.close()
+                self._depth -= 1
+                if not self._depth:
+                    self._owner = None
+
+    @contextmanager
+    def cursor(self):
+        """
+        Read-only cursor. Uncommitted data of current transaction is visible only for thread which holds it
+        """
+        if self._owner == threading.get_ident():
+            with self._lock:
+                cursor = self._writer.cursor()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+            return
+        db = self._readers.get()
+        cursor = db.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()  # finishes read transaction of connection
+            self._readers.put(db)
+
+    def checkpoint(self):
+        """
+        Move all data from WAL file to db file
+        """
+        with self._lock:
+            self._writer.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+
+    def vacuum(self):
+        """
+        Rebuild db file, so it doesn't contain free pages with old data
+        """
+        with self._lock:
+            self._writer.execute('VACUUM;')
+        self.checkpoint()
+
+    def close(self):
+        with self._lock:
+            for db in self._all_readers:
+                db.close()
+            self._writer.close()
+
+
+class SchemaMigrator:
+    """
+    Converts history db created by older versions (one table per friend) to current schema.
+    Messages are moved in batches, every batch in separate transaction, so conversion can be interrupted
+    and it will be continued on next start
+    """
+
+    def __init__(self, db, batch_size=MIGRATION_BATCH):
+        self._db = db
+        self._batch_size = batch_size
+
+    def version(self):
+        """
+        :return: schema version of db, 0 for empty db
+        """
+        with self._db.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('schema', 'friends');")
+            tables = set(row[0] for row in cursor.fetchall())
+            if 'schema' in tables:
+                cursor.execute('SELECT version FROM schema;')
+                return cursor.fetchone()[0]
+        return 1 if 'friends' in tables else 0
+
+    def migrate(self):
+        version = self.version()
+        if version < 2:
+            with self._db.transaction() as cursor:
+                if version:
+                    cursor.execute('ALTER TABLE friends RENAME TO legacy_friends;')
+                cursor.execute('CREATE TABLE friends('
+                               '    id INTEGER PRIMARY KEY,'
+                               '    tox_id TEXT UNIQUE NOT NULL'
+                               ')')
+                cursor.execute('CREATE TABLE messages('
+                               '    id INTEGER PRIMARY KEY,'
+                               '    friend_id INTEGER NOT NULL,'
+                               '    unix_time REAL,'
+                               '    owner INTEGER,'
+                               '    type INTEGER,'
+                               '    message TEXT'
+                               ')')
+                cursor.execute('CREATE INDEX messages_friend_time ON messages(friend_id, unix_time);')
+                cursor.execute('CREATE TABLE schema(version INTEGER);')
+                cursor.execute('INSERT INTO schema VALUES (?);', (2, ))
+                if version:
+                    cursor.execute('INSERT INTO friends(tox_id) SELECT tox_id FROM legacy_friends;')
+                    cursor.execute('DROP TABLE legacy_friends;')
+        if version < 3:
+            with self._db.transaction() as cursor:
+                self.create_search_index(cursor)
+                cursor.execute('UPDATE schema SET version = ?;', (3, ))
+        if version < 4:
+            with self._db.transaction() as cursor:
+                cursor.execute('CREATE TABLE encryption(salt BLOB NOT NULL);')
+                cursor.execute('UPDATE schema SET version = ?;', (SCHEMA_VERSION, ))
+        for table in self._legacy_tables():
+            self._move_messages(table)
+
+    @staticmethod
+    def drop_search_index(cursor):
+        cursor.execute('DROP TRIGGER IF EXISTS messages_fts_insert;')
+        cursor.execute('DROP TRIGGER IF EXISTS messages_fts_delete;')
+        cursor.execute('DROP TRIGGER IF EXISTS messages_fts_update;')
+        cursor.execute('DROP TABLE IF EXISTS messages_fts;')
+
+    @staticmethod
+    def create_search_index(cursor):
+        """
+        Creates FTS5 index of messages. Index is updated by triggers, so all changes of messages table are indexed
+        in the same transaction. Index is not created if SQLite doesn't support FTS5 or trigram tokenizer
+        """
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE messages_fts USING fts5("
+                           "    message,"
+                           "    content='messages',"
+                           "    content_rowid='id',"
+                           "    tokenize='trigram'"
+                           ")")
+        except OperationalError:
+            print('Full-text search is not supported')
+            return
+        cursor.execute('CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN '
+                       '    INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message); '
+                       'END;')
+        cursor.execute('CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN '
+                       "    INSERT INTO messages_fts(messages_fts, rowid, message) "
+                       "    VALUES ('delete', old.id, old.message); "
+                       'END;')
+        cursor.execute('CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN '
+                       "    INSERT INTO messages_fts(messages_fts, rowid, message) "
+                       "    VALUES ('delete', old.id, old.message); "
+                       '    INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message); '
+                       'END;')
+        cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild');")
+
+    def _legacy_tables(self):
+        with self._db.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'id%';")
+            return [row[0] for row in cursor.fetchall()]
+
+    def _move_messages(self, table):
+        tox_id = table[2:]
+        with self._db.transaction() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO friends(tox_id) VALUES (?);', (tox_id, ))
+            cursor.execute('SELECT id FROM friends WHERE tox_id=?;', (tox_id, ))
+            friend_id = cursor.fetchone()[0]
+        moved = -1
+        while moved:
+            with self._db.transaction() as cursor:
+                cursor.execute('INSERT INTO messages(friend_id, unix_time, owner, type, message) '
+                               'SELECT ?, unix_time, owner, message_type, message FROM ' + table +
+                               ' ORDER BY id LIMIT ?;', (friend_id, self._batch_size))
+                moved = cursor.rowcount
+                cursor.execute('DELETE FROM ' + table + ' WHERE id IN '
+                               '(SELECT id FROM ' + table + ' ORDER BY id LIMIT ?);', (self._batch_size, ))
+        with self._db.transaction() as cursor:
+            cursor.execute('DROP TABLE ' + table + ';')
+
+
+class Journal:
+    """
+    Write-behind journal of history. Writes are done by worker thread, every batch of writes in one transaction
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, writes):
+        """
+        :param writes: list of tuples (function, args) which should be called in one transaction
+        """
+        self._queue.put(writes)
+
+    def flush(self):
+        """
+        Wait until all queued writes are done
+        """
+        self._queue.join()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            writes = self._queue.get()
+            try:
+                if writes is None:
+                    return
+                with self._db.transaction():
+                    for func, args in writes:
+                        func(*args)
+            except Exception as ex:
+                print('History journal error: ' + str(ex))
+            finally:
+                self._queue.task_done()
+
+
 class History:
+    """
+    If profile has password, every message is encrypted separately with key derived from password, so db file
+    is never decrypted or re-encrypted as a whole
+    """
 
     def __init__(self, name):
         self._name = name
-        chdir(settings.ProfileHelper.get_path())
+        self._key = None  # key which was used to encrypt messages or None if history is not encrypted
+        self._journal = None
         path = settings.ProfileHelper.get_path() + self._name + '.hstr'
         if os.path.exists(path):
-            decr = ToxES.get_instance()
-            try:
-                with open(path, 'rb') as fin:
-                    data = fin.read()
-                if decr.is_data_encrypted(data):
-                    data = decr.pass_decrypt(data)
-                    with open(path, 'wb') as fout:
-                        fout.write(data)
-            except:
-                os.remove(path)
-        db = connect(name + '.hstr', timeout=TIMEOUT)
-        cursor = db.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS friends('
-                       '    tox_id TEXT PRIMARY KEY'
-                       ')')
-        db.close()
+            self._decrypt_legacy_file(path)
+        self._open(path)
+        salt = self._get_salt()
+        if salt is not None and not self._set_key(salt):
+            # e.g. password was removed, but app was closed before history was saved
+            print('History is encrypted with other password, it\'s kept with suffix \'.encrypted\'')
+            self._db.close()
+            self._keep_encrypted(path)
+            self._open(path)
+        self.update_encryption()
 
-    def save(self):
-        encr = ToxES.get_instance()
-        if encr.has_password():
-            path = settings.ProfileHelper.get_path() + self._name + '.hstr'
+    def _open(self, path):
+        self._db = Database(path)
+        self._db.create_function('DECRYPT', 1, self._decrypt)
+        SchemaMigrator(self._db).migrate()
+
+    @staticmethod
+    def _keep_encrypted(path):
+        """
+        Move history file which can't be decrypted to free path with suffix '.encrypted'
+        """
+        new_path, i = path + '.encrypted', 1
+        while os.path.exists(new_path):
+            new_path, i = path + '.encrypted' + str(i), i + 1
+        for suffix in ('', '-wal', '-shm'):  # files of db
+            if os.path.exists(path + suffix):
+                os.replace(path + suffix, new_path + suffix)
+
+    @staticmethod
+    def _decrypt_legacy_file(path):
+        """
+        Decrypt history file encrypted as a whole by older versions. Only header of file is read to check it. If file
+        can't be decrypted, it's kept with suffix '.encrypted' and new history is created
+        """
+        decr = ToxES.get_instance()
+        try:
+            with open(path, 'rb') as fin:
+                header = fin.read(TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+        except OSError as ex:
+            print('History file can\'t be read: ' + str(ex))
+            return
+        if not decr.is_data_encrypted(header):
+            return
+        try:
             with open(path, 'rb') as fin:
-                data = fin.read()
-            data = encr.pass_encrypt(bytes(data))
-            with open(path, 'wb') as fout:
+                data = decr.pass_decrypt(fin.read())
+            with open(path + '.tmp', 'wb') as fout:
                 fout.write(data)
+            os.replace(path + '.tmp', path)
+        except (OSError, MemoryError, ArgumentError, RuntimeError) as ex:
+            print('History decryption failed: ' + str(ex))
+            try:
+                History._keep_encrypted(path)
+            except OSError as ex:
+                print('History file can\'t be moved: ' + str(ex))
+
+    def close(self):
+        """
+        Close all connections to db
+        """
+        self.stop_journal()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def save(self):
+        self.stop_journal()
+        self.update_encryption()
+        self.close()
 
     def export(self, directory):
+        self.update_encryption()
+        self._db.checkpoint()
         path = settings.ProfileHelper.get_path() + self._name + '.hstr'
         new_path = directory + self._name + '.hstr'
         with open(path, 'rb') as fin:
             data = fin.read()
-        encr = ToxES.get_instance()
-        if encr.has_password():
-            data = encr.pass_encrypt(data)
         with open(new_path, 'wb') as fout:
             fout.write(data)
 
+    # -----------------------------------------------------------------------------------------------------------------
+    # Write-behind journal
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def start_journal(self):
+        if self._journal is None:
+            self._journal = Journal(self._db)
+
+    def stop_journal(self):
+        """
+        Finish all queued writes and stop worker thread
+        """
+        if self._journal is not None:
+            self._journal.stop()
+            self._journal = None
+
+    def write_later(self, writes):
+        """
+        Queue writes to history. Writes are done immediately if journal is not started
+        :param writes: list of tuples (method of History, args)
+        """
+        if self._journal is not None:
+            self._journal.put(writes)
+        else:
+            with self._db.transaction():
+                for func, args in writes:
+                    func(*args)
+
+    def flush(self):
+        """
+        Wait until all queued writes are done. Should be called before changes which depend on queued writes
+        """
+        if self._journal is not None:
+            self._journal.flush()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Encryption
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _get_salt(self):
+        with self._db.cursor() as cursor:
+            cursor.execute('SELECT salt FROM encryption;')
+            result = cursor.fetchone()
+        return result[0] if result is not None else None
+
+    def _set_key(self, salt):
+        """
+        Use key derived from current password and salt of history
+        :return: False if encrypted messages can't be decrypted with current password
+        """
+        encr = ToxES.get_instance()
+        self._key = encr.derive_key(salt) if encr is not None and encr.has_password() else None
+        with self._db.cursor() as cursor:
+            cursor.execute('SELECT message FROM messages WHERE typeof(message) = \'blob\' LIMIT 1;')
+            row = cursor.fetchone()
+        if row is None:
+            return True
+        try:
+            if self._key is not None:
+                encr.key_decrypt(row[0], self._key)
+                return True
+        except (ArgumentError, RuntimeError):
+            self._key = None
+        return False
+
+    def _encrypt(self, message):
+        if self._key is None:
+            return message
+        return ToxES.get_instance().key_encrypt(bytes(message, 'utf-8'), self._key)
+
+    def _decrypt(self, message):
+        """
+        Plain text messages are stored as TEXT and encrypted as BLOB
+        """
+        if not isinstance(message, bytes):
+            return message
+        if self._key is None:
+            return ''
+        return str(ToxES.get_instance().key_decrypt(message, self._key), 'utf-8')
+
+    def update_encryption(self):
+        """
+        Encrypts, decrypts or re-encrypts all messages if profile password was set, removed or changed.
+        Messages are converted in one transaction, so history never contains messages encrypted with different keys
+        """
+        encr = ToxES.get_instance()
+        if encr is None:
+            return
+        if encr.has_password():
+            salt = self._key[:SALT_LENGTH] if self._key is not None else None
+            key = encr.derive_key(salt)
+            if key == self._key:
+                return
+            if self._key is not None:  # password was changed
+                key = encr.derive_key()
+        elif self._key is None:
+            return
+        else:
+            key = None
+        encrypt = self._key is None
+        with self._db.transaction() as cursor:
+            if encrypt:
+                SchemaMigrator.drop_search_index(cursor)
+            self._convert_messages(cursor, key)
+            cursor.execute('DELETE FROM encryption;')
+            if key is not None:
+                cursor.execute('INSERT INTO encryption VALUES (?);', (key[:SALT_LENGTH], ))
+            else:
+                SchemaMigrator.create_search_index(cursor)
+            self._key = key
+        if encrypt:
+            self._db.vacuum()  # remove pages with plain text from db file
+
+    def _convert_messages(self, cursor, key):
+        """
+        Decrypts every message with current key and encrypts it with given key
+        :param key: new key or None to save messages as plain text
+        """
+        encr = ToxES.get_instance()
+        last_id = -1
+        while True:
+            cursor.execute('SELECT id, message FROM messages WHERE id > ? ORDER BY id LIMIT ?;',
+                           (last_id, MIGRATION_BATCH))
+            data = cursor.fetchall()
+            if not data:
+                break
+            last_id = data[-1][0]
+            result = []
+            for message_id, message in data:
+                if isinstance(message, bytes):
+                    message = str(encr.key_decrypt(message, self._key), 'utf-8')
+                if key is not None:
+                    message = encr.key_encrypt(bytes(message, 'utf-8'), key)
+                result.append((message, message_id))
+            cursor.executemany('UPDATE messages SET message = ? WHERE id = ?;', result)
+
+    def transaction(self):
+        """
+        All history changes made inside of this context are saved in one transaction
+        """
+        return self._db.transaction()
+
     def add_friend_to_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
         try:
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO friends VALUES (?);', (tox_id, ))
-            cursor.execute('CREATE TABLE id' + tox_id + '('
-                           '    id INTEGER PRIMARY KEY,'
-                           '    message TEXT,'
-                           '    owner INTEGER,'
-                           '    unix_time REAL,'
-                           '    message_type INTEGER'
-                           ')')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('INSERT INTO friends(tox_id) VALUES (?);', (tox_id, ))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def delete_friend_from_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
         try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM friends WHERE tox_id=?;', (tox_id, ))
-            cursor.execute('DROP TABLE id' + tox_id + ';')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('DELETE FROM messages WHERE friend_id = (SELECT id FROM friends WHERE tox_id=?);',
+                               (tox_id, ))
+                cursor.execute('DELETE FROM friends WHERE tox_id=?;', (tox_id, ))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def friend_exists_in_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
-        cursor = db.cursor()
-        cursor.execute('SELECT 0 FROM friends WHERE tox_id=?', (tox_id, ))
-        result = cursor.fetchone()
-        db.close()
+        with self._db.cursor() as cursor:
+            cursor.execute('SELECT 0 FROM friends WHERE tox_id=?', (tox_id, ))
+            result = cursor.fetchone()
         return result is not None
 
     def save_messages_to_db(self, tox_id, messages_iter):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
         try:
-            cursor = db.cursor()
-            cursor.executemany('INSERT INTO id' + tox_id + '(message, owner, unix_time, message_type) '
-                               'VALUES (?, ?, ?, ?);', messages_iter)
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('INSERT OR IGNORE INTO friends(tox_id) VALUES (?);', (tox_id, ))
+                cursor.execute('SELECT id FROM friends WHERE tox_id=?;', (tox_id, ))
+                friend_id = cursor.fetchone()[0]
+                cursor.executemany('INSERT INTO messages(friend_id, message, owner, unix_time, type) '
+                                   'VALUES (?, ?, ?, ?, ?);',
+                                   ((friend_id, self._encrypt(m[0])) + tuple(m[1:]) for m in messages_iter))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def update_messages(self, tox_id, unsent_time):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
         try:
-            cursor = db.cursor()
-            cursor.execute('UPDATE id' + tox_id + ' SET owner = 0 '
-                           'WHERE unix_time < ' + str(unsent_time) + ' AND owner = 2;')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('UPDATE messages SET owner = 0 '
+                               'WHERE friend_id = (SELECT id FROM friends WHERE tox_id=?) '
+                               'AND unix_time < ? AND owner = 2;', (tox_id, unsent_time))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def delete_message(self, tox_id, time):
-        start, end = str(time - 0.01), str(time + 0.01)
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
+        start, end = time - 0.01, time + 0.01
         try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM id' + tox_id + ' WHERE unix_time < ' + end + ' AND unix_time > ' +
-                           start + ';')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('DELETE FROM messages WHERE friend_id = (SELECT id FROM friends WHERE tox_id=?) '
+                               'AND unix_time < ? AND unix_time > ?;', (tox_id, end, start))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def delete_messages(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
         try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM id' + tox_id + ';')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('DELETE FROM messages WHERE friend_id = (SELECT id FROM friends WHERE tox_id=?);',
+                               (tox_id, ))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
+
+    def search_messages(self, tox_id, search_string, before=None, limit=-1, max_id=None):
+        """
+        Search in history of friend. Plain text is found using full-text index, regex - by scan of messages in db.
+        Encrypted history is not indexed, messages are decrypted during scan
+        :param tox_id: public key of friend
+        :param search_string: regex or plain text. Search is case insensitive
+        :param before: (unix_time, id) of message or None. If not None only older messages will be found
+        :param limit: max count of results or -1
+        :param max_id: if not None only messages with id <= max_id will be found
+        :return: list of (unix_time, id) of found messages, newest first
+        """
+        params = []
+        if self._db.has_search_index() and is_plain_text(search_string) \
+                and len(search_string) >= MIN_INDEXED_SEARCH_LENGTH:
+            query = ('SELECT unix_time, id FROM messages '
+                     'WHERE id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) ')
+            params.append('"' + search_string.replace('"', '""') + '"')
+        elif self._key is not None:
+            query = 'SELECT unix_time, id FROM messages WHERE DECRYPT(message) REGEXP ? '
+            params.append(search_string)
+        else:
+            query = 'SELECT unix_time, id FROM messages WHERE message REGEXP ? '
+            params.append(search_string)
+        query += 'AND friend_id = (SELECT id FROM friends WHERE tox_id=?) '
+        params.append(tox_id)
+        if before is not None:
+            query += 'AND unix_time <= ? AND (unix_time < ? OR id < ?) '
+            params.extend((before[0], before[0], before[1]))
+        if max_id is not None:
+            query += 'AND id <= ? '
+            params.append(max_id)
+        query += 'ORDER BY unix_time DESC, id DESC LIMIT ?;'
+        params.append(limit)
+        with self._db.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    @staticmethod
+    def _time_range(query, params, start, end):
+        if start is not None:
+            query += 'AND unix_time >= ? '
+            params.append(start)
+        if end is not None:
+            query += 'AND unix_time <= ? '
+            params.append(end)
+        return query
+
+    def count_messages(self, tox_id, start=None, end=None):
+        """
+        :return: count of messages of friend in time range
+        """
+        params = [tox_id]
+        query = self._time_range('SELECT COUNT(*) FROM messages '
+                                 'WHERE friend_id = (SELECT id FROM friends WHERE tox_id=?) ', params, start, end)
+        with self._db.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchone()[0]
+
+    def export_messages(self, tox_id, start=None, end=None):
+        """
+        Generator of messages of friend, oldest first. Messages are read in batches, every batch in separate read
+        transaction, so export of any history uses constant memory and doesn't block db
+        :param start: unix time of oldest message or None
+        :param end: unix time of newest message or None
+        :return: iterator of tuples (message, owner, unix_time, type)
+        """
+        last = None  # (unix_time, id) of last exported message
+        while True:
+            query = ('SELECT message, owner, unix_time, type, id FROM messages '
+                     'WHERE friend_id = (SELECT id FROM friends WHERE tox_id=?) ')
+            params = [tox_id]
+            if last is not None:
+                query += 'AND unix_time >= ? AND (unix_time > ? OR id > ?) '
+                params.extend((last[0], last[0], last[1]))
+            query = self._time_range(query, params, start, end)
+            query += 'ORDER BY unix_time, id LIMIT ?;'
+            params.append(EXPORT_BATCH)
+            with self._db.cursor() as cursor:
+                cursor.execute(query, params)
+                data = cursor.fetchall()
+            for row in data:
+                yield (self._decrypt(row[0]), ) + row[1:4]
+            if len(data) < EXPORT_BATCH:
+                return
+            last = data[-1][2], data[-1][4]
 
     def messages_getter(self, tox_id):
-        return History.MessageGetter(self._name, tox_id)
+        return History.MessageGetter(self, self._db, tox_id)
 
     class MessageGetter:
+        """
+        Loads messages of friend page by page, from newest to oldest. Remembers (unix_time, id) of last loaded
+        message, so every page is loaded using index on (friend_id, unix_time) regardless of history depth.
+        Messages saved after creation of getter are not loaded - they are already in memory
+        """
 
-        def __init__(self, name, tox_id):
-            self._count = 0
-            self._name = name
+        def __init__(self, history, db, tox_id):
+            self._history = history
+            self._db = db
             self._tox_id = tox_id
-            self._db = self._cursor = None
+            self._last = None  # (unix_time, id) of oldest loaded message
+            with self._db.cursor() as cursor:
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages;')
+                self._max_id = cursor.fetchone()[0]
 
-        def connect(self):
-            chdir(settings.ProfileHelper.get_path())
-            self._db = connect(self._name + '.hstr', timeout=TIMEOUT)
-            self._cursor = self._db.cursor()
-            self._cursor.execute('SELECT message, owner, unix_time, message_type FROM id' + self._tox_id +
-                                 ' ORDER BY unix_time DESC;')
+        def _select(self, count=-1, until=None):
+            """
+            :param count: max count of messages or -1 to get all remaining messages
+            :param until: (unix_time, id) of oldest message which should be loaded or None
+            """
+            query = ('SELECT message, owner, unix_time, type, id FROM messages '
+                     'WHERE friend_id = (SELECT id FROM friends WHERE tox_id=?) AND id <= ? ')
+            params = [self._tox_id, self._max_id]
+            if self._last is not None:
+                query += 'AND unix_time <= ? AND (unix_time < ? OR id < ?) '
+                params.extend((self._last[0], self._last[0], self._last[1]))
+            if until is not None:
+                query += 'AND unix_time >= ? AND (unix_time > ? OR id >= ?) '
+                params.extend((until[0], until[0], until[1]))
+            query += 'ORDER BY unix_time DESC, id DESC LIMIT ?;'
+            params.append(count)
+            with self._db.cursor() as cursor:
+                cursor.execute(query, params)
+                data = cursor.fetchall()
+            if data:
+                self._last = data[-1][2], data[-1][4]
+            return [(self._history._decrypt(row[0]), ) + row[1:4] for row in data]
 
-        def disconnect(self):
-            self._db.close()
+        def rewind(self, unix_time):
+            """
+            Messages sent not later than unix_time were unloaded from memory, they will be loaded again
+            """
+            self._history.flush()
+            with self._db.cursor() as cursor:
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages;')
+                self._max_id = cursor.fetchone()[0]
+            self._last = unix_time, float('inf')
+
+        def search(self, search_string):
+            """
+            :return: (unix_time, id) of newest not loaded message which contains search_string or None
+            """
+            data = self._history.search_messages(self._tox_id, search_string, self._last, 1, self._max_id)
+            return data[0] if data else None
+
+        def get_until(self, message):
+            """
+            :param message: (unix_time, id) of message
+            :return: all not loaded messages newer than given message and this message
+            """
+            return self._select(until=message)
 
         def get_one(self):
-            self.connect()
-            self.skip()
-            data = self._cursor.fetchone()
-            self._count += 1
-            self.disconnect()
-            return data
+            data = self._select(1)
+            return data[0] if data else None
 
         def get_all(self):
-            self.connect()
-            data = self._cursor.fetchall()
-            self.disconnect()
-            self._count = len(data)
-            return data
+            return self._select()
 
         def get(self, count):
-            self.connect()
-            self.skip()
-            data = self._cursor.fetchmany(count)
-            self.disconnect()
-            self._count += len(data)
-            return data
-
-        def skip(self):
-            if self._count:
-                self._cursor.fetchmany(self._count)
-
-        def delete_one(self):
-            if self._count:
-                self._count -= 1
+            return self._select(count)
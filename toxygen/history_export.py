@@ -0,0 +1,155 @@
+import csv
+import json
+from html import escape
+from history import MESSAGE_OWNER
+from messages import MESSAGE_TYPE
+from util import convert_time
+
+
+PROGRESS_STEP = 1000  # progress is reported after every PROGRESS_STEP messages
+
+
+class Exporter:
+    """
+    Base class of history exporters. Messages are written to file one by one, nothing is accumulated in memory
+    """
+
+    def __init__(self, fl, own_name):
+        """
+        :param fl: file opened in text mode
+        :param own_name: name of current user
+        """
+        self._file = fl
+        self._own_name = own_name
+
+    def begin(self, title):
+        pass
+
+    def contact(self, name, tox_id):
+        """
+        Messages of next contact will be written. Called only if history of several contacts is exported
+        """
+        pass
+
+    def message(self, name, tox_id, message, owner, unix_time, message_type):
+        pass
+
+    def end(self):
+        pass
+
+    def author(self, name, owner):
+        return name if owner == MESSAGE_OWNER['FRIEND'] else self._own_name
+
+
+class TextExporter(Exporter):
+
+    def __init__(self, fl, own_name):
+        super().__init__(fl, own_name)
+        self._first = True
+
+    def contact(self, name, tox_id):
+        if not self._first:
+            self._file.write('\n')
+        self._file.write('{}\n\n'.format(name))
+        self._first = True
+
+    def message(self, name, tox_id, message, owner, unix_time, message_type):
+        if not self._first:
+            self._file.write('\n')
+        self._first = False
+        self._file.write('[{}] {}: {}\n'.format(convert_time(unix_time) if owner != MESSAGE_OWNER['NOT_SENT']
+                                                else 'Unsent', self.author(name, owner), message))
+
+
+class HTMLExporter(TextExporter):
+
+    def begin(self, title):
+        self._file.write('<html><head><meta charset="UTF-8"><title>{}</title></head><body>'.format(escape(title)))
+
+    def contact(self, name, tox_id):
+        self._file.write('<h3>{}</h3>'.format(escape(name)))
+        self._first = True
+
+    def message(self, name, tox_id, message, owner, unix_time, message_type):
+        if not self._first:
+            self._file.write('<br>')
+        self._first = False
+        self._file.write('[{}] <b>{}:</b> {}<br>'.format(convert_time(unix_time) if owner != MESSAGE_OWNER['NOT_SENT']
+                                                         else 'Unsent', escape(self.author(name, owner)),
+                                                         escape(message)))
+
+    def end(self):
+        self._file.write('</body></html>')
+
+
+class JSONExporter(Exporter):
+    """
+    JSON lines - one JSON object per message
+    """
+
+    def message(self, name, tox_id, message, owner, unix_time, message_type):
+        data = {
+            'tox_id': tox_id,
+            'author': self.author(name, owner),
+            'owner': owner,
+            'time': unix_time,
+            'action': message_type == MESSAGE_TYPE['ACTION'],
+            'message': message
+        }
+        self._file.write(json.dumps(data) + '\n')
+
+
+class CSVExporter(Exporter):
+
+    def __init__(self, fl, own_name):
+        super().__init__(fl, own_name)
+        self._writer = csv.writer(fl)
+
+    def begin(self, title):
+        self._writer.writerow(('tox_id', 'author', 'owner', 'time', 'action', 'message'))
+
+    def message(self, name, tox_id, message, owner, unix_time, message_type):
+        self._writer.writerow((tox_id, self.author(name, owner), owner, unix_time,
+                               int(message_type == MESSAGE_TYPE['ACTION']), message))
+
+
+EXPORTERS = {
+    'txt': TextExporter,
+    'html': HTMLExporter,
+    'jsonl': JSONExporter,
+    'csv': CSVExporter
+}
+
+
+def export_history(history, fl, export_format, own_name, contacts, start=None, end=None, progress=None):
+    """
+    Streams messages from history to file
+    :param history: History instance
+    :param fl: file opened in text mode
+    :param export_format: key of EXPORTERS
+    :param own_name: name of current user
+    :param contacts: list of tuples (name, tox_id, unsaved messages) of exported contacts. Unsaved messages are
+    written after messages from db
+    :param start: unix time of oldest exported message or None
+    :param end: unix time of newest exported message or None
+    :param progress: callable with args (count of exported messages, total count) or None
+    """
+    exporter = EXPORTERS[export_format](fl, own_name)
+    total = sum(map(lambda c: history.count_messages(c[1], start, end) + len(c[2]), contacts))
+    count = 0
+    exporter.begin(contacts[0][0] if len(contacts) == 1 else own_name)
+    for name, tox_id, unsaved in contacts:
+        if len(contacts) > 1:
+            exporter.contact(name, tox_id)
+        unsaved = filter(lambda m: (start is None or m[2] >= start) and (end is None or m[2] <= end), unsaved)
+        for message, owner, unix_time, message_type in history.export_messages(tox_id, start, end):
+            exporter.message(name, tox_id, message, owner, unix_time, message_type)
+            count += 1
+            if progress is not None and not count % PROGRESS_STEP:
+                progress(count, total)
+        for message, owner, unix_time, message_type in unsaved:
+            exporter.message(name, tox_id, message, owner, unix_time, message_type)
+            count += 1
+    exporter.end()
+    if progress is not None:
+        progress(count, total)
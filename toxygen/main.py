@@ -13,6 +13,7 @@ import toxes
 from passwordscreen import PasswordScreen, UnlockAppScreen, SetProfilePasswordScreen
 from plugin_support import PluginLoader
 import updater
+from file_transfers import ToxCalls
 
 
 class Toxygen:
@@ -344,6 +345,7 @@ class Toxygen:
         self.mainloop.wait()
         self.init.wait()
         self.avloop.wait()
+        ToxCalls.get_instance().clear()  # calls of old tox instance
         data = self.tox.get_savedata()
         ProfileHelper.get_instance().save_profile(data)
         del self.tox
@@ -414,7 +416,9 @@ class Toxygen:
             self.stop = False
 
         def run(self):
+            tox_calls = ToxCalls.get_instance()
             while not self.stop:
+                tox_calls.run()  # calls of toxcore from threads of file transfers
                 self.tox.iterate()
                 self.msleep(self.tox.iteration_interval())
 
@@ -461,6 +465,18 @@ def reset():
     Settings.reset_auto_profile()
 
 
+def migrate_history(path):
+    """Converts unencrypted history db to current schema"""
+    import history
+    try:
+        db = history.Database(path)
+        history.SchemaMigrator(db).migrate()
+        db.close()
+        print('History was converted successfully')
+    except Exception as ex:
+        print('History conversion failed: ' + str(ex))
+
+
 def main():
     if len(sys.argv) == 1:
         toxygen = Toxygen()
@@ -470,7 +486,8 @@ def main():
             print('Toxygen v' + program_version)
             return
         elif arg == '--help':
-            print('Usage:\ntoxygen path_to_profile\ntoxygen tox_id\ntoxygen --version\ntoxygen --reset')
+            print('Usage:\ntoxygen path_to_profile\ntoxygen tox_id\ntoxygen --version\ntoxygen --reset\n'
+                  'toxygen --migrate-history path_to_hstr')
             return
         elif arg == '--clean':
             clean()
@@ -478,6 +495,9 @@ def main():
         elif arg == '--reset':
             reset()
             return
+        elif arg == '--migrate-history' and len(sys.argv) > 2:
+            migrate_history(sys.argv[2])
+            return
         else:
             toxygen = Toxygen(arg)
     toxygen.main()
@@ -63,9 +63,11 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         self.importPlugin = QtWidgets.QAction(window)
         self.reloadPlugins = QtWidgets.QAction(window)
         self.lockApp = QtWidgets.QAction(window)
+        self.exportHistory = QtWidgets.QAction(window)
         self.menuProfile.addAction(self.actionAdd_friend)
         self.menuProfile.addAction(self.actionAdd_gc)
         self.menuProfile.addAction(self.actionSettings)
+        self.menuProfile.addAction(self.exportHistory)
         self.menuProfile.addAction(self.lockApp)
         self.menuSettings.addAction(self.actionPrivacy_settings)
         self.menuSettings.addAction(self.actionInterface_settings)
@@ -97,6 +99,7 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         self.updateSettings.triggered.connect(self.update_settings)
         self.pluginData.triggered.connect(self.plugins_menu)
         self.lockApp.triggered.connect(self.lock_app)
+        self.exportHistory.triggered.connect(lambda: self.export_history(None))
         self.importPlugin.triggered.connect(self.import_plugin)
         self.reloadPlugins.triggered.connect(self.reload_plugins)
 
@@ -111,6 +114,7 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
 
     def retranslateUi(self):
         self.lockApp.setText(QtWidgets.QApplication.translate("MainWindow", "Lock"))
+        self.exportHistory.setText(QtWidgets.QApplication.translate("MainWindow", "Export all history"))
         self.menuPlugins.setTitle(QtWidgets.QApplication.translate("MainWindow", "Plugins"))
         self.pluginData.setText(QtWidgets.QApplication.translate("MainWindow", "List of plugins"))
         self.menuProfile.setTitle(QtWidgets.QApplication.translate("MainWindow", "Profile"))
@@ -522,9 +526,12 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         self.menu.hide()
         if self.profile.active_friend + 1and self.profile.is_active_a_friend():
             choose = QtWidgets.QApplication.translate("MainWindow", 'Choose file')
-            name = QtWidgets.QFileDialog.getOpenFileName(self, choose, options=QtWidgets.QFileDialog.DontUseNativeDialog)
-            if name[0]:
-                self.profile.send_file(name[0])
+            names = QtWidgets.QFileDialog.getOpenFileNames(self, choose,
+                                                           options=QtWidgets.QFileDialog.DontUseNativeDialog)
+            if len(names[0]) == 1:
+                self.profile.send_file(names[0][0])
+            elif names[0]:
+                self.profile.send_files_batch(names[0])
 
     def send_screenshot(self, hide=False):
         self.menu.hide()
@@ -562,6 +569,12 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
 
     def call_finished(self):
         self.update_call_state('call')
+        self.callButton.setToolTip(QtWidgets.QApplication.translate("MainWindow", "Start audio call with friend"))
+        self.videocallButton.setToolTip('')
+
+    def show_call_stats(self, text):
+        self.callButton.setToolTip(text)
+        self.videocallButton.setToolTip(text)
 
     def update_call_state(self, state):
         os.chdir(curr_directory() + '/images/')
@@ -600,6 +613,8 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
             clear_history_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Clear history'))
             export_to_text_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Export as text'))
             export_to_html_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Export as HTML'))
+            export_to_json_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Export as JSON lines'))
+            export_to_csv_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Export as CSV'))
 
             copy_menu = self.listMenu.addMenu(QtWidgets.QApplication.translate("MainWindow", 'Copy'))
             copy_name_item = copy_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Name'))
@@ -639,8 +654,10 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
             clear_history_item.triggered.connect(lambda: self.clear_history(num))
             copy_name_item.triggered.connect(lambda: self.copy_name(friend))
             copy_status_item.triggered.connect(lambda: self.copy_status(friend))
-            export_to_text_item.triggered.connect(lambda: self.export_history(num))
-            export_to_html_item.triggered.connect(lambda: self.export_history(num, False))
+            export_to_text_item.triggered.connect(lambda: self.export_history(num, 'txt'))
+            export_to_html_item.triggered.connect(lambda: self.export_history(num, 'html'))
+            export_to_json_item.triggered.connect(lambda: self.export_history(num, 'jsonl'))
+            export_to_csv_item.triggered.connect(lambda: self.export_history(num, 'csv'))
             parent_position = self.friends_list.mapToGlobal(QtCore.QPoint(0, 0))
             self.listMenu.move(parent_position + pos)
             self.listMenu.show()
@@ -660,21 +677,39 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         self.note = MultilineEdit(user, note, save_note)
         self.note.show()
 
-    def export_history(self, num, as_text=True):
-        s = self.profile.export_history(num, as_text)
-        extension = 'txt' if as_text else 'html'
-        file_name, _ = QtWidgets.QFileDialog.getSaveFileName(None,
-                                                              QtWidgets.QApplication.translate("MainWindow",
-                                                                                               'Choose file name'),
-                                                              curr_directory(),
-                                                              filter=extension,
-                                                              options=QtWidgets.QFileDialog.ShowDirsOnly | QtWidgets.QFileDialog.DontUseNativeDialog)
+    def export_history(self, num, extension=None):
+        """
+        Export history of contact or all history if num is None
+        :param extension: format of file or None if user should choose it
+        """
+        extensions = ('txt', 'html', 'jsonl', 'csv') if extension is None else (extension, )
+        file_name, file_filter = QtWidgets.QFileDialog.getSaveFileName(None,
+                                                                       QtWidgets.QApplication.translate("MainWindow",
+                                                                                                        'Choose file name'),
+                                                                       curr_directory(),
+                                                                       filter=';;'.join(extensions),
+                                                                       options=QtWidgets.QFileDialog.ShowDirsOnly | QtWidgets.QFileDialog.DontUseNativeDialog)
 
         if file_name:
+            extension = file_filter if file_filter in extensions else extensions[0]
             if not file_name.endswith('.' + extension):
                 file_name += '.' + extension
-            with open(file_name, 'wt') as fl:
-                fl.write(s)
+            dialog = ExportRangeDialog()
+            if not dialog.exec_():
+                return
+            start, end = dialog.get_range()
+            progress = QtWidgets.QProgressDialog(QtWidgets.QApplication.translate("MainWindow", 'Exporting history...'),
+                                                 None, 0, 0)
+            progress.setWindowModality(QtCore.Qt.ApplicationModal)
+            progress.show()
+
+            def update_progress(count, total):
+                progress.setMaximum(total)
+                progress.setValue(count)
+                QtWidgets.QApplication.processEvents()
+
+            self.profile.export_history_to_file(file_name, extension, num, start, end, update_progress)
+            progress.close()
 
     def set_alias(self, num):
         self.profile.set_alias(num)
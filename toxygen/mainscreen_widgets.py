@@ -4,6 +4,7 @@ from profile import Profile
 import smileys
 import util
 import platform
+import os
 
 
 class MessageArea(QtWidgets.QPlainTextEdit):
@@ -62,8 +63,13 @@ class MessageArea(QtWidgets.QPlainTextEdit):
             e.accept()
             self.pasteEvent(e.mimeData().text())
         elif e.mimeData().hasUrls():
-            for url in e.mimeData().urls():
-                self.pasteEvent(url.toString())
+            urls = list(map(lambda u: u.toString(), e.mimeData().urls()))
+            files = list(filter(lambda u: u.startswith('file://'), urls))
+            if len(files) > 1:  # several files are sent as batch
+                self.parent.profile.send_files_batch(list(map(self.parse_file_name, files)))
+                urls = list(filter(lambda u: not u.startswith('file://'), urls))
+            for url in urls:
+                self.pasteEvent(url)
             e.accept()
         else:
             e.ignore()
@@ -72,7 +78,10 @@ class MessageArea(QtWidgets.QPlainTextEdit):
         text = text or QtWidgets.QApplication.clipboard().text()
         if text.startswith('file://'):
             file_name = self.parse_file_name(text)
-            self.parent.profile.send_file(file_name)
+            if os.path.isdir(file_name):
+                self.parent.profile.send_files_batch([file_name])
+            else:
+                self.parent.profile.send_file(file_name)
         else:
             self.insertPlainText(text)
 
@@ -457,9 +466,13 @@ class SearchScreen(QtWidgets.QWidget):
         if index is not None:
             profile = Profile.get_instance()
             count = self._messages.count()
-            while count + index < 0:
+            while count + index < 0:  # found message is already in corr, only items are created here
                 profile.load_history()
+                if count == self._messages.count():
+                    break
                 count = self._messages.count()
+            if count + index < 0:
+                return
             index += count
             item = self._messages.item(index)
             self._messages.scrollToItem(item)
@@ -482,3 +495,37 @@ class SearchScreen(QtWidgets.QWidget):
         mbox.setWindowTitle(QtWidgets.QApplication.translate("MainWindow",
                                                              'Not found'))
         mbox.exec_()
+
+
+class ExportRangeDialog(QtWidgets.QDialog):
+    """
+    Choosing of time range of exported messages
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.setWindowTitle(QtWidgets.QApplication.translate("MainWindow", 'Time range of exported messages'))
+        layout = QtWidgets.QGridLayout(self)
+        now = QtCore.QDateTime.currentDateTime()
+        self.use_start = QtWidgets.QCheckBox(QtWidgets.QApplication.translate("MainWindow", 'From:'), self)
+        self.start = QtWidgets.QDateTimeEdit(now.addMonths(-1), self)
+        self.use_end = QtWidgets.QCheckBox(QtWidgets.QApplication.translate("MainWindow", 'To:'), self)
+        self.end = QtWidgets.QDateTimeEdit(now, self)
+        for row, (check_box, edit) in enumerate(((self.use_start, self.start), (self.use_end, self.end))):
+            edit.setCalendarPopup(True)
+            edit.setEnabled(False)
+            check_box.toggled.connect(edit.setEnabled)
+            layout.addWidget(check_box, row, 0)
+            layout.addWidget(edit, row, 1)
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons, 2, 0, 1, 2)
+
+    def get_range(self):
+        """
+        :return: tuple (start, end) - unix time of oldest and newest exported messages, None if range isn't limited
+        """
+        start = self.start.dateTime().toMSecsSinceEpoch() / 1000 if self.use_start.isChecked() else None
+        end = self.end.dateTime().toMSecsSinceEpoch() / 1000 if self.use_end.isChecked() else None
+        return start, end
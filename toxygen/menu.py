@@ -285,7 +285,7 @@ class ProfileSettings(CenteredWidget):
 
 
 class NetworkSettings(CenteredWidget):
-    """Network settings form: UDP, Ipv6 and proxy"""
+    """Network settings form: UDP, Ipv6, proxy and limits of speed of file transfers"""
     def __init__(self, reset):
         super(NetworkSettings, self).__init__()
         self.reset = reset
@@ -294,10 +294,10 @@ class NetworkSettings(CenteredWidget):
 
     def initUI(self):
         self.setObjectName("NetworkSettings")
-        self.resize(300, 400)
-        self.setMinimumSize(QtCore.QSize(300, 400))
-        self.setMaximumSize(QtCore.QSize(300, 400))
-        self.setBaseSize(QtCore.QSize(300, 400))
+        self.resize(300, 500)
+        self.setMinimumSize(QtCore.QSize(300, 500))
+        self.setMaximumSize(QtCore.QSize(300, 500))
+        self.setBaseSize(QtCore.QSize(300, 500))
         self.ipv = QtWidgets.QCheckBox(self)
         self.ipv.setGeometry(QtCore.QRect(20, 10, 97, 22))
         self.ipv.setObjectName("ipv")
@@ -335,6 +335,17 @@ class NetworkSettings(CenteredWidget):
         self.nodes = QtWidgets.QCheckBox(self)
         self.nodes.setGeometry(QtCore.QRect(20, 350, 270, 22))
         self.nodes.setChecked(settings['download_nodes_list'])
+        self.speed_labels, self.speed_limits = [], []
+        for i, key in enumerate(('upload_speed_limit', 'download_speed_limit', 'call_speed_limit')):
+            label = QtWidgets.QLabel(self)
+            label.setGeometry(QtCore.QRect(20, 385 + i * 35, 150, 27))
+            self.speed_labels.append(label)
+            limit = QtWidgets.QSpinBox(self)
+            limit.setGeometry(QtCore.QRect(170, 385 + i * 35, 110, 27))
+            limit.setRange(0, 1000000)
+            limit.setSuffix(' KB/s')
+            limit.setValue(settings[key])
+            self.speed_limits.append(limit)
         self.retranslateUi()
         self.proxy.stateChanged.connect(lambda x: self.activate())
         self.activate()
@@ -351,6 +362,10 @@ class NetworkSettings(CenteredWidget):
         self.http.setText(QtWidgets.QApplication.translate("Form", "HTTP"))
         self.nodes.setText(QtWidgets.QApplication.translate("Form", "Download nodes list from tox.chat"))
         self.warning.setText(QtWidgets.QApplication.translate("Form", "WARNING:\nusing proxy with enabled UDP\ncan produce IP leak"))
+        for label, text in zip(self.speed_labels, ("Upload limit:", "Download limit:", "Limit during call:")):
+            label.setText(QtWidgets.QApplication.translate("NetworkSettings", text))
+        for limit in self.speed_limits:
+            limit.setSpecialValueText(QtWidgets.QApplication.translate("NetworkSettings", "Unlimited"))
 
     def activate(self):
         bl = self.proxy.isChecked()
@@ -374,6 +389,13 @@ class NetworkSettings(CenteredWidget):
         except Exception as ex:
             log('Exception in restart: ' + str(ex))
 
+    def closeEvent(self, event):
+        settings = Settings.get_instance()
+        for key, limit in zip(('upload_speed_limit', 'download_speed_limit', 'call_speed_limit'), self.speed_limits):
+            settings[key] = limit.value()
+        settings.save()
+        Profile.get_instance().update_speed_limits()
+
 
 class PrivacySettings(CenteredWidget):
     """Privacy settings form: history, typing notifications"""
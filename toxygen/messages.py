@@ -1,3 +1,4 @@
+from array import array
 
 
 MESSAGE_TYPE = {
@@ -13,6 +14,8 @@ MESSAGE_TYPE = {
 
 class Message:
 
+    __slots__ = ('_time', '_type', '_owner')
+
     def __init__(self, message_type, owner, time):
         self._time = time
         self._type = message_type
@@ -24,6 +27,9 @@ class Message:
     def get_owner(self):
         return self._owner
 
+    def get_time(self):
+        return self._time
+
     def mark_as_sent(self):
         self._owner = 0
 
@@ -33,6 +39,8 @@ class TextMessage(Message):
     Plain text or action message
     """
 
+    __slots__ = ('_message', )
+
     def __init__(self, message, owner, time, message_type):
         super(TextMessage, self).__init__(message_type, owner, time)
         self._message = message
@@ -43,6 +51,8 @@ class TextMessage(Message):
 
 class GroupChatMessage(TextMessage):
 
+    __slots__ = ('_user_name', )
+
     def __init__(self, message, owner, time, message_type, name):
         super().__init__(message, owner, time, message_type)
         self._user_name = name
@@ -56,6 +66,8 @@ class TransferMessage(Message):
     Message with info about file transfer
     """
 
+    __slots__ = ('_status', '_size', '_file_name', '_friend_number', '_file_number')
+
     def __init__(self, owner, time, status, size, name, friend_number, file_number):
         super(TransferMessage, self).__init__(MESSAGE_TYPE['FILE_TRANSFER'], owner, time)
         self._status = status
@@ -83,6 +95,9 @@ class TransferMessage(Message):
 
 
 class UnsentFile(Message):
+
+    __slots__ = ('_data', '_path')
+
     def __init__(self, path, data, time):
         super(UnsentFile, self).__init__(MESSAGE_TYPE['FILE_TRANSFER'], 0, time)
         self._data, self._path = data, path
@@ -99,6 +114,8 @@ class InlineImage(Message):
     Inline image
     """
 
+    __slots__ = ('_data', )
+
     def __init__(self, data):
         super(InlineImage, self).__init__(MESSAGE_TYPE['INLINE'], None, None)
         self._data = data
@@ -109,5 +126,216 @@ class InlineImage(Message):
 
 class InfoMessage(TextMessage):
 
+    __slots__ = ()
+
     def __init__(self, message, time):
         super(InfoMessage, self).__init__(message, None, time, MESSAGE_TYPE['INFO_MESSAGE'])
+
+
+class Corr:
+    """
+    Messages of contact. Time, owner and type of every message are stored in arrays, text of text and info messages -
+    in list, so these messages don't need objects. Other messages (file transfers, inline images, group chat messages)
+    are stored as objects. Message objects for text messages are created on access, so changes of them are not stored.
+    Stored messages are changed only by Corr methods (mark_as_sent, set_transfer_status) - counters of text and unsent
+    messages are updated on every change
+    """
+
+    __slots__ = ('_times', '_owners', '_types', '_texts', '_objects', '_text_count', '_unsent_count')
+
+    def __init__(self, messages=()):
+        self._times, self._owners, self._types = array('d'), array('b'), array('b')
+        self._texts, self._objects = [], []
+        self._text_count = self._unsent_count = 0
+        self.extend(messages)
+
+    def __len__(self):
+        return len(self._types)
+
+    def __iter__(self):
+        return map(self._get_message, range(len(self._types)))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(map(self._get_message, range(len(self._types))[key]))
+        return self._get_message(key)
+
+    def __delitem__(self, key):
+        indexes = range(len(self._types))[key]
+        if not isinstance(key, slice):
+            indexes = (indexes, )
+        for i in indexes:
+            self._count(self._types[i], self._owners[i], -1)
+        for column in (self._times, self._owners, self._types, self._texts, self._objects):
+            del column[key]
+
+    @staticmethod
+    def _row(message):
+        """
+        :return: tuple (time, owner, type, text, object) - values of columns for message
+        """
+        message_time, owner = message.get_time(), message.get_owner()
+        message_time = message_time if message_time is not None else float('nan')
+        owner = owner if owner is not None else -1
+        if type(message) in (TextMessage, InfoMessage):
+            return message_time, owner, message.get_type(), message.get_data()[0], None
+        return message_time, owner, message.get_type(), None, message
+
+    def _get_message(self, i):
+        message = self._objects[i]
+        if message is not None:
+            return message
+        message_type = self._types[i]
+        if message_type == MESSAGE_TYPE['INFO_MESSAGE']:
+            return InfoMessage(self._texts[i], self._times[i])
+        return TextMessage(self._texts[i], self._owners[i], self._times[i], message_type)
+
+    def _count(self, message_type, owner, delta):
+        if message_type <= 1:
+            self._text_count += delta
+        if owner == 2:  # not sent
+            self._unsent_count += delta
+
+    def append(self, message):
+        row = self._row(message)
+        for column, value in zip((self._times, self._owners, self._types, self._texts, self._objects), row):
+            column.append(value)
+        self._count(row[2], row[1], 1)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def insert(self, index, message):
+        row = self._row(message)
+        for column, value in zip((self._times, self._owners, self._types, self._texts, self._objects), row):
+            column.insert(index, value)
+        self._count(row[2], row[1], 1)
+
+    def prepend(self, messages):
+        """
+        Add older messages to the beginning
+        """
+        corr = Corr(messages)
+        self._times = corr._times + self._times
+        self._owners = corr._owners + self._owners
+        self._types = corr._types + self._types
+        self._texts = corr._texts + self._texts
+        self._objects = corr._objects + self._objects
+        self._text_count += corr._text_count
+        self._unsent_count += corr._unsent_count
+
+    def filter(self, predicate):
+        """
+        :return: new Corr with messages which satisfy predicate
+        """
+        return Corr(filter(predicate, self))
+
+    def get_objects(self):
+        """
+        :return: list of messages stored as objects (file transfers, inline images, group chat messages)
+        """
+        return [message for message in self._objects if message is not None]
+
+    def remove_objects(self, predicate):
+        """
+        Remove messages stored as objects which satisfy predicate
+        """
+        for i in range(len(self._objects) - 1, -1, -1):
+            if self._objects[i] is not None and predicate(self._objects[i]):
+                del self[i]
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Columns
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def get_type(self, i):
+        return self._types[i]
+
+    def get_owner(self, i):
+        return self._owners[i]
+
+    def get_time(self, i):
+        return self._times[i]
+
+    def get_text(self, i):
+        """
+        :return: text of text or info message, None for other messages
+        """
+        return self._texts[i]
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Counters
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def get_text_count(self):
+        """
+        :return: count of text messages (plain text and actions)
+        """
+        return self._text_count
+
+    def get_unsent_count(self):
+        return self._unsent_count
+
+    def get_last_text_messages(self, count):
+        """
+        :return: list of data of last count text messages, oldest first
+        """
+        result = []
+        i = len(self._types) - 1
+        while len(result) < count and i >= 0:
+            if self._types[i] <= 1:
+                result.append((self._texts[i], self._owners[i], self._times[i], self._types[i]))
+            i -= 1
+        result.reverse()
+        return result
+
+    def get_unsent_indexes(self):
+        """
+        :return: indexes of unsent messages, oldest first. Messages are searched from the end
+        """
+        result = []
+        i = len(self._types) - 1
+        while len(result) < self._unsent_count and i >= 0:
+            if self._owners[i] == 2:
+                result.append(i)
+            i -= 1
+        result.reverse()
+        return result
+
+    def mark_as_sent(self):
+        """
+        Mark oldest unsent message as sent
+        :return: True if unsent message was found
+        """
+        indexes = self.get_unsent_indexes()
+        if not indexes:
+            self._unsent_count = 0
+            return False
+        i = indexes[0]
+        self._owners[i] = 0
+        if self._objects[i] is not None:
+            self._objects[i].mark_as_sent()
+        self._unsent_count -= 1
+        return True
+
+    def set_transfer_status(self, file_number, status):
+        """
+        Set status of active file transfer
+        :return: index of transfer message or None if there is no active transfer with this file number
+        """
+        for i, message in enumerate(self._objects):
+            if type(message) is TransferMessage and message.is_active(file_number):
+                message.set_status(status)
+                return i
+        return None
+
+    def get_last_text(self, owner):
+        """
+        :param owner: owner of messages which should be skipped
+        :return: text of last text message with other owner or ''
+        """
+        for i in range(len(self._types) - 1, -1, -1):
+            if self._types[i] <= 1 and self._owners[i] != owner:
+                return self._texts[i]
+        return ''
@@ -13,9 +13,9 @@ import calls
 import avwidgets
 import plugin_support
 import basecontact
+import history_export
+from transfers_scheduler import TransfersScheduler
 import items_factory
-import cv2
-import threading
 from group_chat import *
 import re
 
@@ -39,8 +39,14 @@ class Profile(basecontact.BaseContact, Singleton):
         self._messages = screen.messages
         self._tox = tox
         self._file_transfers = {}  # dict of file transfers. key - tuple (friend_number, file_number)
+        # key - file id, value - tuple (path, friend number, time). Used for re-sending corrupted parts
+        self._sent_files = {}
+        self._verifications = {}  # key - file id, value - dict with data about verification of incoming file
+        self._manifests = {}  # key - tuple (friend number, file id), value - path of incoming file in sent directory
         self._call = calls.AV(tox.AV)  # object with data about calls
         self._call_widgets = {}  # dict of incoming call widgets
+        self._video_widgets = {}  # dict of widgets which show incoming video
+        self._flushed_unsent = {}  # key - tox id, value - time of first unsent message passed to journal or None
         self._incoming_calls = set()
         self._load_history = True
         self._waiting_for_reconnection = False
@@ -50,8 +56,17 @@ class Profile(basecontact.BaseContact, Singleton):
         self._show_avatars = settings['show_avatars']
         self._filter_string = ''
         self._friend_item_height = 40 if settings['compact_mode'] else 70
-        self._paused_file_transfers = dict(settings['paused_file_transfers'])
-        # key - file id, value: [path, friend number, is incoming, start position]
+        self._resumable_transfers = ResumableTransfers(ProfileHelper.get_path() + tox.self_get_public_key() +
+                                                       '.transfers')
+        if not settings['resend_files']:
+            self._resumable_transfers.clear()
+        self._resumable_transfers.import_paused(settings['paused_file_transfers'])
+        self._resumable_transfers.save()
+        settings['paused_file_transfers'] = {}
+        self._shaper = BandwidthShaper(lambda: hasattr(self, '_call') and self._call.has_active_calls())
+        self._scheduler = TransfersScheduler(self._start_scheduled_transfer,
+                                             lambda n: self.get_friend_by_number(n).status is not None,
+                                             settings['max_transfers_per_friend'], settings['max_transfers'])
         screen.online_contacts.setCurrentIndex(int(self._sorting))
         aliases = settings['friends_aliases']
         data = tox.self_get_friend_list()
@@ -75,6 +90,18 @@ class Profile(basecontact.BaseContact, Singleton):
         if len(self._contacts):
             self.set_active(0)
         self.filtration_and_sorting(self._sorting)
+        self.update_speed_limits()
+        self._history.start_journal()
+        self._history_timer = QtCore.QTimer()  # new messages are saved during session, not only on exit
+        self._history_timer.timeout.connect(self.flush_history)
+        self._history_timer.start(JOURNAL_INTERVAL * 1000)
+        self._transfers_timer = QtCore.QTimer()  # positions of incoming transfers are saved for resuming after crash
+        self._transfers_timer.timeout.connect(self.save_transfers_positions)
+        self._transfers_timer.timeout.connect(self.remove_old_verifications)
+        self._transfers_timer.start(TRANSFERS_SAVE_INTERVAL * 1000)
+        self._call_stats_timer = QtCore.QTimer()
+        self._call_stats_timer.timeout.connect(self.update_call_stats)
+        self._call_stats_timer.start(1000)
 
     # -----------------------------------------------------------------------------------------------------------------
     # Edit current user's data
@@ -234,7 +261,8 @@ class Profile(basecontact.BaseContact, Singleton):
                     friend.delete_old_messages()
                 self._messages.clear()
                 friend.load_corr()
-                messages = friend.get_corr()[-PAGE_SIZE:]
+                self.shrink_messages_cache()
+                messages = friend.get_corr(-PAGE_SIZE)
                 self._load_history = False
                 for message in messages:
                     if message.get_type() <= 1:
@@ -354,13 +382,15 @@ class Profile(basecontact.BaseContact, Singleton):
                 else:
                     self.send_file(data[0], friend_number, True)
             friend.clear_unsent_files()
-            for key in list(self._paused_file_transfers.keys()):
-                data = self._paused_file_transfers[key]
-                if not os.path.exists(data[0]):
-                    del self._paused_file_transfers[key]
-                elif data[1] == friend_number and not data[2]:
-                    self.send_file(data[0], friend_number, True, key)
-                    del self._paused_file_transfers[key]
+            active = set(map(lambda ft: ft.get_id(), self._file_transfers.values()))
+            resumed = []
+            for key, data in self._resumable_transfers.items():
+                if not os.path.exists(data['path']):
+                    self._resumable_transfers.remove(key)
+                elif data['friend_number'] == friend_number and not data['incoming'] and key not in active \
+                        and key not in self._scheduler:
+                    resumed.append((data['path'], data['size'], key, None))
+            self._scheduler.add(friend_number, resumed)
             if friend_number == self.get_active_number() and self.is_active_a_friend():
                 self.update()
         except Exception as ex:
@@ -377,11 +407,15 @@ class Profile(basecontact.BaseContact, Singleton):
         for friend_num, file_num in list(self._file_transfers.keys()):
             if friend_num == friend_number:
                 ft = self._file_transfers[(friend_num, file_num)]
-                if type(ft) is SendTransfer:
-                    self._paused_file_transfers[ft.get_id()] = [ft.get_path(), friend_num, False, -1]
-                elif type(ft) is ReceiveTransfer and ft.state != TOX_FILE_TRANSFER_STATE['INCOMING_NOT_STARTED']:
-                    self._paused_file_transfers[ft.get_id()] = [ft.get_path(), friend_num, True, ft.total_size()]
+                data = self._resumable_transfers.get(ft.get_id())
+                verification = self._verifications.get(ft.get_id()), self._sent_files.get(ft.get_id())
                 self.cancel_transfer(friend_num, file_num, True)
+                if data is not None:  # transfer will be resumed when friend is online
+                    self._restore_verification(ft.get_id(), *verification)
+                    incoming = type(ft) is ReceiveTransfer
+                    self._resumable_transfers.add(ft.get_id(), data['path'], friend_num, data['incoming'],
+                                                  data['size'], ft.total_size() if incoming else 0, data.get('end'),
+                                                  ft.get_saved_hashes() if incoming else None)
 
     # -----------------------------------------------------------------------------------------------------------------
     # Typing notifications
@@ -507,6 +541,7 @@ class Profile(basecontact.BaseContact, Singleton):
     def delete_message(self, time):
         friend = self.get_curr_friend()
         friend.delete_message(time)
+        self._history.flush()
         self._history.delete_message(friend.tox_id, time)
         self.update()
 
@@ -514,25 +549,68 @@ class Profile(basecontact.BaseContact, Singleton):
     # History support
     # -----------------------------------------------------------------------------------------------------------------
 
+    def flush_history(self):
+        """
+        Pass new messages to write-behind journal of history
+        """
+        s = Settings.get_instance()
+        if not hasattr(self, '_history') or not s['save_history'] or s['save_unsent_only']:
+            return
+        writes = []
+        for friend in filter(lambda x: type(x) is Friend, self._contacts):
+            messages = friend.get_corr_for_saving()
+            unsent_messages = friend.get_unsent_messages()
+            first_unsent = unsent_messages[0].get_data()[2] if len(unsent_messages) else None
+            unsent_changed = self._flushed_unsent.get(friend.tox_id) != first_unsent  # some messages were delivered
+            if not messages and not unsent_changed:
+                continue
+            if messages:
+                friend.mark_corr_as_saved()
+                writes.append((self._history.save_messages_to_db, (friend.tox_id, messages)))
+            self._flushed_unsent[friend.tox_id] = first_unsent
+            unsent_time = first_unsent if first_unsent is not None else time.time() + 1
+            writes.append((self._history.update_messages, (friend.tox_id, unsent_time)))
+        if writes:
+            self._history.write_later(writes)
+            self.shrink_messages_cache()
+
+    def shrink_messages_cache(self):
+        """
+        Unload old messages of least recently used contacts if too many messages are loaded. Messages of active
+        contact are never unloaded
+        """
+        count = sum(map(lambda x: x.get_corr_size(), self._contacts))
+        if count <= MESSAGES_CACHE_SIZE:
+            return
+        active = self.get_curr_friend()
+        for contact in sorted(self._contacts, key=lambda x: x.get_last_used()):
+            if contact is not active:
+                count -= contact.unload_old_messages(count - MESSAGES_CACHE_SIZE)
+                if count <= MESSAGES_CACHE_SIZE:
+                    break
+
     def save_history(self):
         """
         Save history to db
         """
         s = Settings.get_instance()
         if hasattr(self, '_history'):
+            self._history_timer.stop()
+            self._history.stop_journal()
             if s['save_history']:
-                for friend in filter(lambda x: type(x) is Friend, self._contacts):
-                    if not self._history.friend_exists_in_db(friend.tox_id):
-                        self._history.add_friend_to_db(friend.tox_id)
-                    if not s['save_unsent_only']:
-                        messages = friend.get_corr_for_saving()
-                    else:
-                        messages = friend.get_unsent_messages_for_saving()
-                        self._history.delete_messages(friend.tox_id)
-                    self._history.save_messages_to_db(friend.tox_id, messages)
-                    unsent_messages = friend.get_unsent_messages()
-                    unsent_time = unsent_messages[0].get_data()[2] if len(unsent_messages) else time.time() + 1
-                    self._history.update_messages(friend.tox_id, unsent_time)
+                with self._history.transaction():
+                    for friend in filter(lambda x: type(x) is Friend, self._contacts):
+                        if not self._history.friend_exists_in_db(friend.tox_id):
+                            self._history.add_friend_to_db(friend.tox_id)
+                        if not s['save_unsent_only']:
+                            messages = friend.get_corr_for_saving()
+                        else:
+                            messages = friend.get_unsent_messages_for_saving()
+                            self._history.delete_messages(friend.tox_id)
+                        self._history.save_messages_to_db(friend.tox_id, messages)
+                        unsent_messages = friend.get_unsent_messages()
+                        unsent_time = unsent_messages[0].get_data()[2] if len(unsent_messages) else time.time() + 1
+                        self._history.update_messages(friend.tox_id, unsent_time)
             self._history.save()
             del self._history
 
@@ -541,6 +619,7 @@ class Profile(basecontact.BaseContact, Singleton):
         Clear chat history
         """
         if num is not None:
+            self._history.flush()
             friend = self._contacts[num]
             friend.clear_corr(save_unsent)
             if self._history.friend_exists_in_db(friend.tox_id):
@@ -560,12 +639,14 @@ class Profile(basecontact.BaseContact, Singleton):
             return
         self._load_history = False
         friend = self.get_curr_friend()
-        friend.load_corr(False)
-        data = friend.get_corr()
-        if not data:
+        count = self._messages.count()
+        if friend.get_corr_size() < count + PAGE_SIZE:  # not enough loaded messages
+            friend.load_corr(False)
+        size = friend.get_corr_size()
+        if not size:
             return
+        data = friend.get_corr(max(size - count - PAGE_SIZE, 0), max(size - count, 0))
         data.reverse()
-        data = data[self._messages.count():self._messages.count() + PAGE_SIZE]
         for message in data:
             if message.get_type() <= 1:  # text message
                 data = message.get_data()
@@ -601,14 +682,38 @@ class Profile(basecontact.BaseContact, Singleton):
         self._load_history = True
 
     def export_db(self, directory):
+        self._history.flush()
         self._history.export(directory)
 
-    def export_history(self, num, as_text=True, _range=None):
+    def export_history_to_file(self, path, export_format, num=None, start=None, end=None, progress=None):
+        """
+        Export history of contact or of all friends to file. Messages are streamed from db, not loaded in memory
+        :param path: path to file
+        :param export_format: 'txt', 'html', 'jsonl' or 'csv'
+        :param num: number of contact in list or None to export history of all friends
+        :param start: unix time of oldest exported message or None
+        :param end: unix time of newest exported message or None
+        :param progress: callable with args (count of exported messages, total count) or None
+        """
+        self.flush_history()
+        self._history.flush()
+        if num is None:
+            contacts = filter(lambda x: type(x) is Friend, self._contacts)
+        else:
+            contacts = [self._contacts[num]]
+        contacts = list(map(lambda x: (x.name, x.tox_id, x.get_corr_for_saving()), contacts))
+        if not contacts:
+            return
+        with open(path, 'wt', encoding='utf-8', newline='' if export_format == 'csv' else None) as fl:
+            history_export.export_history(self._history, fl, export_format, self.name, contacts, start, end, progress)
+
+    def export_history(self, num, as_text, _range):
+        """
+        Export selected loaded messages of contact to string
+        :param _range: tuple (first, last) - indexes of exported messages
+        """
         friend = self._contacts[num]
-        if _range is None:
-            friend.load_all_corr()
-            corr = friend.get_corr()
-        elif _range[1] + 1:
+        if _range[1] + 1:
             corr = friend.get_corr()[_range[0]:_range[1] + 1]
         else:
             corr = friend.get_corr()[_range[0]:]
@@ -746,6 +851,7 @@ class Profile(basecontact.BaseContact, Singleton):
         self.clear_history(num)
         if self._history.friend_exists_in_db(friend.tox_id):
             self._history.delete_friend_from_db(friend.tox_id)
+        self._scheduler.remove_friend(friend.number)
         self._tox.friend_delete(friend.number)
         del self._contacts[num]
         self._screen.friends_list.takeItem(num)
@@ -886,6 +992,7 @@ class Profile(basecontact.BaseContact, Singleton):
         self.status = None
         for friend in self._contacts:
             friend.number = self._tox.friend_by_public_key(friend.tox_id)  # numbers update
+        self.update_speed_limits()
         self.update_filtration()
 
     def reconnect(self):
@@ -903,8 +1010,12 @@ class Profile(basecontact.BaseContact, Singleton):
         if hasattr(self, '_call'):
             self._call.stop()
             del self._call
+        self._transfers_timer.stop()
+        self._call_stats_timer.stop()
         s = Settings.get_instance()
-        s['paused_file_transfers'] = dict(self._paused_file_transfers) if s['resend_files'] else {}
+        if not s['resend_files']:
+            self._resumable_transfers.clear()
+        self._resumable_transfers.save(True)
         s.save()
 
     # -----------------------------------------------------------------------------------------------------------------
@@ -925,14 +1036,14 @@ class Profile(basecontact.BaseContact, Singleton):
         inline = is_inline(file_name) and settings['allow_inline']
         file_id = self._tox.file_get_file_id(friend_number, file_number)
         accepted = True
-        if file_id in self._paused_file_transfers:
-            data = self._paused_file_transfers[file_id]
-            pos = data[-1] if os.path.exists(data[0]) else 0
+        data = self._resumable_transfers.get(file_id)
+        if data is not None and data['incoming']:
+            pos = data['position'] if os.path.exists(data['path']) else 0
             if pos >= size:
                 self._tox.file_control(friend_number, file_number, TOX_FILE_CONTROL['CANCEL'])
                 return
             self._tox.file_seek(friend_number, file_number, pos)
-            self.accept_transfer(None, data[0], friend_number, file_number, size, False, pos)
+            self.accept_transfer(None, data['path'], friend_number, file_number, size, False, pos, data.get('end'))
             tm = TransferMessage(MESSAGE_OWNER['FRIEND'],
                                  time.time(),
                                  TOX_FILE_TRANSFER_STATE['RUNNING'],
@@ -940,7 +1051,7 @@ class Profile(basecontact.BaseContact, Singleton):
                                  file_name,
                                  friend_number,
                                  file_number)
-        elif inline and size < 1024 * 1024:
+        elif inline and size < settings['inline_size_limit']:
             self.accept_transfer(None, '', friend_number, file_number, size, True)
             tm = TransferMessage(MESSAGE_OWNER['FRIEND'],
                                  time.time(),
@@ -990,6 +1101,9 @@ class Profile(basecontact.BaseContact, Singleton):
                                                                           TOX_FILE_TRANSFER_STATE['CANCELLED'])
         if (friend_number, file_number) in self._file_transfers:
             tr = self._file_transfers[(friend_number, file_number)]
+            self._resumable_transfers.remove(tr.get_id())
+            self._scheduler.transfer_finished(tr.get_id())
+            self._remove_verification(tr.get_id())
             if not already_cancelled:
                 tr.cancel()
             else:
@@ -1033,7 +1147,8 @@ class Profile(basecontact.BaseContact, Singleton):
         else:
             tr.send_control(TOX_FILE_CONTROL['RESUME'])
 
-    def accept_transfer(self, item, path, friend_number, file_number, size, inline=False, from_position=0):
+    def accept_transfer(self, item, path, friend_number, file_number, size, inline=False, from_position=0,
+                        to_position=None):
         """
         :param item: transfer item.
         :param path: path for saving
@@ -1042,10 +1157,16 @@ class Profile(basecontact.BaseContact, Singleton):
         :param size: file size
         :param inline: is inline image
         :param from_position: position for start
+        :param to_position: position for end (re-fetch of corrupted part) or None
         """
+        relative_path = self._manifests.pop((friend_number, self._tox.file_get_file_id(friend_number, file_number)),
+                                            None)
+        if relative_path is not None and not from_position and to_position is None:  # file from directory
+            path = os.path.join(os.path.dirname(path), relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
         path, file_name = os.path.split(path)
         new_file_name, i = file_name, 1
-        if not from_position:
+        if not from_position and to_position is None:
             while os.path.isfile(path + '/' + new_file_name):  # file with same name already exists
                 if '.' in file_name:  # has extension
                     d = file_name.rindex('.')
@@ -1055,7 +1176,15 @@ class Profile(basecontact.BaseContact, Singleton):
                 i += 1
         path = os.path.join(path, new_file_name)
         if not inline:
-            rt = ReceiveTransfer(path, self._tox, friend_number, size, file_number, from_position)
+            rt = ReceiveTransfer(path, self._tox, friend_number, size, file_number, from_position, to_position)
+            saved = self._resumable_transfers.get(rt.get_id())
+            hashes = saved.get('hashes', {}) if saved is not None and from_position and to_position is None else {}
+            if Settings.get_instance()['verify_file_transfers']:
+                rt.enable_verification()
+                rt.set_saved_hashes(hashes)
+            self._resumable_transfers.add(rt.get_id(), path, friend_number, True, size, from_position, to_position,
+                                          hashes)
+            rt.set_shaper(self._shaper)
         else:
             rt = ReceiveToBuffer(self._tox, friend_number, size, file_number)
         rt.set_transfer_finished_handler(self.transfer_finished)
@@ -1124,6 +1253,11 @@ class Profile(basecontact.BaseContact, Singleton):
             raise RuntimeError()
         st = SendTransfer(path, self._tox, friend_number, TOX_FILE_KIND['DATA'], file_id)
         st.set_transfer_finished_handler(self.transfer_finished)
+        self._resumable_transfers.add(st.get_id(), path, friend_number, False, os.path.getsize(path))
+        if Settings.get_instance()['verify_file_transfers']:
+            st.enable_verification()
+            self._sent_files[st.get_id()] = (path, friend_number, time.time())
+        st.set_shaper(self._shaper)
         self._file_transfers[(friend_number, st.get_file_number())] = st
         tm = TransferMessage(MESSAGE_OWNER['ME'],
                              time.time(),
@@ -1138,6 +1272,61 @@ class Profile(basecontact.BaseContact, Singleton):
             self._messages.scrollToBottom()
         self._contacts[friend_number].append_message(tm)
 
+    def update_speed_limits(self):
+        """
+        Apply limits of speed of file transfers from settings
+        """
+        s = Settings.get_instance()
+        friends_limits = {}
+        for friend in filter(lambda x: type(x) is Friend, self._contacts):
+            if friend.tox_id in s['friends_speed_limits']:
+                friends_limits[friend.number] = s['friends_speed_limits'][friend.tox_id] * 1024
+        self._shaper.set_limits(s['upload_speed_limit'] * 1024, s['download_speed_limit'] * 1024, friends_limits,
+                                s['call_speed_limit'] * 1024)
+
+    def send_files_batch(self, paths, number=None):
+        """
+        Send files and directories to friend. Files are queued and sent by scheduler. Paths of files in directories
+        are sent to friend before files, so directories tree can be recreated
+        :param paths: list of paths of files and directories
+        :param number: friend_number
+        """
+        friend_number = self.get_active_number() if number is None else number
+        files = []  # tuples (path, path relative to parent of sent directory)
+        for path in paths:
+            if os.path.isdir(path):
+                parent = os.path.dirname(os.path.normpath(path))
+                for root, dirs, file_names in os.walk(path):
+                    for file_name in file_names:
+                        file_path = os.path.join(root, file_name)
+                        files.append((file_path, os.path.relpath(file_path, parent)))
+            elif os.path.isfile(path):
+                files.append((path, None))
+        queued = []  # files of offline friend wait in scheduler until friend is online
+        for path, relative_path in files:
+            file_id = os.urandom(TOX_FILE_ID_LENGTH).hex().upper()
+            queued.append((path, os.path.getsize(path), file_id, relative_path))
+        self._scheduler.add(friend_number, queued)
+
+    def _start_scheduled_transfer(self, friend_number, path, file_id, relative_path):
+        """
+        Path of file relative to sent directory is sent to friend right before file. If packets queue is full,
+        transfer is postponed
+        """
+        if relative_path is not None:
+            try:
+                self._tox.friend_send_lossless_packet(friend_number, manifest_packet(file_id, relative_path))
+            except Exception as ex:
+                log('Sending of manifest failed: ' + str(ex))
+                QtCore.QTimer.singleShot(SCHEDULER_RETRY_INTERVAL, self._scheduler.schedule)
+                return None
+        try:
+            self.send_file(path, friend_number, True, file_id)
+            return True
+        except Exception as ex:
+            log('Exception in file sending: ' + str(ex))
+            return False
+
     def incoming_chunk(self, friend_number, file_number, position, data):
         """
         Incoming chunk
@@ -1150,6 +1339,23 @@ class Profile(basecontact.BaseContact, Singleton):
         """
         self._file_transfers[(friend_number, file_number)].send_chunk(position, size)
 
+    def transfer_congested(self, friend_number, file_number, congested):
+        """
+        Called from tox or worker thread if too many chunks of transfer are queued or queue was processed
+        """
+        transfer = self._file_transfers.get((friend_number, file_number))
+        if transfer is not None:
+            transfer.set_congested(congested)
+
+    def save_transfers_positions(self):
+        """
+        Save positions from which incoming transfers can be resumed
+        """
+        for ft in list(self._file_transfers.values()):
+            if type(ft) is ReceiveTransfer and ft.state == TOX_FILE_TRANSFER_STATE['RUNNING']:
+                self._resumable_transfers.update(ft.get_id(), ft.get_saved_size(), ft.get_saved_hashes())
+        self._resumable_transfers.save()
+
     def transfer_finished(self, friend_number, file_number):
         transfer = self._file_transfers[(friend_number, file_number)]
         t = type(transfer)
@@ -1175,9 +1381,126 @@ class Profile(basecontact.BaseContact, Singleton):
         elif t is not SendAvatar:
             self.get_friend_by_number(friend_number).update_transfer_data(file_number,
                                                                           TOX_FILE_TRANSFER_STATE['FINISHED'])
+            if transfer.get_id() in self._sent_files:  # friend can request corrupted parts after finish
+                path, number, _ = self._sent_files[transfer.get_id()]
+                self._sent_files[transfer.get_id()] = (path, number, time.time())
+        self._resumable_transfers.remove(transfer.get_id())
+        self._scheduler.transfer_finished(transfer.get_id())
         del self._file_transfers[(friend_number, file_number)]
+        if t is ReceiveTransfer and Settings.get_instance()['verify_file_transfers']:
+            self.transfer_received(transfer)
         del transfer
 
+    # -----------------------------------------------------------------------------------------------------------------
+    # File transfers verification
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def transfer_received(self, transfer):
+        """
+        Incoming file was received. Hashes of its blocks will be compared with hashes computed by friend
+        """
+        if transfer.get_hashes() is None:  # verification was enabled after transfer was started
+            return
+        verification = self._get_verification(transfer.get_id())
+        if verification['hashes'] is None:
+            verification['hashes'] = transfer.get_hashes()
+        else:  # corrupted part was received again
+            verification['hashes'].merge(transfer.get_hashes())
+        verification['path'] = transfer.get_path()
+        verification['friend_number'] = transfer.get_friend_number()
+        verification['size'] = transfer.get_size()
+        self.verify_transfer(transfer.get_id())
+
+    def incoming_transfer_packet(self, friend_number, data):
+        """
+        Friend sent hashes of file, requested corrupted part of file or sent path of file in directory
+        """
+        try:
+            packet_type, file_id, data = parse_transfer_packet(data)
+        except Exception as ex:
+            log('Invalid file transfers packet: ' + str(ex))
+            return
+        if packet_type == TRANSFER_PACKET_TYPE['MANIFEST']:
+            if data:
+                self._manifests[(friend_number, file_id)] = data
+            return
+        if packet_type == TRANSFER_PACKET_TYPE['HASHES']:
+            receiving = any(map(lambda ft: type(ft) is ReceiveTransfer and ft.get_id() == file_id,
+                                self._file_transfers.values()))
+            if receiving or file_id in self._verifications:
+                verification = self._get_verification(file_id)
+                if data is None:  # friend uses other hash algorithm
+                    verification['remote'] = None
+                else:
+                    verification['remote'].update(data)
+                self.verify_transfer(file_id)
+        elif packet_type == TRANSFER_PACKET_TYPE['REFETCH']:
+            path, number, _ = self._sent_files.get(file_id, (None, None, None))
+            if number == friend_number and os.path.exists(path):
+                self.send_file(path, friend_number, True, file_id)
+
+    def verify_transfer(self, file_id):
+        """
+        Compare hashes of received file with hashes from friend. Corrupted part of file is requested again
+        """
+        verification = self._verifications.get(file_id)
+        if verification is None or verification['hashes'] is None:
+            return
+        if verification['remote'] is None:
+            del self._verifications[file_id]
+            log('File can\'t be verified, friend uses other hash algorithm: ' + verification['path'])
+            return
+        count = len(verification['hashes'].get_hashes())
+        if len(verification['remote']) < count:  # waiting for hashes from friend
+            return
+        remote = [verification['remote'].get(i) for i in range(count)]
+        corrupted = verification['hashes'].mismatched_range(remote)
+        path, friend_number = verification['path'], verification['friend_number']
+        if corrupted is None:
+            del self._verifications[file_id]
+            log('File was verified: ' + path)
+        elif verification['attempts'] >= MAX_REFETCH_ATTEMPTS:
+            del self._verifications[file_id]
+            log('File is corrupted: ' + path)
+        else:
+            verification['attempts'] += 1
+            start, end = corrupted
+            self._resumable_transfers.add(file_id, path, friend_number, True, verification['size'], start, end)
+            try:
+                self._tox.friend_send_lossless_packet(friend_number, refetch_packet(file_id, start, end))
+            except Exception as ex:
+                log('Requesting of corrupted part of file failed: ' + str(ex))
+
+    def _get_verification(self, file_id):
+        if file_id not in self._verifications:
+            self._verifications[file_id] = {'hashes': None, 'remote': {}, 'attempts': 0}
+        self._verifications[file_id]['time'] = time.time()
+        return self._verifications[file_id]
+
+    def _remove_verification(self, file_id):
+        self._verifications.pop(file_id, None)
+        self._sent_files.pop(file_id, None)
+
+    def _restore_verification(self, file_id, verification, sent_file):
+        if verification is not None:
+            self._verifications[file_id] = verification
+        if sent_file is not None:
+            self._sent_files[file_id] = sent_file
+
+    def remove_old_verifications(self):
+        """
+        Remove data of transfers if friend sent no hashes or requests for VERIFICATION_TIMEOUT sec
+        """
+        active = set(map(lambda ft: ft.get_id(), self._file_transfers.values()))
+        old = time.time() - VERIFICATION_TIMEOUT
+        for file_id in list(self._verifications.keys()):
+            if file_id not in active and self._verifications[file_id]['time'] < old:
+                log('Hashes of file were not received: ' + self._verifications[file_id].get('path', file_id))
+                del self._verifications[file_id]
+        for file_id in list(self._sent_files.keys()):
+            if file_id not in active and self._sent_files[file_id][2] < old:
+                del self._sent_files[file_id]
+
     # -----------------------------------------------------------------------------------------------------------------
     # Avatars support
     # -----------------------------------------------------------------------------------------------------------------
@@ -1227,6 +1550,20 @@ class Profile(basecontact.BaseContact, Singleton):
 
     call = property(get_call)
 
+    def update_call_stats(self):
+        """
+        Show counters of sent frames of call with active friend
+        """
+        stats = self._call.get_stats(self.get_active_number()) if self.is_active_a_friend() else None
+        if stats is None:
+            return
+        text = QtWidgets.QApplication.translate('MainWindow', 'Audio: {} sent, {} dropped, {} errors\n'
+                                                              'Video: {} captured, {} sent, {} dropped, {} errors\n'
+                                                              'Video conversion: {:.1f} ms')
+        self._screen.show_call_stats(text.format(stats['audio_sent'], stats['audio_dropped'], stats['audio_errors'],
+                                                 stats['video_captured'], stats['video_sent'], stats['video_dropped'],
+                                                 stats['video_errors'], stats['conversion_time']))
+
     def call_click(self, audio=True, video=False):
         """User clicked audio button in main window"""
         num = self.get_active_number()
@@ -1236,6 +1573,7 @@ class Profile(basecontact.BaseContact, Singleton):
             if not Settings.get_instance().audio['enabled']:
                 return
             self._call(num, audio, video)
+            self.create_video_widget(num)
             self._screen.active_call()
             if video:
                 text = QtWidgets.QApplication.translate("incoming_call", "Outgoing video call")
@@ -1275,11 +1613,24 @@ class Profile(basecontact.BaseContact, Singleton):
         Accept incoming call with audio or video
         """
         self._call.accept_call(friend_number, audio, video)
+        self.create_video_widget(friend_number)
         self._screen.active_call()
         if friend_number in self._incoming_calls:
             self._incoming_calls.remove(friend_number)
         del self._call_widgets[friend_number]
 
+    def create_video_widget(self, friend_number):
+        """
+        Widget is created in main thread and shown when first frame of video is received
+        """
+        self._video_widgets[friend_number] = avwidgets.VideoWidget(self.get_friend_by_number(friend_number).name)
+
+    def get_video_widget(self, friend_number):
+        """
+        :return: widget which shows incoming video of friend or None
+        """
+        return self._video_widgets.get(friend_number)
+
     def stop_call(self, friend_number, by_friend):
         """
         Stop call with friend
@@ -1290,17 +1641,12 @@ class Profile(basecontact.BaseContact, Singleton):
         else:
             text = QtWidgets.QApplication.translate("incoming_call", "Call finished")
         self._screen.call_finished()
-        is_video = self._call.is_video_call(friend_number)
         self._call.finish_call(friend_number, by_friend)  # finish or decline call
         if hasattr(self, '_call_widget'):
             self._call_widget[friend_number].close()
             del self._call_widget[friend_number]
-
-        def destroy_window():
-            if is_video:
-                cv2.destroyWindow(str(friend_number))
-
-        threading.Timer(2.0, destroy_window).start()
+        if friend_number in self._video_widgets:
+            self._video_widgets.pop(friend_number).close()
         friend = self.get_friend_by_number(friend_number)
         friend.append_message(InfoMessage(text, time.time()))
         if friend_number == self.get_active_number():
@@ -117,12 +117,21 @@ class Settings(dict, Singleton):
             'language': 'English',
             'save_history': False,
             'allow_inline': True,
+            'inline_size_limit': 1024 * 1024,  # max size of inline image in bytes
             'allow_auto_accept': True,
             'auto_accept_path': None,
             'sorting': 0,
             'auto_accept_from_friends': [],
             'paused_file_transfers': {},
             'resend_files': True,
+            'file_transfers_workers': 4,
+            'verify_file_transfers': True,
+            'max_transfers_per_friend': 3,  # limits of count of running transfers of files sent as batch
+            'max_transfers': 10,
+            'upload_speed_limit': 0,  # limits of speed of file transfers in KB/s, 0 - unlimited
+            'download_speed_limit': 0,
+            'friends_speed_limits': {},  # key - tox id, value - limit in KB/s
+            'call_speed_limit': 64,  # limit of speed of file transfers during audio/video call
             'friends_aliases': [],
             'show_avatars': False,
             'typing_notifications': False,
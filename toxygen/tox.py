@@ -1235,12 +1235,14 @@ class Tox:
         :param friend_number: The friend number of the receiving friend for this file.
         :param file_number: The file transfer identifier returned by tox_file_send.
         :param position: The file or stream position from which to continue reading.
-        :param data: Chunk of file data
+        :param data: Chunk of file data (bytes or ctypes array of c_char, array is passed without copying)
         :return: true on success.
         """
         tox_err_file_send_chunk = c_int()
         result = self.libtoxcore.tox_file_send_chunk(self._tox_pointer, c_uint32(friend_number), c_uint32(file_number),
-                                                     c_uint64(position), c_char_p(data), c_size_t(len(data)),
+                                                     c_uint64(position),
+                                                     c_char_p(data) if type(data) is bytes else data,
+                                                     c_size_t(len(data)),
                                                      byref(tox_err_file_send_chunk))
         tox_err_file_send_chunk = tox_err_file_send_chunk.value
         if tox_err_file_send_chunk == TOX_ERR_FILE_SEND_CHUNK['OK']:
@@ -39,6 +39,7 @@ class ToxAV:
         self.audio_receive_frame_cb = None
         self.video_receive_frame_cb = None
         self.call_cb = None
+        self.bit_rate_status_cb = None
 
     def __del__(self):
         """
@@ -215,9 +216,57 @@ class ToxAV:
                                'that is not paused.')
 
     # -----------------------------------------------------------------------------------------------------------------
-    # TODO Controlling bit rates
+    # Controlling bit rates
     # -----------------------------------------------------------------------------------------------------------------
 
+    def bit_rate_set(self, friend_number, audio_bit_rate, video_bit_rate):
+        """
+        Set the bit rate to be used in subsequent audio/video frames.
+
+        :param friend_number: The friend number of the friend for which to set the bit rate.
+        :param audio_bit_rate: The new audio bit rate in Kb/sec. Set to 0 to disable audio sending. Set to -1 to leave
+        unchanged.
+        :param video_bit_rate: The new video bit rate in Kb/sec. Set to 0 to disable video sending. Set to -1 to leave
+        unchanged.
+        :return: True on success.
+        """
+        toxav_err_bit_rate_set = c_int()
+        result = self.libtoxav.toxav_bit_rate_set(self._toxav_pointer, c_uint32(friend_number),
+                                                   c_int32(audio_bit_rate), c_int32(video_bit_rate),
+                                                   byref(toxav_err_bit_rate_set))
+        toxav_err_bit_rate_set = toxav_err_bit_rate_set.value
+        if toxav_err_bit_rate_set == TOXAV_ERR_BIT_RATE_SET['OK']:
+            return bool(result)
+        elif toxav_err_bit_rate_set == TOXAV_ERR_BIT_RATE_SET['SYNC']:
+            raise RuntimeError('Synchronization error occurred.')
+        elif toxav_err_bit_rate_set == TOXAV_ERR_BIT_RATE_SET['INVALID_AUDIO_BIT_RATE']:
+            raise ArgumentError('The audio bit rate passed was not one of the supported values.')
+        elif toxav_err_bit_rate_set == TOXAV_ERR_BIT_RATE_SET['INVALID_VIDEO_BIT_RATE']:
+            raise ArgumentError('The video bit rate passed was not one of the supported values.')
+        elif toxav_err_bit_rate_set == TOXAV_ERR_BIT_RATE_SET['FRIEND_NOT_FOUND']:
+            raise ArgumentError('The friend_number passed did not designate a valid friend.')
+        elif toxav_err_bit_rate_set == TOXAV_ERR_BIT_RATE_SET['FRIEND_NOT_IN_CALL']:
+            raise RuntimeError('This client is currently not in a call with the friend.')
+
+    def callback_bit_rate_status(self, callback, user_data):
+        """
+        Set the callback for the `bit_rate_status` event. Pass None to unset.
+
+        :param callback: Python function.
+        The function is called when the network becomes too saturated for current bit rates at which point core
+        suggests new bit rates.
+
+        Should take pointer (c_void_p) to ToxAV object,
+        The friend number (c_uint32) of the friend for which to set the bit rate.
+        Suggested maximum audio bit rate in Kb/sec (c_uint32).
+        Suggested maximum video bit rate in Kb/sec (c_uint32).
+        pointer (c_void_p) to user_data
+        :param user_data: pointer (c_void_p) to user data
+        """
+        c_callback = CFUNCTYPE(None, c_void_p, c_uint32, c_uint32, c_uint32, c_void_p)
+        self.bit_rate_status_cb = c_callback(callback)
+        self.libtoxav.toxav_callback_bit_rate_status(self._toxav_pointer, self.bit_rate_status_cb, user_data)
+
     # -----------------------------------------------------------------------------------------------------------------
     # A/V sending
     # -----------------------------------------------------------------------------------------------------------------
@@ -278,11 +327,12 @@ class ToxAV:
         :param y: Y (Luminance) plane data.
         :param u: U (Chroma) plane data.
         :param v: V (Chroma) plane data.
+        Planes are bytes or ctypes arrays of c_char (arrays are passed without copying)
         """
         toxav_err_send_frame = c_int()
+        y, u, v = map(lambda p: c_char_p(p) if type(p) is bytes else p, (y, u, v))
         result = self.libtoxav.toxav_video_send_frame(self._toxav_pointer, c_uint32(friend_number), c_uint16(width),
-                                                       c_uint16(height), c_char_p(y), c_char_p(u), c_char_p(v),
-                                                       byref(toxav_err_send_frame))
+                                                       c_uint16(height), y, u, v, byref(toxav_err_send_frame))
         toxav_err_send_frame = toxav_err_send_frame.value
         if toxav_err_send_frame == TOXAV_ERR_SEND_FRAME['OK']:
             return bool(result)
@@ -42,6 +42,84 @@ class ToxEncryptSave:
         elif tox_err_encryption == TOX_ERR_ENCRYPTION['FAILED']:
             raise RuntimeError('The encryption itself failed.')
 
+    def pass_key_derive(self, password, salt=None):
+        """
+        Derives key from the given password. Key derivation is slow, so key should be derived once and reused.
+
+        :param salt: salt of existing key or None to generate new random salt
+        :return: TOX_PASS_KEY: salt + key
+        """
+        password = bytes(password, 'utf-8')
+        out = create_string_buffer(TOX_PASS_SALT_LENGTH + TOX_PASS_KEY_LENGTH)
+        tox_err_key_derivation = c_int()
+        if salt is None:
+            self.libtoxencryptsave.tox_derive_key_from_pass(c_char_p(password),
+                                                            c_size_t(len(password)),
+                                                            out,
+                                                            byref(tox_err_key_derivation))
+        else:
+            self.libtoxencryptsave.tox_derive_key_with_salt(c_char_p(password),
+                                                            c_size_t(len(password)),
+                                                            c_char_p(bytes(salt)),
+                                                            out,
+                                                            byref(tox_err_key_derivation))
+        tox_err_key_derivation = tox_err_key_derivation.value
+        if tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['OK']:
+            return out[:]
+        elif tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['FAILED']:
+            raise RuntimeError('The crypto lib was unable to derive a key from the given passphrase, which is usually a'
+                               ' lack of memory issue.')
+
+    def pass_key_encrypt(self, data, key):
+        """
+        Encrypts the given data with the given key derived by pass_key_derive. Doesn't derive key, so it's fast.
+
+        :return: output array
+        """
+        out = create_string_buffer(len(data) + TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+        tox_err_encryption = c_int()
+        self.libtoxencryptsave.tox_pass_key_encrypt(c_char_p(bytes(data)),
+                                                    c_size_t(len(data)),
+                                                    c_char_p(bytes(key)),
+                                                    out,
+                                                    byref(tox_err_encryption))
+        tox_err_encryption = tox_err_encryption.value
+        if tox_err_encryption == TOX_ERR_ENCRYPTION['OK']:
+            return out[:]
+        elif tox_err_encryption == TOX_ERR_ENCRYPTION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_encryption == TOX_ERR_ENCRYPTION['FAILED']:
+            raise RuntimeError('The encryption itself failed.')
+
+    def pass_key_decrypt(self, data, key):
+        """
+        Decrypts the given data with the given key derived by pass_key_derive.
+
+        :return: output array
+        """
+        out = create_string_buffer(len(data) - TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+        tox_err_decryption = c_int()
+        self.libtoxencryptsave.tox_pass_key_decrypt(c_char_p(bytes(data)),
+                                                    c_size_t(len(data)),
+                                                    c_char_p(bytes(key)),
+                                                    out,
+                                                    byref(tox_err_decryption))
+        tox_err_decryption = tox_err_decryption.value
+        if tox_err_decryption == TOX_ERR_DECRYPTION['OK']:
+            return out[:]
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['INVALID_LENGTH']:
+            raise ArgumentError('The input data was shorter than TOX_PASS_ENCRYPTION_EXTRA_LENGTH bytes')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['BAD_FORMAT']:
+            raise ArgumentError('The input data is missing the magic number (i.e. wasn\'t created by this module, or is'
+                                ' corrupted)')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['FAILED']:
+            raise RuntimeError('The encrypted byte array could not be decrypted. Either the data was corrupt or the '
+                               'key was incorrect.')
+
     def pass_decrypt(self, data, password):
         """
         Decrypts the given data with the given password.
@@ -27,3 +27,16 @@ TOX_ERR_DECRYPTION = {
 }
 
 TOX_PASS_ENCRYPTION_EXTRA_LENGTH = 80
+
+TOX_ERR_KEY_DERIVATION = {
+    # The function returned successfully.
+    'OK': 0,
+    # Some input data, or maybe the output pointer, was null.
+    'NULL': 1,
+    # The crypto lib was unable to derive a key from the given passphrase, which is usually a lack of memory issue.
+    'FAILED': 2
+}
+
+TOX_PASS_SALT_LENGTH = 32
+
+TOX_PASS_KEY_LENGTH = 32
@@ -26,3 +26,16 @@ class ToxES(util.Singleton):
 
     def pass_decrypt(self, data):
         return self._toxencryptsave.pass_decrypt(data, self._passphrase)
+
+    def derive_key(self, salt=None):
+        """
+        :param salt: salt of existing key or None to generate new salt
+        :return: key derived from current password (first TOX_PASS_SALT_LENGTH bytes of key are salt)
+        """
+        return self._toxencryptsave.pass_key_derive(self._passphrase, salt)
+
+    def key_encrypt(self, data, key):
+        return self._toxencryptsave.pass_key_encrypt(data, key)
+
+    def key_decrypt(self, data, key):
+        return self._toxencryptsave.pass_key_decrypt(data, key)
@@ -0,0 +1,90 @@
+import heapq
+from itertools import count
+
+
+class TransfersScheduler:
+    """
+    Queue of outgoing files. Files are sent in order of priority and size (small files first). Count of running
+    transfers is limited for every friend and in total
+    """
+
+    def __init__(self, start_transfer, can_send, max_per_friend, max_total):
+        """
+        :param start_transfer: callable with args (friend number, path, file id, relative path). Returns True if
+        transfer was started, False if it failed and None if it should be started later
+        :param can_send: callable with arg friend number. Returns True if friend is online
+        :param max_per_friend: max count of running transfers of one friend
+        :param max_total: max count of running transfers
+        """
+        self._start_transfer = start_transfer
+        self._can_send = can_send
+        self._max_per_friend = max_per_friend
+        self._max_total = max_total
+        self._queue = []  # heap of tuples (priority, size, number, friend number, path, file id, relative path)
+        self._counter = count()  # keeps order of files with same priority and size
+        self._running = {}  # file id -> friend number
+        self._running_count = {}  # friend number -> count of running transfers
+
+    def add(self, friend_number, files, priority=0):
+        """
+        Add files to queue
+        :param friend_number: number of friend
+        :param files: list of tuples (path, size, file id, path relative to sent directory or None)
+        :param priority: files with lower value are sent first
+        """
+        for path, size, file_id, relative_path in files:
+            heapq.heappush(self._queue, (priority, size, next(self._counter), friend_number, path, file_id,
+                                         relative_path))
+        self.schedule()
+
+    def schedule(self):
+        """
+        Start transfers while limits allow it
+        """
+        postponed = []
+        while self._queue and len(self._running) < self._max_total:
+            item = heapq.heappop(self._queue)
+            friend_number, path, file_id, relative_path = item[3:]
+            if self._running_count.get(friend_number, 0) >= self._max_per_friend or not self._can_send(friend_number):
+                postponed.append(item)
+                continue
+            started = self._start_transfer(friend_number, path, file_id, relative_path)
+            if started:
+                self._running[file_id] = friend_number
+                self._running_count[friend_number] = self._running_count.get(friend_number, 0) + 1
+            elif started is None:  # e.g. packets queue is full, other transfers will be postponed too
+                postponed.append(item)
+                break
+        for item in postponed:
+            heapq.heappush(self._queue, item)
+
+    def transfer_finished(self, file_id):
+        """
+        Transfer was finished or cancelled. Next files are started
+        """
+        if file_id not in self._running:
+            return
+        friend_number = self._running.pop(file_id)
+        self._running_count[friend_number] -= 1
+        self.schedule()
+
+    def remove_friend(self, friend_number):
+        """
+        Remove queued files of friend
+        """
+        self._queue = list(filter(lambda item: item[3] != friend_number, self._queue))
+        heapq.heapify(self._queue)
+
+    def __contains__(self, file_id):
+        """
+        :return: True if file is queued or sent
+        """
+        return file_id in self._running or any(map(lambda item: item[5] == file_id, self._queue))
+
+    def get_queue_size(self, friend_number=None):
+        """
+        :return: count of queued files of friend or of all friends
+        """
+        if friend_number is None:
+            return len(self._queue)
+        return len(list(filter(lambda item: item[3] == friend_number, self._queue)))